@@ -0,0 +1,160 @@
+"""
+Checked/CheckMixin 解析与校验的微基准测试
+
+测量两条路径每秒能构造多少个对象:
+1. parse_json: 一篇文章对应多个实例时 解析大模型回复的完整路径
+2. 直接构造: cls(**kwargs) 只包含字段的类型转换与校验
+每条路径都与baseline对比: 编译转换函数与__init__之前的实现 每次赋值经过属性描述符并重复判断类型
+
+用法: python -m benchmark.checked_bench --objects 200000
+"""
+import argparse
+import json
+import random
+import re
+import time
+
+from core import CheckMixin, Checked, filed_validator
+from core.checked import Field
+
+
+class Paper(CheckMixin, Checked):
+    """'keywords' are the key topics of the paper"""
+    title: str
+    first_author: str
+    year: int
+    citations: int
+    score: float
+    keywords: list[str]
+    venue: str
+
+    @filed_validator("title")
+    def check_title(self, v: str):
+        return v.strip()
+
+
+class LegacyField(Field):
+    """
+    编译之前的Field.__set__ 每次赋值都判断一次字段类型
+    """
+
+    def __set__(self, instance, value):
+        if value is ... or value is None:
+            value = self.constructor()
+        try:
+            if self.generic_type is list and self.generic_param_type is str:
+                if isinstance(value, str):
+                    value = [t for e in re.split(r'[,;]+', value) if (t := e.strip()) != '']
+                else:
+                    value = [str(i) for i in value]
+            else:
+                if (self.constructor is int or self.constructor is float) and isinstance(value, str):
+                    value = self.constructor('0' + value)
+                else:
+                    value = self.constructor(value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'{value!r} is not compatible with {self.name[1:]!r}:{self.constructor}') from e
+        if self.check_func is not None:
+            try:
+                value = self.check_func(value)
+            except ValueError as e:
+                raise ValueError(f'{self.name[1:]}={value!r} cannot pass the check!') from e
+        setattr(instance, self.name, value)
+
+
+class LegacyPaper(CheckMixin, Checked):
+    """'keywords' are the key topics of the paper"""
+    title: str
+    first_author: str
+    year: int
+    citations: int
+    score: float
+    keywords: list[str]
+    venue: str
+
+    # 类中定义了__init__时不生成专用的__init__ 使用Checked.__init__逐个setattr
+    __init__ = Checked.__init__
+
+    @filed_validator("title")
+    def check_title(self, v: str):
+        return v.strip()
+
+
+for _name in LegacyPaper._fields:
+    _field = getattr(LegacyPaper, _name)
+    setattr(LegacyPaper, _name, LegacyField(_field.constructor, _name, _field.check_func))
+
+
+def legacy_parse_json(cls, json_str: str):
+    """
+    编译之前的CheckMixin.parse_json(one_to_many=True) 逐个正则匹配NOT_SPECIFIED
+    """
+    json_str = json_str[json_str.index('['):json_str.rindex(']') + 1]
+    check_fields = cls.check_fields()
+    for item in json.loads(json_str):
+        missing_keys = []
+        for attr in check_fields:
+            if attr not in item:
+                missing_keys.append(attr)
+            v = item.get(attr, ...)
+            if isinstance(v, str):
+                for p in cls.NOT_SPECIFIED:
+                    if p.search(v):
+                        del item[attr]
+                        missing_keys.append(attr)
+                        break
+        extra_keys = list(set(item.keys()) - set(check_fields))
+        for attr in extra_keys:
+            del item[attr]
+        yield cls(**item), missing_keys, extra_keys
+
+
+def make_items(n: int, seed=0) -> list[dict]:
+    rng = random.Random(seed)
+    items = []
+    for i in range(n):
+        items.append({
+            "title": f"  A Study of Topic {i}  ",
+            "first_author": rng.choice(["Xu Hao", "Cai", "Leon", "not specified"]),
+            "year": str(rng.randint(1990, 2024)),
+            "citations": rng.choice([rng.randint(0, 500), "", None]),
+            "score": rng.choice([rng.random(), str(rng.random())]),
+            "keywords": rng.choice(["llm; extraction, json", ["llm", "extraction"], "unclear"]),
+            "venue": rng.choice(["ACL", "EMNLP", "unspecified venue", None]),
+        })
+    return items
+
+
+def bench(name: str, n: int, func) -> float:
+    begin = time.perf_counter()
+    func()
+    cost = time.perf_counter() - begin
+    print(f"{name:<21} {n} objects in {cost:6.2f}s, {n / cost:10.0f} objects/sec")
+    return n / cost
+
+
+def compare(name: str, n: int, baseline_func, func):
+    before = bench(f"{name} (baseline)", n, baseline_func)
+    after = bench(f"{name} (compiled)", n, func)
+    print(f"{name:<21} speedup {after / before:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--objects", type=int, default=200000)
+    args = parser.parse_args()
+
+    items = make_items(args.objects)
+    json_str = "Here is the result: " + json.dumps(items)
+
+    compare("parse_json", args.objects,
+            lambda: sum(1 for _ in legacy_parse_json(LegacyPaper, json_str)),
+            lambda: sum(1 for _ in Paper.parse_json(json_str, one_to_many=True)))
+    kwargs_list = [{k: v for k, v in e.items()} for e in items]
+    compare("construct", args.objects,
+            lambda: [LegacyPaper(**e) for e in kwargs_list],
+            lambda: [Paper(**e) for e in kwargs_list])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+端到端基准测试: 在本地模拟服务上运行build_task 不消耗真实的API调用
+用于在离线状态下发现调度器 限流器 解析与写入器的性能退化
+
+每个数据规模在独立的进程中运行 模拟服务也在独立的进程中运行 输出:
+docs/sec tokens/sec 命中前缀缓存的提示词比例 请求数与429次数 RPM/TPM的利用率 峰值RSS SQLite每秒写入行数
+请求耗时与等待限流器的p50/p99 来自框架的指标注册表
+用法: python -m benchmark.e2e_bench --docs 1000 10000 100000 --backend qwen --rpm 60000
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import socket
+import sqlite3
+import time
+import urllib.request
+from pathlib import Path
+
+import core.client_pool
+import core.task
+from core import CheckMixin, Checked, TaskConfig, build_task
+from core.chat_bot_limit import CHAT_MODEL_LIMIT, RequestLimit
+from core.metrics import REGISTRY
+from .mock_llm_server import MockLLMServer, run_in_process, parse_shapes
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BENCH_MODELS = {'qwen': 'qwen-bench', 'deepseek': 'deepseek-bench', 'glm': 'glm-bench'}
+SQL_WRITER_PATTERN = re.compile(r'sql writer: (\d+) rows written, (\d+) rows/sec')
+
+
+class UserInfo(CheckMixin, Checked):
+    """'hobby' summarized from what he often does"""
+    user_name: str
+    age: int
+    hobby: list[str]
+
+
+def make_dataset(work_dir: Path, n_docs: int, doc_chars: int, duplicate_ratio: float = 0.0) -> str:
+    """
+    生成n_docs篇合成文章 已存在且数量一致时直接复用
+    :param duplicate_ratio: 这个比例的文章是之前某篇文章的副本 其中一半替换了少量单词
+    :return: 数据集名称
+    """
+    name = f"bench_{n_docs}_{doc_chars}" + (f"_dup{duplicate_ratio:g}" if duplicate_ratio else "")
+    dataset = work_dir / name
+    if dataset.exists() and sum(1 for _ in dataset.glob("*.txt")) == n_docs:
+        return name
+    dataset.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(n_docs)
+    words = ["alice", "bob", "likes", "reading", "coding", "is", "years", "old", "and", "often", "plays", "chess"]
+    docs = []
+    for i in range(n_docs):
+        if docs and rng.random() < duplicate_ratio:
+            tokens = rng.choice(docs).split(' ')
+            if rng.random() < 0.5:
+                for _ in range(max(len(tokens) // 50, 1)):
+                    tokens[rng.randrange(len(tokens))] = rng.choice(words)
+        else:
+            # 每篇独有的用户名 使不同的文章之间足够不相似
+            tokens = [f"user{i}_{j}" if j % 5 == 0 else rng.choice(words) for j in range(doc_chars // 6)]
+        text = ' '.join(tokens)
+        docs.append(text)
+        (dataset / f"doc{i}.txt").write_text(text, encoding='utf-8')
+    return name
+
+
+def fetch_stats(base_url: str) -> dict:
+    with urllib.request.urlopen(base_url + "/stats") as response:
+        return json.loads(response.read())
+
+
+def point_to_mock(base_url: str, db_path: Path):
+    # 框架的地址与Key来自core/config.py中的常量 这里替换为模拟服务
+    core.client_pool.DASHSCOPE_BASE_URL = base_url + "/api/v1"
+    core.client_pool.ZHIPUAI_BASE_URL = base_url + "/api/paas/v4"
+    core.client_pool.OPENAI_DEEPSEEK_BASE_URL = base_url + "/v1"
+    core.client_pool.DASHSCOPE_API_KEY = core.client_pool.ZHIPUAI_API_KEY = \
+        core.client_pool.OPENAI_DEEPSEEK_API_KEY = "mock.secret"
+    core.task.DATABASE_URI = db_path.as_posix()
+
+
+class SqlWriterStats(logging.Handler):
+    # 从写入器结束时的日志中取出写入的行数与速率
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.rows_written = 0
+        self.rows_per_sec = 0
+
+    def emit(self, record: logging.LogRecord):
+        if match := SQL_WRITER_PATTERN.search(record.getMessage()):
+            self.rows_written, self.rows_per_sec = int(match[1]), int(match[2])
+
+
+def run_one(args: argparse.Namespace, n_docs: int, base_url: str, results: multiprocessing.Queue):
+    """
+    在子进程中运行一次build_task 结果放入results
+    """
+    model = BENCH_MODELS[args.backend]
+    CHAT_MODEL_LIMIT[model] = RequestLimit(args.rpm, args.tpm, 32 * 1024, args.concurrent or max(args.rpm // 4, 1))
+    work_dir = Path(args.work_dir)
+    dataset_name = make_dataset(work_dir, n_docs, args.doc_chars, args.duplicate_ratio)
+    db_path = work_dir / f"{dataset_name}.db"
+    db_path.unlink(missing_ok=True)
+    (work_dir / f"{dataset_name}_dedup.db").unlink(missing_ok=True)
+    point_to_mock(base_url, db_path)
+
+    extract_results = []
+    config = TaskConfig(input_file_type="txt", dataset_dir_path=work_dir, dataset_name=dataset_name,
+                        dataset_theme="user", model=model, one_article_to_many_instance=True,
+                        post_processing_hook=extract_results.extend, log_dir_path=work_dir / "log",
+                        num_workers=args.num_workers, parse_mode=args.parse_mode, stream_response=args.stream,
+                        pack_short_articles=args.pack, pack_max_docs=args.pack_max_docs,
+                        dedup_index_path=work_dir / f"{dataset_name}_dedup.db" if args.dedup else None,
+                        metrics_port=args.metrics_port,
+                        metrics_snapshot_path=work_dir / f"{dataset_name}_metrics.json")
+    sql_stats = SqlWriterStats()
+    logging.getLogger("InfoExtract").addHandler(sql_stats)
+
+    before = fetch_stats(base_url)
+    begin = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):  # 不在控制台逐条输出日志
+        asyncio.run(build_task(config, UserInfo))
+    elapsed = time.perf_counter() - begin
+    after = fetch_stats(base_url)
+
+    tokens = sum(e.tokens_consumed for e in extract_results if e.request_success)
+    cached_tokens = after["cached_tokens"] - before["cached_tokens"]
+    completions = after["completions"] - before["completions"]
+    served_tokens = (after["prompt_tokens"] + after["completion_tokens"]
+                     - before["prompt_tokens"] - before["completion_tokens"])
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute("SELECT COUNT(*) FROM UserInfo").fetchone()[0]
+    metrics = REGISTRY.snapshot()["metrics"]
+    request_seconds = metrics["request_seconds"]["samples"][0]
+    limiter_waits = {e["labels"]["limiter"].rsplit('/', 1)[-1]: e["p99"]
+                     for e in metrics["limiter_wait_seconds"]["samples"]}
+    results.put({
+        "docs": n_docs,
+        "seconds": elapsed,
+        "docs_per_sec": n_docs / elapsed,
+        "tokens_per_sec": tokens / elapsed,
+        "cached_ratio": cached_tokens / max(after["prompt_tokens"] - before["prompt_tokens"], 1),
+        "success": sum(e.request_success and e.parse_success for e in extract_results),
+        "requests": after["requests"] - before["requests"],
+        "rate_limited": after["rate_limited"] - before["rate_limited"],
+        "rpm_utilization": completions / (elapsed / 60) / args.rpm,
+        "tpm_utilization": served_tokens / (elapsed / 60) / args.tpm,
+        "rows": rows,
+        "sql_rows_per_sec": sql_stats.rows_per_sec,
+        "request_p50": request_seconds["p50"],
+        "request_p99": request_seconds["p99"],
+        "limiter_wait_p99": limiter_waits,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource else float('nan'),
+    })
+
+
+def print_report(r: dict):
+    print(f"docs={r['docs']:<7} {r['seconds']:7.1f}s  {r['docs_per_sec']:7.1f} docs/s  "
+          f"{r['tokens_per_sec']:9.0f} tokens/s  cached={r['cached_ratio']:.0%}  success={r['success']}  "
+          f"requests={r['requests']}  "
+          f"429={r['rate_limited']}  rpm_util={r['rpm_utilization']:.0%}  tpm_util={r['tpm_utilization']:.0%}  "
+          f"rows={r['rows']}  sql={r['sql_rows_per_sec']} rows/s  peak_rss={r['peak_rss_mb']:.0f}MB  "
+          f"request_p50={r['request_p50']:.2f}s  request_p99={r['request_p99']:.2f}s  "
+          f"wait_p99={','.join(f'{k}={v:.2f}s' for k, v in r['limiter_wait_p99'].items())}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, nargs='+', default=[1000], help="数据规模 可以有多个 如 1000 10000 100000")
+    parser.add_argument("--backend", choices=list(BENCH_MODELS), default="qwen")
+    parser.add_argument("--rpm", type=int, default=60000, help="模拟模型的每分钟请求数限制")
+    parser.add_argument("--tpm", type=int, default=10 ** 8, help="模拟模型的每分钟token数限制")
+    parser.add_argument("--concurrent", type=int, default=None, help="max_concurrent_requests 即每15秒的请求数 默认为rpm/4")
+    parser.add_argument("--num-workers", type=int, default=None, help="默认与build_task相同 由模型的并发数决定")
+    parser.add_argument("--parse-mode", choices=['inline', 'thread', 'process'], default='thread')
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--pack", action="store_true", help="将多篇短文章打包进一个请求")
+    parser.add_argument("--pack-max-docs", type=int, default=8)
+    parser.add_argument("--doc-chars", type=int, default=1000, help="每篇合成文章的字符数")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.0, help="合成数据集中重复与近似重复文章的比例")
+    parser.add_argument("--dedup", action="store_true", help="分发前对近似重复的文章去重")
+    parser.add_argument("--work-dir", default="./benchmark_output/e2e")
+    parser.add_argument("--metrics-port", type=int, default=None, help="运行期间在该端口提供/metrics")
+    # 模拟服务的行为
+    parser.add_argument("--latency", type=float, default=0.2, help="生成耗时的中位数")
+    parser.add_argument("--latency-sigma", type=float, default=0.5, help="生成耗时对数正态分布的sigma")
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0, help="随机返回429的比例")
+    parser.add_argument("--objects-per-reply", type=int, default=3)
+    parser.add_argument("--shapes", type=parse_shapes, default="array", help="如 array=0.9,truncated=0.1")
+    args = parser.parse_args()
+    Path(args.work_dir).mkdir(parents=True, exist_ok=True)
+
+    ctx = multiprocessing.get_context("spawn")
+    server = MockLLMServer(latency=args.latency, latency_sigma=args.latency_sigma,
+                           rate_limit_ratio=args.rate_limit_ratio, retry_after=0.5,
+                           objects_per_reply=args.objects_per_reply, shapes=args.shapes)
+    # 预先选好一个空闲端口 使运行build_task的进程知道模拟服务的地址
+    with socket.socket() as sock:
+        sock.bind((server.host, 0))
+        server.port = sock.getsockname()[1]
+    ready = ctx.Event()
+    server_process = ctx.Process(target=run_in_process, args=(server, ready), daemon=True)
+    server_process.start()
+    ready.wait(30)
+
+    try:
+        for n_docs in args.docs:
+            results = ctx.Queue()
+            process = ctx.Process(target=run_one, args=(args, n_docs, server.base_url, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f"docs={n_docs} failed with exit code {process.exitcode}", flush=True)
+                continue
+            print_report(results.get())
+    finally:
+        server_process.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+比较dashscope SDK(每次调用新建会话)与共享连接池的HttpTransport在本地模拟服务上的表现
+
+输出每种方式的 每秒请求数 p50/p99延迟 以及模拟服务上建立过的TCP连接数
+用法: python -m benchmark.http_transport_bench --requests 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import time
+
+import dashscope
+from dashscope.aigc.generation import AioGeneration
+
+from core.http_transport import HttpTransport
+from core.qwen_backend import DashScopeClient
+from .mock_llm_server import MockLLMServer
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+async def run(name: str, server: MockLLMServer, call, n_requests: int, concurrency: int, stream: bool):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+    connections_before = server.connections
+
+    async def one():
+        async with sem:
+            begin = time.perf_counter()
+            if stream:
+                async for response in await call(stream=True, incremental_output=True):
+                    assert response.status_code == 200, response
+            else:
+                response = await call()
+                assert response.status_code == 200, response
+            latencies.append(time.perf_counter() - begin)
+
+    begin = time.perf_counter()
+    await asyncio.gather(*[one() for _ in range(n_requests)])
+    cost = time.perf_counter() - begin
+    print(f"{name:<24} {n_requests / cost:8.0f} req/s  p50={percentile(latencies, 0.5) * 1000:6.1f}ms  "
+          f"p99={percentile(latencies, 0.99) * 1000:6.1f}ms  connections={server.connections - connections_before}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.02, help="模拟服务的生成耗时")
+    parser.add_argument("--stream", action="store_true", help="使用SSE流式接口")
+    args = parser.parse_args()
+
+    async with MockLLMServer(latency=args.latency) as server:
+        dashscope.base_http_api_url = server.base_url + "/api/v1"
+        prompt = "x" * 2000
+
+        def sdk_call(**kwargs):
+            return AioGeneration.call("qwen-plus", prompt=prompt, api_key="mock", **kwargs)
+
+        await run("dashscope sdk", server, sdk_call, args.requests, args.concurrency, args.stream)
+
+        async with HttpTransport() as transport:
+            client = DashScopeClient("mock", transport.aiohttp_session(args.concurrency), server.base_url + "/api/v1")
+
+            def pooled_call(**kwargs):
+                return client.call("qwen-plus", prompt=prompt, **kwargs)
+
+            await run("shared pool", server, pooled_call, args.requests,
+                      args.concurrency, args.stream)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
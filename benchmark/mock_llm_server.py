@@ -0,0 +1,363 @@
+"""
+本地的大模型接口模拟服务 用于在不消耗token的情况下测量框架自身的开销
+
+基于asyncio的最小HTTP/1.1服务 支持长连接 分块传输与SSE 实现以下接口:
+1. DashScope文本生成 普通与SSE流式      POST /api/v1/services/aigc/text-generation/generation
+2. 兼容OpenAI的对话补全 普通与SSE流式    POST /v1/chat/completions
+3. ZhipuAI的异步对话补全与结果查询       POST /api/paas/v4/async/chat/completions
+                                       GET  /api/paas/v4/async-result/{id}
+4. 统计信息                            GET  /stats
+
+可配置: 生成耗时的分布(对数正态 中位数为latency) 随机返回429的比例 回复中的实例数 回复的JSON形态
+用法: python -m benchmark.mock_llm_server --port 8765 --latency 0.5 --latency-sigma 0.3 --rate-limit-ratio 0.01
+"""
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+from core.extract_helper import estimate_tokens
+
+DASHSCOPE_GENERATION_PATH = "/api/v1/services/aigc/text-generation/generation"
+OPENAI_CHAT_PATH = "/v1/chat/completions"
+ZHIPUAI_ASYNC_CHAT_PATH = "/api/paas/v4/async/chat/completions"
+ZHIPUAI_ASYNC_RESULT_PATH = "/api/paas/v4/async-result/"
+PACKED_DOC_PATTERN = re.compile(r'=== Document \d+ ===')  # 与core/packing.py中的分隔行一致
+REPLY_SHAPES = ('array', 'object', 'fenced', 'truncated')
+
+
+def make_objects(n_objects: int, seed: int) -> list[dict]:
+    # 与demo.py中UserInfo的字段一致
+    return [{"user_name": f"user{seed}_{i}", "age": 20 + i % 50, "hobby": "reading; coding"} for i in range(n_objects)]
+
+
+def make_reply(n_objects: int = 3, shape: str = 'array', seed: int = 0) -> str:
+    """
+    :param shape: array: 合法的JSON数组 object: 单个JSON对象 fenced: 包在```json代码块中的数组
+                  truncated: 在80%处被截断的数组 模拟回复超出长度上限
+    """
+    objects = make_objects(n_objects, seed)
+    if shape == 'object':
+        return json.dumps(objects[0])
+    array = json.dumps(objects)
+    if shape == 'fenced':
+        return f"```json\n{array}\n```"
+    if shape == 'truncated':
+        return array[:len(array) * 4 // 5]
+    return array
+
+
+def make_packed_reply(n_docs: int, n_objects: int = 3, shape: str = 'array', seed: int = 0) -> str:
+    """
+    打包请求的回复: 以文档编号为键的JSON对象 shape为truncated时整个对象在80%处被截断 其余形状都返回合法的对象
+    """
+    reply = json.dumps({str(i): make_objects(n_objects, seed * 1000 + i) for i in range(1, n_docs + 1)})
+    return reply[:len(reply) * 4 // 5] if shape == 'truncated' else reply
+
+
+def parse_shapes(text: str) -> dict[str, float]:
+    """
+    'array=0.9,truncated=0.1' -> {'array': 0.9, 'truncated': 0.1}
+    """
+    shapes = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in REPLY_SHAPES:
+            raise ValueError(f"unknown reply shape {name!r}, choose from {REPLY_SHAPES}")
+        shapes[name] = float(weight or 1)
+    return shapes
+
+
+class MockLLMServer:
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.02, latency_sigma=0.0, rate_limit_ratio=0.0,
+                 retry_after=1.0, objects_per_reply=3, shapes: dict[str, float] | None = None, reply: str | None = None,
+                 stream_pieces=8, seed=0):
+        self.host = host
+        self.port = port
+        self.latency = latency  # 生成耗时的中位数
+        self.latency_sigma = latency_sigma  # 对数正态分布的sigma 为0时耗时固定
+        self.rate_limit_ratio = rate_limit_ratio  # 随机返回429的比例
+        self.retry_after = retry_after  # 429回复中的Retry-After
+        self.objects_per_reply = objects_per_reply
+        self.shapes = shapes or {'array': 1.0}
+        self.reply = reply  # 固定的回复 为None时按shapes生成
+        self.stream_pieces = stream_pieces  # 流式回复分成多少个事件
+        self.random = random.Random(seed)
+        self.server: asyncio.AbstractServer | None = None
+        self.glm_tasks: dict[str, tuple[float, str, dict]] = {}  # task_id -> (完成时间, 回复, token用量)
+        self.cached_prefixes: set[str] = set()  # 模拟服务端的前缀缓存 见过的system消息
+        self.stats = {"connections": 0, "requests": 0, "completions": 0, "rate_limited": 0,
+                      "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+
+    @property
+    def connections(self) -> int:
+        return self.stats["connections"]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    # ---------------- 模拟的生成过程 ----------------
+
+    def _sample_latency(self) -> float:
+        if self.latency_sigma <= 0:
+            return self.latency
+        return self.random.lognormvariate(0, self.latency_sigma) * self.latency
+
+    def _rate_limited(self) -> bool:
+        if self.rate_limit_ratio > 0 and self.random.random() < self.rate_limit_ratio:
+            self.stats["rate_limited"] += 1
+            return True
+        return False
+
+    def _generate(self, messages: list[dict]) -> tuple[str, int, int, int]:
+        """
+        以system消息开头的请求 同一个system消息第二次出现时视为命中前缀缓存
+        :return: 回复 提示词token数 回复token数 命中缓存的提示词token数
+        """
+        prompt = ''.join(e.get("content", "") for e in messages)
+        cached_tokens = 0
+        if messages and messages[0].get("role") == "system":
+            prefix = messages[0].get("content", "")
+            if prefix in self.cached_prefixes:
+                cached_tokens = estimate_tokens(prefix)
+            self.cached_prefixes.add(prefix)
+        if self.reply is not None:
+            reply = self.reply
+        else:
+            shape = self.random.choices(list(self.shapes), weights=list(self.shapes.values()))[0]
+            if n_docs := len(PACKED_DOC_PATTERN.findall(prompt)):
+                reply = make_packed_reply(n_docs, self.objects_per_reply, shape, self.stats["completions"])
+            else:
+                reply = make_reply(self.objects_per_reply, shape, self.stats["completions"])
+        prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(reply)
+        self.stats["completions"] += 1
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["completion_tokens"] += completion_tokens
+        self.stats["cached_tokens"] += cached_tokens
+        return reply, prompt_tokens, completion_tokens, cached_tokens
+
+    def _pieces(self, reply: str) -> list[str]:
+        step = max(len(reply) // self.stream_pieces, 1)
+        return [reply[i:i + step] for i in range(0, len(reply), step)]
+
+    # ---------------- HTTP ----------------
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.stats["connections"] += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    key, value = line.decode().split(':', 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.stats["requests"] += 1
+                await self._route(method, path.split('?')[0], headers, json.loads(body or b'{}'), writer)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # 事件循环结束时仍保持的长连接被取消 正常结束即可 否则asyncio会打印大量异常
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, headers: dict, body: dict, writer: asyncio.StreamWriter):
+        if path == '/stats':
+            self._write_json(writer, 200, self.stats)
+        elif not headers.get('authorization', '').startswith('Bearer '):
+            self._write_json(writer, 401, {"code": "InvalidApiKey", "message": "no api key",
+                                           "error": {"message": "no api key", "type": "invalid_request_error"}})
+        elif method == 'POST' and path == DASHSCOPE_GENERATION_PATH:
+            await self._dashscope_generation(headers, body, writer)
+        elif method == 'POST' and path == OPENAI_CHAT_PATH:
+            await self._openai_chat(body, writer)
+        elif method == 'POST' and path == ZHIPUAI_ASYNC_CHAT_PATH:
+            self._zhipuai_async_chat(body, writer)
+        elif method == 'GET' and path.startswith(ZHIPUAI_ASYNC_RESULT_PATH):
+            self._zhipuai_async_result(path[len(ZHIPUAI_ASYNC_RESULT_PATH):], writer)
+        else:
+            self._write_json(writer, 404, {"code": "NotFound", "message": path})
+
+    @staticmethod
+    def _write_head(writer: asyncio.StreamWriter, status: int, content_type: str, length: int | None = None,
+                    extra_headers: dict | None = None):
+        lines = [f"HTTP/1.1 {status} MOCK", f"Content-Type: {content_type}", "Connection: keep-alive"]
+        lines.append(f"Content-Length: {length}" if length is not None else "Transfer-Encoding: chunked")
+        lines.extend(f"{k}: {v}" for k, v in (extra_headers or {}).items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode())
+
+    def _write_json(self, writer: asyncio.StreamWriter, status: int, data: dict, extra_headers: dict | None = None):
+        payload = json.dumps(data).encode()
+        self._write_head(writer, status, "application/json", len(payload), extra_headers)
+        writer.write(payload)
+
+    def _write_rate_limited(self, writer: asyncio.StreamWriter, data: dict):
+        self._write_json(writer, 429, data, {"Retry-After": self.retry_after})
+
+    @staticmethod
+    def _write_chunk(writer: asyncio.StreamWriter, data: bytes):
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+    # ---------------- DashScope ----------------
+
+    async def _dashscope_generation(self, headers: dict, body: dict, writer: asyncio.StreamWriter):
+        request_id = uuid.uuid4().hex
+        if self._rate_limited():
+            self._write_rate_limited(writer, {"code": "Throttling.RateQuota", "message": "Requests rate limit exceeded",
+                                              "request_id": request_id})
+            return
+        model_input = body.get("input", {})
+        messages = model_input.get("messages") or [{"role": "user", "content": model_input.get("prompt", "")}]
+        reply, input_tokens, output_tokens, cached_tokens = self._generate(messages)
+        details = {"prompt_tokens_details": {"cached_tokens": cached_tokens}} if cached_tokens else {}
+        await asyncio.sleep(self._sample_latency())
+        if headers.get('x-dashscope-sse') != 'enable':
+            self._write_json(writer, 200, {
+                "output": {"text": reply, "finish_reason": "stop"},
+                "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                          "total_tokens": input_tokens + output_tokens, **details},
+                "request_id": request_id})
+            return
+
+        incremental = body.get("parameters", {}).get("incremental_output", False)
+        self._write_head(writer, 200, "text/event-stream")
+        pieces = self._pieces(reply)
+        text = ''
+        for i, piece in enumerate(pieces, 1):
+            text += piece
+            finished = i == len(pieces)
+            data = {"output": {"text": piece if incremental else text, "finish_reason": "stop" if finished else "null"},
+                    "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens * i // len(pieces),
+                              "total_tokens": input_tokens + output_tokens * i // len(pieces), **details},
+                    "request_id": request_id}
+            event = f"id:{i}\nevent:result\n:HTTP_STATUS/200\ndata:{json.dumps(data)}\n\n"
+            self._write_chunk(writer, event.encode())
+            await writer.drain()
+        self._write_chunk(writer, b"")
+
+    # ---------------- OpenAI ----------------
+
+    async def _openai_chat(self, body: dict, writer: asyncio.StreamWriter):
+        if self._rate_limited():
+            self._write_rate_limited(writer, {"error": {"message": "Rate limit reached", "type": "rate_limit_error",
+                                                        "code": "rate_limit_exceeded"}})
+            return
+        reply, prompt_tokens, completion_tokens, cached_tokens = self._generate(body.get("messages", []))
+        # 与DeepSeek一致 同时给出prompt_cache_hit_tokens与OpenAI的prompt_tokens_details
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_cache_hit_tokens": cached_tokens, "prompt_cache_miss_tokens": prompt_tokens - cached_tokens,
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        common = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": body.get("model", "")}
+        await asyncio.sleep(self._sample_latency())
+        if not body.get("stream"):
+            self._write_json(writer, 200, {
+                **common, "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+                "usage": usage})
+            return
+
+        self._write_head(writer, 200, "text/event-stream")
+        pieces = self._pieces(reply)
+        for i, piece in enumerate(pieces, 1):
+            chunk = {**common, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": piece},
+                                  "finish_reason": "stop" if i == len(pieces) else None}]}
+            self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+            await writer.drain()
+        if body.get("stream_options", {}).get("include_usage"):
+            chunk = {**common, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            self._write_chunk(writer, f"data: {json.dumps(chunk)}\n\n".encode())
+        self._write_chunk(writer, b"data: [DONE]\n\n")
+        self._write_chunk(writer, b"")
+
+    # ---------------- ZhipuAI ----------------
+
+    def _zhipuai_async_chat(self, body: dict, writer: asyncio.StreamWriter):
+        if self._rate_limited():
+            self._write_rate_limited(writer, {"error": {"code": "1302", "message": "rate limit reached"}})
+            return
+        task_id = uuid.uuid4().hex
+        reply, prompt_tokens, completion_tokens, cached_tokens = self._generate(body.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens,
+                 "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+        # 异步任务立即返回 生成在后台进行 到达完成时间之前查询都返回PROCESSING
+        self.glm_tasks[task_id] = (time.monotonic() + self._sample_latency(), reply, usage)
+        self._write_json(writer, 200, {"id": task_id, "request_id": task_id, "model": body.get("model", ""),
+                                       "task_status": "PROCESSING"})
+
+    def _zhipuai_async_result(self, task_id: str, writer: asyncio.StreamWriter):
+        if task_id not in self.glm_tasks:
+            self._write_json(writer, 404, {"error": {"code": "1214", "message": f"task {task_id} not found"}})
+            return
+        ready_at, reply, usage = self.glm_tasks[task_id]
+        data = {"id": task_id, "request_id": task_id, "model": "", "task_status": "PROCESSING"}
+        if time.monotonic() >= ready_at:
+            del self.glm_tasks[task_id]
+            data.update(task_status="SUCCESS", usage=usage,
+                        choices=[{"index": 0, "finish_reason": "stop",
+                                  "message": {"role": "assistant", "content": reply}}])
+        self._write_json(writer, 200, data)
+
+
+async def serve_forever(server: MockLLMServer, ready=None):
+    """
+    :param ready: 可选的multiprocessing.Event 服务开始监听后set 供其他进程等待
+    """
+    async with server:
+        print(f"mock llm server listening on {server.base_url}", flush=True)
+        if ready is not None:
+            ready.set()
+        await server.server.serve_forever()
+
+
+def run_in_process(server: MockLLMServer, ready=None):
+    # multiprocessing.Process的入口 在独立进程中运行 不与被测的事件循环争抢CPU
+    try:
+        asyncio.run(serve_forever(server, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--latency-sigma", type=float, default=0.0)
+    parser.add_argument("--rate-limit-ratio", type=float, default=0.0)
+    parser.add_argument("--objects-per-reply", type=int, default=3)
+    parser.add_argument("--shapes", type=parse_shapes, default="array")
+    args = parser.parse_args()
+    run_in_process(MockLLMServer(port=args.port, latency=args.latency, latency_sigma=args.latency_sigma,
+                                 rate_limit_ratio=args.rate_limit_ratio, objects_per_reply=args.objects_per_reply,
+                                 shapes=args.shapes))
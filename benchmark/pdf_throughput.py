@@ -0,0 +1,116 @@
+"""
+PDF解析吞吐量基准测试
+
+在临时目录中按固定随机种子生成合成的PDF语料(论文风格 末尾带References) 分别测量:
+1. 单进程下 extract_pdf_text + split_ref 的吞吐量
+2. parse_pdf 完整流水线(进程池 + 文件传递 + 缓存写入)的吞吐量
+3. 第二次运行 parse_pdf 时命中pdf2txt.pkl缓存的吞吐量
+
+用法: python -m benchmark.pdf_throughput --docs 40 --pages 200
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from core.pdf2txt import extract_pdf_text, split_ref, parse_pdf
+from core.task_config import TaskConfig
+
+WORDS = ("model extraction language large information article dataset method result table figure "
+         "experiment baseline accuracy training inference token context prompt schema value").split()
+
+
+def _escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def make_pdf(pages: list[list[str]]) -> bytes:
+    """
+    生成一个最简的PDF 每页为若干行Helvetica文本
+    """
+    objects: list[bytes] = []
+    page_ids = []
+    font_id = 3
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(b"")  # Pages 对象 最后再填
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for lines in pages:
+        stream = "BT /F1 9 Tf 40 800 Td 11 TL " + " ".join(f"({_escape(e)}) Tj T*" for e in lines) + " ET"
+        stream_bytes = stream.encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream_bytes) + stream_bytes + b"\nendstream")
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>" % (font_id, content_id))
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % e for e in page_ids), len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % i + obj + b"\nendobj\n"
+    xref_offset = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref_offset)
+    return bytes(out)
+
+
+def make_corpus(corpus_dir: Path, docs: int, pages: int, lines_per_page=60, seed=0):
+    rng = random.Random(seed)
+    for doc_id in range(docs):
+        doc_pages = [[" ".join(rng.choices(WORDS, k=12)) for _ in range(lines_per_page)] for _ in range(pages)]
+        doc_pages[-1][0] = "References"
+        doc_pages[-1][1:] = [f"[{i}] Author {i}. Some Paper Title. 2024." for i in range(1, lines_per_page)]
+        (corpus_dir / f"{doc_id}.pdf").write_bytes(make_pdf(doc_pages))
+
+
+def report(name: str, seconds: float, pages: int, chars: int):
+    print(f"{name:<28} {seconds:8.2f}s {pages / seconds:10.1f} pages/sec {chars / seconds / 2 ** 20:8.2f} MB/sec")
+
+
+async def run_pipeline(config: TaskConfig, paths: list[str]) -> int:
+    # 结果中没有页数 吞吐量按生成的语料的总页数计算
+    chars = 0
+    async for ret in parse_pdf(config, paths):
+        chars += len(ret.txt) + len(ret.ref_txt)
+    return chars
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type=int, default=40)
+    parser.add_argument("--pages", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        corpus_dir = tmp / "corpus"
+        corpus_dir.mkdir()
+        make_corpus(corpus_dir, args.docs, args.pages)
+        paths = sorted(e.as_posix() for e in corpus_dir.glob("*.pdf"))
+        total_pages = args.docs * args.pages
+
+        begin = time.perf_counter()
+        chars = 0
+        for path in paths:
+            text, _, _ = extract_pdf_text(Path(path))
+            chars += sum(len(e) for e in split_ref(text))
+        report("single process", time.perf_counter() - begin, total_pages, chars)
+
+        config = TaskConfig("pdf", tmp, "corpus", "benchmark", log_dir_path=tmp / "log")
+        begin = time.perf_counter()
+        chars = asyncio.run(run_pipeline(config, paths))
+        report("parse_pdf (cold)", time.perf_counter() - begin, total_pages, chars)
+
+        begin = time.perf_counter()
+        chars = asyncio.run(run_pipeline(config, paths))
+        report("parse_pdf (pdf2txt.pkl hit)", time.perf_counter() - begin, total_pages, chars)
+
+
+if __name__ == '__main__':
+    main()
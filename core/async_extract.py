@@ -1,11 +1,15 @@
 import asyncio
 import logging
 import platform
-from typing import Callable, Awaitable, Union, Type
+from typing import Any, Callable, Awaitable, Union, Type, Iterable, AsyncIterable, AsyncIterator
 
 from .checked import CheckMixin, Checked
 from .extract_helper import ExtractResult
-from .sql_helper import SQLAdapter
+from .json_stream import stream_sink
+from .metrics import TOKENS_CONSUMED, FILES_PROCESSED, QUEUE_DEPTH
+from .parse_stage import ParseStage, ParsedResponse, StreamedObjects
+from .retry import FatalError, DeadLetterQueue
+from .sql_helper import BatchWriter
 
 if platform.system() == 'Windows':
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
@@ -13,56 +17,208 @@ if platform.system() == 'Windows':
 asyncio.set_event_loop(asyncio.new_event_loop())
 
 
-async def parse_for_any_type(input_list: list[tuple[str, str]],
+async def _aiter_input(input_list: Iterable | AsyncIterable) -> AsyncIterator:
+    if hasattr(input_list, '__aiter__'):
+        async for e in input_list:
+            yield e
+    else:
+        for e in input_list:
+            yield e
+
+
+async def parse_for_any_type(input_list: Iterable[tuple[str, str]] | AsyncIterable[tuple[str, str]],
                              data_type: Union[Type[Checked], Type[CheckMixin]],
                              extract_func: Callable[[str, str], Awaitable[ExtractResult]],
-                             sql_adapter: SQLAdapter,
-                             one_to_many: bool) -> list[ExtractResult]:
+                             sql_writer: BatchWriter,
+                             one_to_many: bool,
+                             num_workers: int = 100,
+                             primary_key: str | None = None,
+                             dead_letters: DeadLetterQueue | None = None,
+                             repair_func: Callable[[str, str], Awaitable[ExtractResult]] | None = None,
+                             parse_stage: ParseStage | None = None,
+                             stream_objects: bool = False,
+                             on_result: Callable[[ExtractResult], Any] | None = None
+                             ) -> list[ExtractResult]:
+    """
+    固定数量的worker从有界队列中取任务 内存占用与事件循环开销不随数据集大小增长
+    :param num_workers: worker数量 同时也是队列的容量
+    :param primary_key: 表的主键 长文章分块提取后按它对实例去重
+    :param dead_letters: 请求或解析失败的文件记入死信表 成功的文件从中移除
+    :param repair_func: JSON语法错误且本地修复失败时 用于请求大模型修复JSON的函数
+    :param parse_stage: 解析回复的执行方式 为None时在事件循环中直接解析
+    :param stream_objects: 一篇文章对应多个实例且后端流式输出时 每个实例的右括号到达即写入数据库
+    """
     logger = logging.getLogger("InfoExtract")
-    task_list = [extract_func(*e) for e in input_list]
+    queue: asyncio.Queue[tuple[str, str] | None] = asyncio.Queue(maxsize=num_workers)
     request_success_cnt = 0
     parse_success_cnt = 0
     token_cnt = 0
-    total_task = len(input_list)
+    cached_token_cnt = 0
+    total_task = len(input_list) if hasattr(input_list, '__len__') else '?'
     task_cnt = 0
     result = []
-    # noinspection PyBroadException
-    try:
-        for e in asyncio.as_completed(task_list):
-            ret: ExtractResult = await e
-            task_cnt += 1
-            if ret.request_success:
-                request_success_cnt += 1
-                token_cnt += ret.tokens_consumed
-                logger.info(f"{task_cnt}/{total_task} file_name={ret.file_name},tokens_consumed={ret.tokens_consumed}")
-                try:
-                    ret.parse_objects = []
-                    for i, (obj, missing_keys, extra_keys) in enumerate(
-                            data_type.parse_json(ret.json_str, one_to_many)):
-                        if missing_keys or extra_keys:
-                            logger.warning(f"file_name={ret.file_name},obj={i},missing_keys={missing_keys},"
-                                           f"extra_keys={extra_keys}")
-                        ret.parse_objects.append(obj)
-                        parse_success_cnt += 1
-                        ret.json_str = ''
-                        sql_adapter.add_item(ret.file_name, obj)
-
-                except Exception as e:
+    results_by_file: dict[str, ExtractResult] = {}
+    write_failures: dict[str, str] = {}  # 尚未处理完的文件中 行写入失败的文件
+    parse_stage = parse_stage or ParseStage('inline')
+
+    async def producer():
+        async for item in _aiter_input(input_list):
+            await queue.put(item)  # 队列满时阻塞 输入只会被读取到队列容量的深度
+        for _ in range(num_workers):
+            await queue.put(None)  # 结束标记 每个worker一个
+
+    async def parse_with_repair(file_name: str, json_strs: list[str]) -> ParsedResponse:
+        """
+        本地无法修复的JSON语法错误 请求大模型修复对应的回复后重新解析 每个回复至多修复一次
+        """
+        nonlocal token_cnt, cached_token_cnt
+        json_strs = list(json_strs)
+        repaired_indices = set()
+        while True:
+            parsed = await parse_stage.parse(data_type, file_name, json_strs, one_to_many, primary_key)
+            if parsed.repaired_locally:
+                logger.info(f"file_name={file_name},json repaired locally")
+            idx = parsed.syntax_error_index
+            if repair_func is None or idx == -1 or idx in repaired_indices:
+                return parsed
+            repaired_indices.add(idx)
+            ret = await repair_func(file_name, json_strs[idx])
+            if not ret.request_success:
+                return parsed
+            token_cnt += ret.tokens_consumed
+            cached_token_cnt += ret.cached_tokens
+            count_tokens(ret)
+            logger.info(f"file_name={file_name},json repaired by model,tokens_consumed={ret.tokens_consumed}")
+            json_strs[idx] = ret.json_str
+
+    def count_tokens(ret: ExtractResult):
+        # 命中响应缓存的结果没有实际消耗token 不计入指标
+        if not ret.from_cache:
+            TOKENS_CONSUMED.labels(kind='total').inc(ret.tokens_consumed)
+            TOKENS_CONSUMED.labels(kind='cached').inc(ret.cached_tokens)
+
+    async def handle_result(ret: ExtractResult, streamed: StreamedObjects | None = None):
+        """
+        :param streamed: 流式模式下已经解析并写入的实例 不为None时不再解析完整的回复
+        """
+        nonlocal request_success_cnt, parse_success_cnt, token_cnt, cached_token_cnt, task_cnt
+        task_cnt += 1
+        if ret.request_success:
+            request_success_cnt += 1
+            token_cnt += ret.tokens_consumed
+            cached_token_cnt += ret.cached_tokens
+            count_tokens(ret)
+            logger.info(f"{task_cnt}/{total_task} file_name={ret.file_name},tokens_consumed={ret.tokens_consumed}"
+                        f"{f',cached_tokens={ret.cached_tokens}' if ret.cached_tokens else ''}"
+                        f"{',from_cache=True' if ret.from_cache else ''}")
+            if ret.fail_message:
+                # 部分分块失败 或流式回复中断后保留了部分结果
+                logger.warning(f"file_name={ret.file_name},message={ret.fail_message}")
+            try:
+                json_strs = ret.chunk_json_strs or [ret.json_str]
+                if streamed is not None:
+                    parsed = streamed.parsed_response()
+                else:
+                    parsed = await parse_with_repair(ret.file_name, json_strs)
+                for warning in parsed.warnings:
+                    logger.warning(f"file_name={ret.file_name},{warning}")
+                if parsed.error is not None:
                     ret.parse_success = False
-                    ret.fail_message = repr(e)
+                    ret.fail_message = repr(parsed.error)
                     logger.error(f"{task_cnt}/{total_task} file_name={ret.file_name},message={ret.fail_message}")
-            else:
+                if parsed.merged_from:
+                    logger.info(f"file_name={ret.file_name},{parsed.merged_from} chunks merged into "
+                                f"{len(parsed.objects)} objects")
+                ret.parse_objects = parsed.objects
+                if ret.parse_success:
+                    ret.json_str = ''
+                    ret.chunk_json_strs = None
+                parse_success_cnt += len(parsed.objects)
+                await sql_writer.add_rows(parsed.rows)
+            except Exception as e:
+                if e is sql_writer.error:  # 写入器无法继续写入 终止任务
+                    raise
+                # 单个文件的意外异常不应中止整个任务
+                ret.parse_success = False
+                ret.fail_message = repr(e)
                 logger.error(f"{task_cnt}/{total_task} file_name={ret.file_name},message={ret.fail_message}")
-            result.append(ret)
+            if ret.file_name in write_failures:  # 流式写入的行已经写入失败
+                fail_written(ret, write_failures.pop(ret.file_name))
+        else:
+            logger.error(f"{task_cnt}/{total_task} file_name={ret.file_name},message={ret.fail_message}")
+        FILES_PROCESSED.labels(outcome='success' if ret.request_success and ret.parse_success else
+                               'parse_failed' if ret.request_success else 'request_failed').inc()
+        if dead_letters is not None:
+            if ret.request_success and ret.parse_success:
+                dead_letters.remove(ret.file_name)
+            else:
+                dead_letters.add(ret.file_name, ret.fail_message)
+        if on_result is not None:
+            on_result(ret)
+        result.append(ret)
+        results_by_file[ret.file_name] = ret
+
+    def fail_written(ret: ExtractResult, message: str):
+        ret.parse_success = False
+        ret.fail_message = message
+
+    def on_write_error(file_name: str, message: str):
+        """
+        某个文件的行写入数据库失败 写入器已经继续写入其他文件的行 这里只将该文件记为失败
+        """
+        if (ret := results_by_file.get(file_name)) is None:
+            # 流式写入的行 文件本身尚未处理完 处理完时再记为失败
+            write_failures[file_name] = message
+            return
+        fail_written(ret, message)
+        if dead_letters is not None:
+            dead_letters.add(ret.file_name, ret.fail_message)
+        if on_result is not None:
+            on_result(ret)
+
+    async def worker():
+        while (item := await queue.get()) is not None:
+            file_name, file_content = item
+            streamed = None
+            if stream_objects:
+                # 流式后端每收到一个完整的实例就立即写入 不必等待完整的回复
+                streamed = StreamedObjects(data_type, file_name, sql_writer)
+                stream_sink.set(streamed)
+            try:
+                ret = await extract_func(file_name, file_content)
+            except FatalError:
+                raise
+            except Exception as e:
+                # 单个文件的意外异常不应中止整个任务
+                ret = ExtractResult(request_success=False, file_name=file_name, file_content=file_content,
+                                    fail_message=repr(e))
+            # 命中缓存 长文章分块 或后端不支持流式时 没有实例被流式写入 按完整的回复解析
+            await handle_result(ret, streamed if streamed is not None and streamed.element_cnt else None)
+
+    sql_writer.on_error = on_write_error
+    sql_writer.dead_letters = dead_letters
+    sql_writer.start()
+    QUEUE_DEPTH.set_function(queue.qsize)
+    tasks = [asyncio.create_task(producer())] + [asyncio.create_task(worker()) for _ in range(num_workers)]
+    # noinspection PyBroadException
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for t in done:
+            if t.exception() is not None:
+                raise t.exception()
     except KeyboardInterrupt:
         logger.info("end by KeyboardInterrupt")
     except Exception as e:
         logger.info(f"end by {repr(e)}")
     finally:
-        sql_adapter.commit()
+        for t in tasks:
+            t.cancel()
+        QUEUE_DEPTH.set_function(None)
+        await sql_writer.close()
         if request_success_cnt > 0:
-            logger.info(f"end: {request_success_cnt}/{total_task} requests success, "
-                        f"the average token consumption is {int(token_cnt / request_success_cnt)}")
+            logger.info(f"end: {request_success_cnt}/{task_cnt} requests success, "
+                        f"the average token consumption is {int(token_cnt / request_success_cnt)}, "
+                        f"{cached_token_cnt} prompt tokens hit the prefix cache")
             logger.info(f"end: {parse_success_cnt} instances parse success")
 
     return result
@@ -6,6 +6,7 @@ class RequestLimit(NamedTuple):
     max_tokens_consumed_per_min: int  # 每分钟消耗的最大token数 TPM
     max_len_context: int  # 请求的最大上下文长度
     max_concurrent_requests: int  # 短时间内并发请求数
+    cached_tokens_weight: float = 1.0  # 命中前缀缓存的提示词token计入TPM的比例 服务端不计入时为0
 
 
 CHAT_MODEL_LIMIT = {
@@ -4,6 +4,49 @@ import re
 import json
 from typing import Generator, Union
 
+LIST_STR_SEPARATOR = re.compile(r'[,;]+')
+_MISSING = object()
+
+
+def _compile_init(fields, field_descriptors):
+    """
+    生成专用的__init__ 每个字段直接调用对应的转换函数并写入slot 不再经过属性描述符与setattr
+    生成的代码形如:
+    def __init__(__self, *, name=..., age=..., **__unknown):
+        if __unknown:
+            __self._flag_unknown_attrs(*__unknown)
+        __self._name = __convert_name(name)
+        __self._age = __convert_age(age)
+    """
+    namespace = {f'__convert_{e}': field_descriptors[e].convert for e in fields}
+    params = ''.join(f'{e}=..., ' for e in fields)
+    lines = [f'def __init__(__self, *, {params}**__unknown):',
+             '    if __unknown:',
+             '        __self._flag_unknown_attrs(*__unknown)']
+    lines.extend(f'    __self.{field_descriptors[e].name} = __convert_{e}({e})' for e in fields)
+    exec('\n'.join(lines), namespace)
+    return namespace['__init__']
+
+
+def _compile_not_specified(patterns) -> re.Pattern:
+    # 将多个正则合并为一个 每个分支保留自己的IGNORECASE标志
+    return re.compile('|'.join(f'(?i:{p.pattern})' if p.flags & re.IGNORECASE else f'(?:{p.pattern})'
+                               for p in patterns))
+
+
+def _not_specified_search(cls):
+    """
+    返回合并NOT_SPECIFIED后的search函数 按类缓存
+    每次调用都与当前的NOT_SPECIFIED比较 类创建后修改NOT_SPECIFIED同样生效
+    """
+    patterns = tuple(cls.NOT_SPECIFIED)
+    cached = cls.__dict__.get('_not_specified_cache')
+    if cached is None or cached[0] != patterns:
+        # 空的正则会匹配任意字符串 没有模式时不匹配任何字段
+        cached = (patterns, _compile_not_specified(patterns).search if patterns else lambda _: None)
+        cls._not_specified_cache = cached
+    return cached[1]
+
 
 def filed_validator(field_name):
     def wrapper(func):
@@ -40,32 +83,64 @@ class Field:
             self.generic_type = ori_type
             self.generic_param_type = par_type
 
-    def __set__(self, instance, value):
-        if value is ... or value is None:
-            value = self.constructor()
-        try:
-            if self.generic_type is list and self.generic_param_type is str:
+        self.convert = self._compile_converter()
+
+    def _compile_converter(self):
+        """
+        在类创建时根据字段类型生成专用的转换函数 避免每次赋值时重复判断类型
+        """
+        constructor = self.constructor
+        field_name = self.name[1:]
+
+        if self.generic_type is list and self.generic_param_type is str:
+            split = LIST_STR_SEPARATOR.split
+
+            def convert(value):
+                if value is ... or value is None:
+                    return []
                 if isinstance(value, str):
-                    value = [t for e in re.split(r'[,;]+', value) if (t := e.strip()) != '']
-                else:
-                    value = [str(i) for i in value]
-            else:
-                if (self.constructor is int or self.constructor is float) and isinstance(value, str):
-                    value = self.constructor('0'+value)
-                else:
-                    value = self.constructor(value)
-        except (TypeError, ValueError) as e:
-            raise ValueError(f'{value!r} is not compatible with {self.name[1:]!r}:{self.constructor}') from e
+                    return [t for e in split(value) if (t := e.strip()) != '']
+                try:
+                    return [str(i) for i in value]
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f'{value!r} is not compatible with {field_name!r}:{constructor}') from e
+        elif constructor is int or constructor is float:
+            def convert(value):
+                if value is ... or value is None:
+                    return constructor()
+                try:
+                    if isinstance(value, str):
+                        return constructor('0' + value)
+                    return constructor(value)
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f'{value!r} is not compatible with {field_name!r}:{constructor}') from e
+        else:
+            def convert(value):
+                if value is ... or value is None:
+                    return constructor()
+                try:
+                    return constructor(value)
+                except (TypeError, ValueError) as e:
+                    raise ValueError(f'{value!r} is not compatible with {field_name!r}:{constructor}') from e
         # !r使得字符串可以带引号显示、使得其他对象的输出也更规范
         # from e 使得异常可以回溯
 
         # 如果设置了数据检查函数 这里进行检查
-        if self.check_func is not None:
+        check_func = self.check_func
+        if check_func is None:
+            return convert
+
+        def convert_and_check(value):
+            value = convert(value)
             try:
-                value = self.check_func(value)
+                return check_func(value)
             except ValueError as e:
-                raise ValueError(f'{self.name[1:]}={value!r} cannot pass the check!') from e
-        setattr(instance, self.name, value)
+                raise ValueError(f'{field_name}={value!r} cannot pass the check!') from e
+
+        return convert_and_check
+
+    def __set__(self, instance, value):
+        setattr(instance, self.name, self.convert(value))
 
     # 必须提供__get__方法
     # 否则obj.attr拿到的是属性描述符
@@ -124,6 +199,10 @@ class CheckedMeta(type):
             cls_dict['_field_types'] = tuple(_field_types)
             cls_dict['_field_defaults'] = MappingProxyType(_field_defaults)
             cls_dict['_filed_check_funcs'] = MappingProxyType(_field_check_funcs)
+            new_cls = super().__new__(cls, cls_name, bases, cls_dict)
+            if '__init__' not in cls_dict:
+                new_cls.__init__ = _compile_init(new_cls._fields, {e: getattr(new_cls, e) for e in new_cls._fields})
+            return new_cls
         return super().__new__(cls, cls_name, bases, cls_dict)
 
 
@@ -200,6 +279,8 @@ class CheckMixin:
             json_dict: list[dict] = [json.loads(json_str)]
 
         check_fields = cls.check_fields()
+        check_fields_set = frozenset(check_fields)
+        search = _not_specified_search(cls)
 
         if one_to_many and not isinstance(json_dict, list):
             raise ValueError("json_str must be a list")
@@ -208,16 +289,13 @@ class CheckMixin:
             missing_keys = []
 
             for attr in check_fields:
-                if attr not in item:
+                v = item.get(attr, _MISSING)
+                if v is _MISSING:
+                    missing_keys.append(attr)
+                elif isinstance(v, str) and search(v):  # 确保该字段不是无意义的字符串
+                    del item[attr]
                     missing_keys.append(attr)
-                v = item.get(attr, ...)
-                if isinstance(v, str):
-                    for p in cls.NOT_SPECIFIED: # 确保该字段不是无意义的字符串
-                        if p.search(v):
-                            del item[attr]
-                            missing_keys.append(attr)
-                            break
-            extra_keys = list(set(item.keys()) - set(check_fields))
+            extra_keys = [k for k in item if k not in check_fields_set]
             for attr in extra_keys:
                 del item[attr]
             yield cls(**item), missing_keys, extra_keys
@@ -0,0 +1,118 @@
+import asyncio
+import json
+from typing import Callable, Awaitable, Union, Type
+
+from .chat_bot_limit import RequestLimit
+from .checked import Checked, CheckMixin
+from .extract_helper import ExtractResult, estimate_tokens
+from .json_stream import stream_sink
+
+
+def chunk_token_budget(limit: RequestLimit, extract_prompt: str) -> int:
+    """
+    计算单个分块的文章最多可以有多少token
+    上下文长度 - 提示词模板 - 为回复预留的token 再乘上安全系数 以抵消token估计的误差
+    """
+    reserved_for_completion = max(1024, limit.max_len_context // 4)
+    budget = limit.max_len_context - estimate_tokens(extract_prompt) - reserved_for_completion
+    return max(int(budget * 0.9), 256)
+
+
+def split_article(article: str, max_tokens: int) -> list[str]:
+    """
+    按段落将文章切分为不超过max_tokens的分块 单个段落过长时按字符数硬切分
+    """
+    chunks = []
+    current = []
+    current_tokens = 0
+    for paragraph in article.splitlines(keepends=True):
+        paragraph_tokens = estimate_tokens(paragraph)
+        if paragraph_tokens > max_tokens:
+            # 按估计的每token字符数切分 保证每一段都不超过预算
+            step = max(len(paragraph) * max_tokens // paragraph_tokens, 1)
+            pieces = [paragraph[i:i + step] for i in range(0, len(paragraph), step)]
+        else:
+            pieces = [paragraph]
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece)
+            if current and current_tokens + piece_tokens > max_tokens:
+                chunks.append(''.join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+def chunked_extraction(extract_func: Callable[[str, str], Awaitable[ExtractResult]],
+                       max_tokens: int) -> Callable[[str, str], Awaitable[ExtractResult]]:
+    """
+    超过上下文长度的文章切分后并发提取 各分块的回复放在chunk_json_strs中 解析后再合并
+    """
+
+    async def wrapper(file_name: str, file_content: str) -> ExtractResult:
+        if estimate_tokens(file_content) <= max_tokens:
+            return await extract_func(file_name, file_content)
+
+        chunks = split_article(file_content, max_tokens)
+        # 各分块的实例需要合并后再写入 不能流式写入
+        stream_sink.set(None)
+        results = await asyncio.gather(*[extract_func(file_name, chunk) for chunk in chunks])
+        success = [e for e in results if e.request_success]
+        if not success:
+            results[0].file_content = file_content
+            return results[0]
+        ret = ExtractResult(file_name=file_name,
+                            json_str=success[0].json_str,
+                            tokens_consumed=sum(e.tokens_consumed for e in results),
+                            cached_tokens=sum(e.cached_tokens for e in results),
+                            chunk_json_strs=[e.json_str for e in success])
+        if len(success) != len(results):
+            ret.fail_message = f"{len(results) - len(success)}/{len(results)} chunks failed: " + \
+                               '; '.join(e.fail_message for e in results if not e.request_success)
+        return ret
+
+    return wrapper
+
+
+def _is_empty(value, default) -> bool:
+    return value is None or value == default
+
+
+def _merge_into(target: Union[Checked, CheckMixin], other: Union[Checked, CheckMixin]):
+    # 只用other填补target中为空(等于字段默认值)的字段
+    for name in target._fields:
+        default = target._field_defaults[name]
+        if _is_empty(getattr(target, name), default) and not _is_empty(v := getattr(other, name), default):
+            setattr(target, name, v)
+
+
+def merge_objects(cls: Union[Type[Checked], Type[CheckMixin]],
+                  objects: list[Union[Checked, CheckMixin]],
+                  primary_key: str | None,
+                  one_to_many: bool) -> list[Union[Checked, CheckMixin]]:
+    """
+    合并同一篇文章各分块的提取结果
+    一篇文章对应一个实例时 合并为一个实例 先出现的非空字段优先
+    一篇文章对应多个实例时 按主键去重 没有主键字段时按全部字段去重 重复的实例互相填补空字段
+    """
+    if not objects:
+        return objects
+    if not one_to_many:
+        merged = objects[0]
+        for obj in objects[1:]:
+            _merge_into(merged, obj)
+        return [merged]
+
+    merged: dict = {}
+    for obj in objects:
+        if primary_key in cls._fields:
+            key = getattr(obj, primary_key)
+        else:
+            key = json.dumps(obj._asdict(), sort_keys=True, ensure_ascii=False)
+        if key in merged:
+            _merge_into(merged[key], obj)
+        else:
+            merged[key] = obj
+    return list(merged.values())
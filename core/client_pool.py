@@ -0,0 +1,163 @@
+import logging
+from dataclasses import dataclass
+from typing import Any, Callable, Awaitable
+
+from .chat_bot_limit import CHAT_MODEL_LIMIT
+from .config import (DASHSCOPE_API_KEY, DASHSCOPE_API_KEYS, DASHSCOPE_BASE_URL,
+                     ZHIPUAI_API_KEY, ZHIPUAI_API_KEYS, ZHIPUAI_BASE_URL,
+                     OPENAI_DEEPSEEK_API_KEY, OPENAI_DEEPSEEK_BASE_URL, OPENAI_DEEPSEEK_ENDPOINTS)
+from .custom_semaphore import ModelLimiters, create_limiters
+from .extract_helper import ExtractResult
+from .http_transport import HttpTransport, connection_pool_size
+from .retry import RetryableError, FatalError
+
+RATE_LIMIT_COOLDOWN = 5.0  # 服务端没有给出Retry-After时 触发限流的Key暂停的秒数
+
+
+def mask_key(api_key: str) -> str:
+    # 日志中只显示Key的末尾几位
+    return f"***{api_key[-4:]}" if len(api_key) > 8 else "***"
+
+
+@dataclass(eq=False)
+class PooledClient:
+    name: str  # 打码后的Key 用于日志
+    client: Any  # 后端的客户端
+    limiters: ModelLimiters  # 这个Key专属的限流器
+    in_flight: int = 0  # 已分配到这个Key 尚未完成(包括在限流器中等待)的请求数
+    success_cnt: int = 0
+    fail_cnt: int = 0
+    ejected: str = ''  # 被剔除的原因 为空表示健康
+
+    def __repr__(self):
+        state = f"ejected={self.ejected!r}" if self.ejected else f"in_flight={self.in_flight}"
+        return f"PooledClient({self.name},success={self.success_cnt},fail={self.fail_cnt},{state})"
+
+
+class ClientPool:
+    """
+    多个API Key(或多个服务地址)组成的客户端池 每个Key有独立的限流器 总吞吐随Key的数量增长
+    请求分配给负载最低的Key: 先比较未完成的请求数 再比较剩余的请求令牌
+    鉴权失败 欠费等致命错误只剔除对应的Key 请求换一个Key重试 所有Key都被剔除时才终止任务
+    """
+
+    def __init__(self, clients: list[PooledClient]):
+        if not clients:
+            raise ValueError("client pool must have at least one client")
+        self.clients = clients
+        self.logger = logging.getLogger("InfoExtract")
+
+    def __len__(self):
+        return len(self.clients)
+
+    def healthy(self) -> list[PooledClient]:
+        return [e for e in self.clients if not e.ejected]
+
+    def acquire(self) -> PooledClient:
+        healthy = self.healthy()
+        if not healthy:
+            raise FatalError("all api keys are ejected", [f"{e.name}: {e.ejected}" for e in self.clients])
+        return min(healthy, key=lambda e: (e.in_flight, -e.limiters.timed_reqs_sem.tokens))
+
+    def eject(self, client: PooledClient, reason: str):
+        if not client.ejected:
+            client.ejected = reason
+            self.logger.error(f"api key {client.name} ejected: {reason}, "
+                              f"{len(self.healthy())}/{len(self.clients)} keys remain")
+
+    def extraction(self, backend: Callable[..., Awaitable[ExtractResult]]
+                   ) -> Callable[[str, str], Awaitable[ExtractResult]]:
+        """
+        :param backend: 除限流器与client外参数都已绑定的后端函数
+        :return: (file_name, file_content) -> ExtractResult 的提取函数
+        """
+
+        async def wrapper(file_name: str, file_content: str) -> ExtractResult:
+            client = self.acquire()
+            client.in_flight += 1
+            try:
+                ret = await backend(file_name, file_content,
+                                    timed_reqs_sem=client.limiters.timed_reqs_sem,
+                                    flow_sem=client.limiters.flow_sem,
+                                    instant_sem=client.limiters.instant_req_sem,
+                                    client=client.client)
+            except FatalError as e:
+                client.fail_cnt += 1
+                self.eject(client, repr(e))
+                if not self.healthy():
+                    raise
+                raise RetryableError(f"api key {client.name} ejected: {e}", retry_after=0) from e
+            except RetryableError as e:
+                client.fail_cnt += 1
+                if e.rate_limited:
+                    # 只让触发限流的Key暂停 其他Key继续处理请求
+                    client.limiters.penalize(e.retry_after if e.retry_after is not None else RATE_LIMIT_COOLDOWN)
+                raise
+            finally:
+                client.in_flight -= 1
+            # 后端把部分异常转换为失败的结果返回 这些也计为失败
+            if ret.request_success:
+                client.success_cnt += 1
+            else:
+                client.fail_cnt += 1
+            return ret
+
+        return wrapper
+
+    def cancel(self):
+        for e in self.clients:
+            e.limiters.cancel()
+
+    def __repr__(self):
+        return f"ClientPool({self.clients})"
+
+
+def shard_clients(clients: list, shard: tuple[int, int]) -> tuple[list, float]:
+    """
+    分片模式下每个分片(进程或主机)只使用一部分Key 避免多个分片各自按完整的限额请求同一个Key
+    Key不少于分片数时 第i个分片使用第i, i+count, ...个Key
+    Key比分片少时 每个分片使用一个Key 共用同一个Key的分片平分它的限额
+    :param shard: (分片序号, 分片总数)
+    :return: 该分片的客户端 与 每个Key的限额比例
+    """
+    index, count = shard
+    if not 0 <= index < count:
+        raise ValueError(f"shard index {index} out of range for {count} shards")
+    if len(clients) >= count:
+        return clients[index::count], 1.0
+    key_index = index % len(clients)
+    return [clients[key_index]], 1 / len(range(key_index, count, len(clients)))
+
+
+def create_client_pool(model: str, transport: HttpTransport, shard: tuple[int, int] | None = None) -> ClientPool:
+    """
+    根据config中配置的Key为模型创建客户端池 没有配置Key列表时只有一个客户端
+    同一模型的所有Key共享transport中的一个连接池 SDK自身的重试关闭 统一由重试层处理
+    :param shard: (分片序号, 分片总数) 为None时使用全部的Key
+    """
+    limit = CHAT_MODEL_LIMIT[model]
+    if model.startswith("qwen"):
+        from .qwen_backend import DashScopeClient
+        keys = DASHSCOPE_API_KEYS or [DASHSCOPE_API_KEY]
+        session = transport.aiohttp_session(connection_pool_size(limit, len(keys)))
+        clients = [(key, DashScopeClient(key, session, DASHSCOPE_BASE_URL)) for key in keys]
+    elif model.startswith("glm"):
+        from zhipuai import ZhipuAI
+        from .glm_backend import EXECUTOR_THREADS
+        keys = ZHIPUAI_API_KEYS or [ZHIPUAI_API_KEY]
+        # 同步SDK在线程池中发出请求 连接数不需要超过线程数
+        http_client = transport.sync_client(EXECUTOR_THREADS)
+        clients = [(key, ZhipuAI(api_key=key, base_url=ZHIPUAI_BASE_URL, http_client=http_client, max_retries=0))
+                   for key in keys]
+    elif model.startswith("deepseek"):
+        from openai import AsyncOpenAI
+        endpoints = OPENAI_DEEPSEEK_ENDPOINTS or [(OPENAI_DEEPSEEK_API_KEY, OPENAI_DEEPSEEK_BASE_URL)]
+        http_client = transport.async_client(connection_pool_size(limit, len(endpoints)))
+        clients = [(key, AsyncOpenAI(api_key=key, base_url=base_url, http_client=http_client, max_retries=0))
+                   for key, base_url in endpoints]
+    else:
+        raise ValueError(f"unsupported model {model}")
+    share = 1.0
+    if shard is not None:
+        clients, share = shard_clients(clients, shard)
+    return ClientPool([PooledClient(mask_key(key), client, create_limiters(model, share)) for key, client in clients])
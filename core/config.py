@@ -5,3 +5,11 @@ DASHSCOPE_API_KEY = ""
 ZHIPUAI_API_KEY = ""
 OPENAI_DEEPSEEK_API_KEY = ""
 OPENAI_DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+DASHSCOPE_BASE_URL = "https://dashscope.aliyuncs.com/api/v1"
+ZHIPUAI_BASE_URL = "https://open.bigmodel.cn/api/paas/v4"
+
+# 拥有多个API Key时填写在以下列表中 请求会分散到各个Key 每个Key有独立的限流
+# 列表为空时使用上面的单个Key
+DASHSCOPE_API_KEYS: list[str] = []
+ZHIPUAI_API_KEYS: list[str] = []
+OPENAI_DEEPSEEK_ENDPOINTS: list[tuple[str, str]] = []  # (api_key, base_url)
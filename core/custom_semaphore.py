@@ -1,85 +1,204 @@
 import asyncio
-
-
-class TimedReqsSemaphore:
-    def __init__(self, limit, reset_interval=60):
+import time
+from typing import Callable, Awaitable, NamedTuple
+
+from .chat_bot_limit import CHAT_MODEL_LIMIT
+from .extract_helper import estimate_tokens
+from .metrics import LIMITER_WAIT_SECONDS, LIMITER_TOKENS_TAKEN, LIMITER_LIMIT
+
+
+class TokenBucket:
+    """
+    令牌桶 限制每reset_interval秒内消耗的令牌数不超过limit
+    令牌按limit / reset_interval的速率平滑补充 长期的消耗速率恰好为limit 桶容量burst只决定允许的瞬时突发
+    任意reset_interval秒的窗口内 消耗量至多为 burst + limit 不会像固定窗口那样在边界处出现2倍的突发
+    clock与sleep可替换 便于用假时钟做确定性的测试
+    给定name时 等待时间 消耗的令牌数与每分钟的限制记入指标 同名的令牌桶(例如多个Key)合并统计
+    """
+
+    def __init__(self, limit, reset_interval=60, burst=None,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], Awaitable] = asyncio.sleep,
+                 name: str | None = None):
+        if limit < 1:
+            raise ValueError("limit must be at least 1")
         self.limit = limit
         self.reset_interval = reset_interval
-        self.semaphore = asyncio.BoundedSemaphore(limit)
+        self.burst = min(burst or max(1, limit // 10), limit)  # 桶容量 即允许的最大瞬时突发
+        self.rate = limit / reset_interval  # 每秒补充的令牌数
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.updated_at = clock()
+        self.lock = asyncio.Lock()  # asyncio.Lock是公平的 等待者按到达顺序获得令牌
+        self.name = name
+        if name is not None:
+            self.wait_seconds = LIMITER_WAIT_SECONDS.labels(limiter=name)
+            self.tokens_taken = LIMITER_TOKENS_TAKEN.labels(limiter=name)
+            LIMITER_LIMIT.labels(limiter=name).inc(limit * 60 / reset_interval)
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def take(self, n=1):
+        """
+        取走n个令牌 令牌不足时等待 n超过桶容量时按桶容量等待 避免永远等不到
+        """
+        need = min(n, self.burst)
+        begin = time.perf_counter()
+        async with self.lock:
+            self._refill()
+            while self.tokens < need - 1e-9:  # 容忍浮点误差 否则可能陷入极短的反复睡眠
+                # 令牌不足 睡眠到恰好补充出足够的令牌 被取消时不会消耗令牌
+                await self.sleep((need - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= n  # 可以为负 欠下的令牌由后续请求等待补齐
+        if self.name is not None:
+            # 包括排队等锁的时间 即调用方实际等待的时间
+            self.wait_seconds.observe(time.perf_counter() - begin)
+            self.tokens_taken.inc(n)
+
+    def adjust(self, n):
+        """
+        结算: n为正表示补扣令牌 为负表示退还令牌
+        """
+        self._refill()
+        self.tokens = min(self.burst, self.tokens - n)
+
+    def penalize(self, seconds: float):
+        """
+        收到限流信号后 清空令牌并欠下seconds秒的补充量 使之后的请求一起暂停seconds秒
+        """
+        self._refill()
+        self.tokens = min(self.tokens, -self.rate * seconds)
+
+    def cancel(self):
+        # 令牌桶不依赖后台定时任务 只从指标中撤下该令牌桶的限制
+        if self.name is not None:
+            LIMITER_LIMIT.labels(limiter=self.name).dec(self.limit * 60 / self.reset_interval)
+            self.name = None
+
 
-        async def reset_timer():
-            while True:
-                try:
-                    await asyncio.sleep(reset_interval)
-                    for _ in range(limit):
-                        self.semaphore.release()
-                except asyncio.CancelledError:
-                    break
+class TimedReqsSemaphore(TokenBucket):
+    """
+    每reset_interval秒的请求数限制 每个请求消耗一个令牌
+    """
 
-        self.resetTimer = asyncio.create_task(reset_timer())
+    async def acquire(self):
+        await self.take(1)
 
     async def __aenter__(self):
-        await self.semaphore.acquire()
+        await self.acquire()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
 
-    def cancel(self):
-        self.resetTimer.cancel()
+    def __repr__(self):
+        return f"TimedReqsSemaphore(limit={self.limit},reset_interval={self.reset_interval},burst={self.burst})"
+
+
+class FlowSemaphore(TokenBucket):
+    """
+    每reset_interval秒的token消耗限制
+    每个请求按提示词长度与历史的平均回复token数预留流量 请求结束后按实际用量多退少补
+    命中前缀缓存的提示词token按cached_tokens_weight计入 预留时按历史的缓存命中比例折算
+    """
+
+    def __init__(self, limit, reset_interval=60, burst=None, completion_tokens_prior=1024, smoothing=0.1,
+                 cached_tokens_weight=1.0, **kwargs):
+        super().__init__(limit, reset_interval, burst, **kwargs)
+        self.smoothing = smoothing  # 指数滑动平均的系数
+        self.cached_tokens_weight = cached_tokens_weight
+        self.prompt_tokens_ratio = 1.0  # 实际提示词token数 / estimate_tokens估计值
+        self.cached_tokens_ratio = 0.0  # 命中缓存的token数 / 实际提示词token数
+        self.avg_completion_tokens = float(completion_tokens_prior)  # 平均回复token数
+        self.observed_cnt = 0
+
+    def charged(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> int:
+        # 实际计入限制的token数
+        return int(prompt_tokens - cached_tokens * (1 - self.cached_tokens_weight) + completion_tokens)
+
+    def estimate(self, prompt: str) -> int:
+        prompt_tokens = estimate_tokens(prompt) * self.prompt_tokens_ratio
+        return self.charged(prompt_tokens, self.avg_completion_tokens, prompt_tokens * self.cached_tokens_ratio)
+
+    def reserve(self, prompt: str) -> 'FlowReservation':
+        return FlowReservation(self, prompt)
+
+    def observe(self, prompt: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0):
+        # 前几次观测直接取平均 之后转为指数滑动平均 兼顾冷启动与跟随变化
+        self.observed_cnt += 1
+        alpha = max(self.smoothing, 1 / self.observed_cnt)
+        if prompt_tokens > 0:
+            ratio = prompt_tokens / max(estimate_tokens(prompt), 1)
+            self.prompt_tokens_ratio += alpha * (ratio - self.prompt_tokens_ratio)
+            self.cached_tokens_ratio += alpha * (min(cached_tokens / prompt_tokens, 1.0) - self.cached_tokens_ratio)
+        self.avg_completion_tokens += alpha * (completion_tokens - self.avg_completion_tokens)
 
     def __repr__(self):
-        return f"TimedReqsSemaphore(limit={self.limit},reset_interval={self.reset_interval})"
+        return (f"FlowSemaphore(limit={self.limit},reset_interval={self.reset_interval},burst={self.burst},"
+                f"prompt_tokens_ratio={self.prompt_tokens_ratio:.2f},"
+                f"cached_tokens_ratio={self.cached_tokens_ratio:.2f},"
+                f"avg_completion_tokens={int(self.avg_completion_tokens)})")
 
 
-class FlowSemaphore:
-    def __init__(self, limit, estimate_once, reset_interval=60):
-        if limit < estimate_once:
-            raise RuntimeError("limit must greater than estimate_once!")
-        self.limit = limit  # 一段时间内允许的流量上限
-        self.count = limit  # 流量计数器
-        self.reset_interval = reset_interval
-        self.estimate_once = estimate_once  # 每次进入上下文管理器最多消耗的流量
-        self.lock = asyncio.Lock()
-        self.condition = asyncio.Condition(self.lock)
-
-        async def reset_timer():
-            while True:
-                try:
-                    await asyncio.sleep(reset_interval)
-                    async with self.lock:
-                        self.count = self.limit
-                        # 保守地唤醒阻塞的协程
-                        # 唤醒这么多协程一定不会触发流量限流
-                        self.condition.notify(n=int(self.limit / self.estimate_once))
-                except asyncio.CancelledError:
-                    break
-
-        self.resetTimer = asyncio.create_task(reset_timer())
+class FlowReservation:
+    """
+    一次请求的流量预留 作为异步上下文管理器使用
+    进入时按估计值预留 请求完成后必须调用flow()以实际用量结算
+    未结算(例如请求异常)时预留的流量不退还 偏保守但不会触发限流
+    """
+
+    def __init__(self, flow_sem: FlowSemaphore, prompt: str):
+        self.flow_sem = flow_sem
+        self.prompt = prompt
+        self.reserved = 0
 
     async def __aenter__(self):
-        # 每次进入不一定会消耗estimate这么多的流量
-        # 因此在多次进入的情况下，流量消耗一定比预估得少
-        # 这样就可以在不触发流量限流的情况下 尽可能多的请求
-        async with self.lock:
-            self.count -= self.estimate_once
-            if self.count < 0:
-                await self.condition.wait()
+        self.reserved = self.flow_sem.estimate(self.prompt)
+        await self.flow_sem.take(self.reserved)
         return self
 
-    async def flow(self, n):
-        # 该函数必须调用 以正确监测流量消耗
-        async with self.lock:
-            self.count -= n
-            self.count += self.estimate_once
-            if self.count > 0:
-                self.condition.notify()  # 这里唤醒一个因流量不足而阻塞的协程
-
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         pass
 
+    async def flow(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0):
+        # 该函数必须调用 以正确监测流量消耗
+        charged = self.flow_sem.charged(prompt_tokens, completion_tokens, cached_tokens)
+        self.flow_sem.adjust(charged - self.reserved)
+        self.flow_sem.observe(self.prompt, prompt_tokens, completion_tokens, cached_tokens)
+        self.reserved = charged
+
+
+class ModelLimiters(NamedTuple):
+    timed_reqs_sem: TimedReqsSemaphore  # 每分钟请求数
+    flow_sem: FlowSemaphore  # 每分钟消耗的token数
+    instant_req_sem: TimedReqsSemaphore  # 瞬时请求数
+
+    def penalize(self, seconds: float):
+        # 限流只影响请求数 token流量的预留照常进行
+        self.timed_reqs_sem.penalize(seconds)
+        self.instant_req_sem.penalize(seconds)
+
     def cancel(self):
-        self.resetTimer.cancel()
+        for e in self:
+            e.cancel()
 
-    def __repr__(self):
-        return f"FlowSemaphore(limit={self.limit},estimate_once={self.estimate_once},reset_interval={self.reset_interval})"
+
+def create_limiters(model: str, share: float = 1.0) -> ModelLimiters:
+    """
+    :param share: 多个分片共用同一个Key时 每个分片只使用限额的这个比例
+    """
+    limit = CHAT_MODEL_LIMIT[model]
+
+    def scaled(n: int) -> int:
+        return max(int(n * share), 1)
+
+    return ModelLimiters(TimedReqsSemaphore(scaled(limit.max_reqs_per_min), name=f"{model}/rpm"),
+                         FlowSemaphore(scaled(limit.max_tokens_consumed_per_min),
+                                       cached_tokens_weight=limit.cached_tokens_weight, name=f"{model}/tpm"),
+                         # 限制瞬时请求的数量
+                         TimedReqsSemaphore(scaled(limit.max_concurrent_requests), 15, name=f"{model}/instant"))
@@ -0,0 +1,288 @@
+import asyncio
+import hashlib
+import logging
+import re
+import sqlite3
+import zlib
+from collections import deque
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Any, AsyncIterator, AsyncIterable, Callable, Iterable
+
+from .extract_helper import ExtractResult
+from .sql_helper import SQLAdapter
+
+SHINGLE_SIZE = 5  # 按字符切分的shingle长度 对中文与英文都适用
+NUM_PERM = 128  # MinHash签名的长度
+LSH_BANDS = 16  # LSH分段数 每段NUM_PERM // LSH_BANDS行 相似度约0.7以上的文章大概率落入同一个桶
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+WHITESPACE_PATTERN = re.compile(r'\s+')
+_permutations = None
+
+
+def _get_permutations():
+    # 固定的随机种子 各进程以及各次运行的签名可以互相比较
+    global _permutations
+    if _permutations is None:
+        import numpy as np
+        rng = np.random.RandomState(20240521)
+        _permutations = (rng.randint(1, 1 << 31, NUM_PERM, dtype=np.uint64),
+                         rng.randint(0, 1 << 31, NUM_PERM, dtype=np.uint64))
+    return _permutations
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def minhash_signature(content: str) -> bytes:
+    """
+    去除大小写与空白差异后 按字符shingle计算MinHash签名
+    """
+    import numpy as np
+    text = WHITESPACE_PATTERN.sub(' ', content).strip().lower()
+    hashes = np.unique(np.fromiter((zlib.crc32(text[i:i + SHINGLE_SIZE].encode('utf-8'))
+                                    for i in range(max(len(text) - SHINGLE_SIZE + 1, 1))), dtype=np.uint64))
+    a, b = _get_permutations()
+    signature = np.empty(NUM_PERM, dtype=np.uint64)
+    buffer = np.empty_like(hashes)
+    # (a * h + b) mod p 模拟NUM_PERM个随机排列 a与h都小于2**32 乘积不会溢出
+    # 逐个排列在同一个缓冲区中原地计算 内存只与shingle数成正比 长文档不会在每个进程中占用数GB
+    for i in range(NUM_PERM):
+        np.multiply(hashes, a[i], out=buffer)
+        buffer += b[i]
+        buffer %= MERSENNE_PRIME
+        buffer &= MAX_HASH
+        signature[i] = buffer.min()
+    return signature.tobytes()
+
+
+def compute_signatures(contents: list[str], known_digests: list[str | None]) -> list[tuple[str, bytes | None]]:
+    """
+    在进程池中执行 内容哈希与签名一起计算 不占用事件循环
+    :param known_digests: 索引中记录的各文件的内容哈希 哈希未变的文件不需要计算签名
+    :return: 内容哈希 与 签名 内容未变时签名为None
+    """
+    ret = []
+    for content, known_digest in zip(contents, known_digests):
+        digest = content_hash(content)
+        ret.append((digest, minhash_signature(content) if digest != known_digest else None))
+    return ret
+
+
+def estimate_similarity(signature: bytes, other: bytes) -> float:
+    # 两个签名相同位置取值相同的比例 是Jaccard相似度的无偏估计
+    import numpy as np
+    return float(np.mean(np.frombuffer(signature, dtype=np.uint64) == np.frombuffer(other, dtype=np.uint64)))
+
+
+def lsh_buckets(signature: bytes) -> list[tuple[int, int]]:
+    rows = len(signature) // LSH_BANDS
+    return [(band, int.from_bytes(hashlib.blake2b(signature[band * rows:(band + 1) * rows], digest_size=8).digest(),
+                                  'little', signed=True))
+            for band in range(LSH_BANDS)]
+
+
+class DedupIndex:
+    """
+    持久化的签名索引
+    DedupDocument记录每个文件的内容哈希 签名与它所属簇的代表文件 代表文件是簇中第一个被处理的文件
+    DedupBucket只记录代表文件的LSH桶 新文件只与各簇的代表比较
+    再次运行时 内容未变的文件直接沿用之前的结果 只有新文件或内容变化的文件需要计算签名
+    """
+
+    def __init__(self, path: Path, threshold: float = 0.8):
+        if isinstance(path, str):
+            path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.threshold = threshold  # 估计的Jaccard相似度不低于该值视为近似重复
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS DedupDocument("
+                          "file_path TEXT PRIMARY KEY, content_hash TEXT, signature BLOB, representative TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_DedupDocument_content_hash ON DedupDocument(content_hash)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS DedupBucket(band INTEGER, bucket INTEGER, file_path TEXT)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_DedupBucket_bucket ON DedupBucket(band, bucket)")
+        self.conn.commit()
+        self.reused_cnt = 0  # 沿用之前结果的文件数
+        self.hashed_cnt = 0  # 计算了签名的文件数
+        self.exact_duplicate_cnt = 0
+        self.near_duplicate_cnt = 0
+
+    def lookup(self, file_path: str) -> tuple[str, str] | None:
+        """
+        :return: 之前记录的内容哈希 与 代表文件 没有记录时为None
+        """
+        return self.conn.execute("SELECT content_hash, representative FROM DedupDocument WHERE file_path=?",
+                                 (file_path,)).fetchone()
+
+    def reuse(self, file_path: str, representative: str) -> str:
+        # 内容未变 沿用之前判定的代表文件
+        self.reused_cnt += 1
+        return representative
+
+    def find_exact(self, file_path: str, digest: str) -> str | None:
+        row = self.conn.execute("SELECT representative FROM DedupDocument WHERE content_hash=? AND file_path!=? "
+                                "LIMIT 1", (digest, file_path)).fetchone()
+        return row[0] if row is not None else None
+
+    def find_similar(self, signature: bytes) -> str | None:
+        candidates = set()
+        for band, bucket in lsh_buckets(signature):
+            cur = self.conn.execute("SELECT file_path FROM DedupBucket WHERE band=? AND bucket=?", (band, bucket))
+            candidates.update(e for (e,) in cur)
+        for candidate in sorted(candidates):
+            row = self.conn.execute("SELECT signature FROM DedupDocument WHERE file_path=?", (candidate,)).fetchone()
+            if row is not None and row[0] is not None and estimate_similarity(signature, row[0]) >= self.threshold:
+                return candidate
+        return None
+
+    def add(self, file_path: str, digest: str, signature: bytes | None, representative: str):
+        # 内容变化的文件先清除旧的记录
+        self.conn.execute("DELETE FROM DedupBucket WHERE file_path=?", (file_path,))
+        self.conn.execute("INSERT OR REPLACE INTO DedupDocument VALUES (?, ?, ?, ?)",
+                          (file_path, digest, signature if representative == file_path else None, representative))
+        if representative == file_path:
+            self.conn.executemany("INSERT INTO DedupBucket VALUES (?, ?, ?)",
+                                  [(band, bucket, file_path) for band, bucket in lsh_buckets(signature)])
+
+    def classify(self, file_path: str, digest: str, signature: bytes) -> str:
+        """
+        判定新文件所属的簇 并记入索引
+        :return: 代表文件 与file_path相同表示它是新簇的代表
+        """
+        self.hashed_cnt += 1
+        if (representative := self.find_exact(file_path, digest)) is not None:
+            self.exact_duplicate_cnt += 1
+        elif (representative := self.find_similar(signature)) is not None:
+            self.near_duplicate_cnt += 1
+        else:
+            representative = file_path
+        self.add(file_path, digest, signature, representative)
+        return representative
+
+    def duplicates(self) -> list[tuple[str, str]]:
+        """
+        :return: 所有 (重复文件, 代表文件)
+        """
+        return self.conn.execute("SELECT file_path, representative FROM DedupDocument "
+                                 "WHERE representative!=file_path").fetchall()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def stats(self) -> dict:
+        return {"reused": self.reused_cnt, "hashed": self.hashed_cnt,
+                "exact_duplicates": self.exact_duplicate_cnt, "near_duplicates": self.near_duplicate_cnt}
+
+
+class PendingDuplicates:
+    """
+    被跳过的重复文件在代表文件的结果确定之前不算处理完成
+    任务结束 写入器关闭后 代表文件成功的 从代表文件复制行 代表文件失败或没有行的 重复文件也记为失败
+    代表文件不在本次运行中时(之前的运行 或其他分片) 以它在表中是否已有行为准
+    """
+
+    def __init__(self):
+        self.representatives: dict[str, str] = {}  # 重复文件 -> 代表文件
+        self.outcomes: dict[str, ExtractResult] = {}  # 本次运行中代表文件的结果
+
+    def add(self, file_path: str, representative: str):
+        # 作为deduplicate的on_duplicate
+        self.representatives[file_path] = representative
+
+    def record(self, ret: ExtractResult):
+        # 每个文件的结果 行写入失败时以失败的结果再次调用
+        self.outcomes[ret.file_name] = ret
+
+    def resolve(self, adapter: SQLAdapter) -> list[ExtractResult]:
+        """
+        :return: 各重复文件的结果
+        """
+        results = []
+        fanned_out = []
+        for file_path, representative in self.representatives.items():
+            if (outcome := self.outcomes.get(representative)) is not None:
+                success = outcome.request_success and outcome.parse_success
+                fail_message = f"representative {representative} failed: {outcome.fail_message}"
+            else:
+                success = adapter.check_exist(representative)
+                fail_message = f"representative {representative} has no rows"
+            if success:
+                fanned_out.append((file_path, representative))
+                results.append(ExtractResult(file_name=file_path))
+            else:
+                results.append(ExtractResult(file_name=file_path, parse_success=False, fail_message=fail_message))
+        adapter.fan_out(fanned_out)
+        return results
+
+    def __len__(self):
+        return len(self.representatives)
+
+
+async def deduplicate(input_data: Iterable[tuple[str, str]] | AsyncIterable[tuple[str, str]],
+                      index: DedupIndex,
+                      executor: Executor,
+                      batch_size: int = 64,
+                      max_pending_batches: int = 4,
+                      on_duplicate: Callable[[str, str], Any] | None = None) -> AsyncIterator[tuple[str, str]]:
+    """
+    分发前去重 只产生每个簇的代表文件 重复文件的提取结果在任务结束时由PendingDuplicates复制
+    内容哈希与签名按批次在进程池中计算 同时至多max_pending_batches个批次在计算中 按输入顺序判定所属的簇
+    :param input_data: 文件路径 与 文件内容
+    :param on_duplicate: 每个被跳过的重复文件调用一次 参数为文件路径与代表文件
+    """
+    from .async_extract import _aiter_input
+    logger = logging.getLogger("InfoExtract")
+    loop = asyncio.get_running_loop()
+    pending: deque[tuple[list[tuple[str, str, tuple[str, str] | None]], asyncio.Future]] = deque()
+
+    def skip(file_path: str, representative: str):
+        logger.debug(f"file_name={file_path},duplicate of {representative}")
+        if on_duplicate is not None:
+            on_duplicate(file_path, representative)
+
+    def submit(batch: list[tuple[str, str, tuple[str, str] | None]]):
+        known_digests = [known[0] if known is not None else None for _, _, known in batch]
+        future = loop.run_in_executor(executor, compute_signatures, [e[1] for e in batch], known_digests)
+        pending.append((batch, future))
+
+    def classify_batch(batch: list[tuple[str, str, tuple[str, str] | None]],
+                       signatures: list[tuple[str, bytes | None]]) -> list[tuple[str, str]]:
+        ret = []
+        for (file_path, content, known), (digest, signature) in zip(batch, signatures):
+            if signature is None:
+                representative = index.reuse(file_path, known[1])
+            else:
+                representative = index.classify(file_path, digest, signature)
+            if representative == file_path:
+                ret.append((file_path, content))
+            else:
+                skip(file_path, representative)
+        index.commit()
+        return ret
+
+    batch: list[tuple[str, str, tuple[str, str] | None]] = []
+    async for file_path, content in _aiter_input(input_data):
+        batch.append((file_path, content, index.lookup(file_path)))
+        if len(batch) >= batch_size:
+            submit(batch)
+            batch = []
+        if len(pending) >= max_pending_batches:
+            done_batch, future = pending.popleft()
+            for item in classify_batch(done_batch, await future):
+                yield item
+    if batch:
+        submit(batch)
+    while pending:
+        done_batch, future = pending.popleft()
+        for item in classify_batch(done_batch, await future):
+            yield item
+    logger.info(f"dedup: {index.stats()}")
@@ -1,11 +1,13 @@
 import re
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Union
+from typing import Optional, Union, NamedTuple
 
 from .checked import Checked, CheckMixin
 
 CHINESE_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+CHINESE_RUN_PATTERN = re.compile(r'[\u4e00-\u9fff]+')
 
 
 @dataclass
@@ -16,15 +18,75 @@ class ExtractResult:
     json_str: str = ''
     fail_message: str = ''
     tokens_consumed: int = 0
+    cached_tokens: int = 0  # 提示词中命中服务端前缀缓存的token数 计费更低
+    from_cache: bool = False  # 是否来自本地的回复缓存
+    chunk_json_strs: Optional[list[str]] = None  # 长文章切分提取时 各分块的回复
 
     parse_success: bool = True
     parse_objects: Optional[list[Union[Checked, CheckMixin]]] = None
 
 
+class ExtractPrompt(NamedTuple):
+    prefix: str  # 指令 字段格式与示例 同一模板的所有请求逐字节相同 可以命中服务端的前缀缓存
+    article: str  # 随文章变化的部分
+
+    @property
+    def text(self) -> str:
+        return self.prefix + self.article
+
+    def messages(self) -> list[dict]:
+        # 不变的前缀作为system消息 文章作为user消息
+        if not self.prefix:
+            return [{"role": "user", "content": self.article}]
+        return [{"role": "system", "content": self.prefix}, {"role": "user", "content": self.article}]
+
+
+@lru_cache(maxsize=16)
+def _split_prompt_template(extract_prompt: str) -> tuple[str, str]:
+    # 从{article}所在行的行首切开 之前的部分与文章无关
+    idx = extract_prompt.find('{article}')
+    if idx == -1:
+        return '', extract_prompt
+    line_start = extract_prompt.rfind('\n', 0, idx) + 1
+    return extract_prompt[:line_start].format(), extract_prompt[line_start:]
+
+
+def build_prompt(extract_prompt: str, file_content: str) -> ExtractPrompt:
+    """
+    将提示词模板分为不变的前缀与文章部分 两者拼接后与extract_prompt.format(article=file_content)相同
+    :param extract_prompt: get_extract_prompt_template得到的模板 只剩{article}一个占位符
+    """
+    prefix, article_template = _split_prompt_template(extract_prompt)
+    return ExtractPrompt(prefix, article_template.format(article=file_content))
+
+
+def cached_prompt_tokens(usage) -> int:
+    """
+    从各后端的token用量中取出命中前缀缓存的提示词token数 没有该信息时为0
+    DeepSeek为prompt_cache_hit_tokens OpenAI DashScope ZhipuAI为prompt_tokens_details.cached_tokens
+    """
+
+    def get(obj, name):
+        return obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+
+    if (hit := get(usage, 'prompt_cache_hit_tokens')) is not None:
+        return hit
+    details = get(usage, 'prompt_tokens_details')
+    return (get(details, 'cached_tokens') or 0) if details is not None else 0
+
+
 def _is_got_json_str(json_str: str):
     return json_str.find("{") != -1 and json_str.find("}") != -1
 
 
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计文本的token数: 中文字符约1个token 其余约4个字符1个token
+    """
+    non_chinese_len = len(CHINESE_RUN_PATTERN.sub('', text))
+    return (len(text) - non_chinese_len) + non_chinese_len // 4 + 1
+
+
 def not_contains_chinese(text):
     # 使用正则表达式判断字符串中是否包含中文字符
     match = CHINESE_PATTERN.search(text)
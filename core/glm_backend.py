@@ -1,11 +1,46 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from zhipuai import ZhipuAI
 from .config import ZHIPUAI_API_KEY
-from .custom_semaphore import TimedReqsSemaphore
-from .extract_helper import _is_got_json_str, ExtractResult
+from .custom_semaphore import TimedReqsSemaphore, FlowSemaphore
+from .extract_helper import _is_got_json_str, ExtractResult, build_prompt, cached_prompt_tokens
+from .metrics import REQUEST_SECONDS
+from .retry import failure_from_exception
 
-client = ZhipuAI(api_key=ZHIPUAI_API_KEY)
+default_client = ZhipuAI(api_key=ZHIPUAI_API_KEY)
+
+POLL_INITIAL_INTERVAL = 1  # 首次查询结果前等待的秒数
+POLL_MAX_INTERVAL = 10  # 查询间隔的上限
+POLL_BACKOFF_FACTOR = 1.5  # 每次查询后间隔的增长倍数
+POLL_TIMEOUT = 120  # 等待异步任务完成的总时长上限
+
+# ZhipuAI只提供同步客户端 HTTP请求放到独立的线程池中执行 避免阻塞事件循环
+# 独立的线程池使大量待查询的任务可以并发轮询 不与默认线程池中的其他工作争抢线程
+EXECUTOR_THREADS = 32
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_THREADS, thread_name_prefix="glm_backend")
+
+
+async def run_sync(func, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, **kwargs))
+
+
+async def poll_completion_result(client: ZhipuAI, task_id: str):
+    """
+    以指数退避的间隔轮询异步任务的结果 每个任务在各自的协程中轮询 互不阻塞
+    :return: 最后一次查询的回复 与 任务状态
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + POLL_TIMEOUT
+    interval = POLL_INITIAL_INTERVAL
+    while True:
+        await asyncio.sleep(min(interval, max(deadline - loop.time(), 0)))
+        response = await run_sync(client.chat.asyncCompletions.retrieve_completion_result, id=task_id)
+        task_status = response.task_status
+        if task_status == 'SUCCESS' or task_status == 'FAILED' or loop.time() >= deadline:
+            return response, task_status
+        interval = min(interval * POLL_BACKOFF_FACTOR, POLL_MAX_INTERVAL)
 
 
 async def glm_extraction(file_name,
@@ -14,33 +49,30 @@ async def glm_extraction(file_name,
                          instant_sem: TimedReqsSemaphore,
                          extract_model: str,
                          extract_prompt: str,
-                         post_check_func: callable  # 后处理函数
+                         post_check_func: callable,  # 后处理函数
+                         flow_sem: FlowSemaphore | None = None,  # GLM不限制token 仅为与其他后端的调用方式一致
+                         client: ZhipuAI | None = None  # 客户端池分配的客户端 为None时使用默认客户端
                          ) -> ExtractResult:
-    async with (timed_reqs_sem, instant_sem):  # GLM只从并发请求数量上做限制
+    client = client or default_client
+    request_timer = REQUEST_SECONDS.labels(model=extract_model).time()
+    # GLM只从并发请求数量上做限制 计时器最后进入 只统计获得令牌之后的耗时
+    async with (timed_reqs_sem, instant_sem, request_timer):
         try:
-            response = client.chat.asyncCompletions.create(
+            response = await run_sync(
+                client.chat.asyncCompletions.create,
                 model=extract_model,  # 填写需要调用的模型名称
-                messages=[
-                    {
-                        "role": "user",
-                        "content": extract_prompt.format(article=file_content)
-                    }
-                ],
+                # 指令与字段格式放在不变的system消息中 文章放在user消息中 使请求的前缀可以命中缓存
+                messages=build_prompt(extract_prompt, file_content).messages(),
             )
-            task_id = response.id
-            task_status = ''
-            get_cnt = 0
-
-            while task_status != 'SUCCESS' and task_status != 'FAILED' and get_cnt <= 40:
-                response = client.chat.asyncCompletions.retrieve_completion_result(id=task_id)
-                task_status = response.task_status
-                await asyncio.sleep(2)
-                get_cnt += 1
+            response, task_status = await poll_completion_result(client, response.id)
 
             if task_status == 'SUCCESS':
                 if _is_got_json_str(response.choices[0].message.content) and post_check_func(
                         response.choices[0].message.content):
-                    return ExtractResult(file_name=file_name, json_str=response.choices[0].message.content)
+                    usage = response.usage
+                    return ExtractResult(file_name=file_name, json_str=response.choices[0].message.content,
+                                         tokens_consumed=usage.total_tokens if usage else 0,
+                                         cached_tokens=cached_prompt_tokens(usage) if usage else 0)
                 else:
                     return ExtractResult(request_success=False, file_name=file_name, file_content=file_content,
                                          fail_message="Not got a json str or post check failed")
@@ -49,5 +81,5 @@ async def glm_extraction(file_name,
                 return ExtractResult(request_success=False, file_name=file_name, file_content=file_content,
                                      fail_message=repr(response))
         except Exception as e:
-            # 得记录下是哪个文件发生了不可继续的异常
-            raise RuntimeError(file_name, repr(e))
+            # 限流 超时等异常交给重试层 鉴权失败等异常终止任务
+            return failure_from_exception(e, file_name, file_content)
@@ -0,0 +1,122 @@
+import itertools
+import logging
+import math
+
+import httpx
+
+from .chat_bot_limit import RequestLimit
+
+CONNECT_TIMEOUT = 10.0
+READ_TIMEOUT = 300.0  # 长回复的生成可能需要几分钟
+KEEPALIVE_EXPIRY = 60.0  # 空闲连接保留的秒数
+POOL_SHARD_SIZE = 32  # 每个httpcore连接池的长连接数 更大的连接池拆分为多个
+
+
+def http2_supported() -> bool:
+    # httpx的HTTP/2需要额外安装h2: pip install httpx[http2]
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def connection_pool_size(limit: RequestLimit, n_keys: int = 1) -> int:
+    """
+    保持的长连接数与模型的瞬时并发数一致 多个Key共享同一个连接池
+    """
+    return max(limit.max_concurrent_requests * n_keys, 1)
+
+
+class ShardedAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    httpcore每次分配连接时扫描池中所有的连接与等待中的请求 开销随同时进行的请求数平方增长
+    数百个请求同时进行时事件循环的CPU都耗在这里 因此拆分为多个小连接池 请求轮流分配
+    """
+
+    def __init__(self, pool_size: int, http2: bool, shard_size: int = POOL_SHARD_SIZE):
+        n_shards = max(math.ceil(pool_size / shard_size), 1)
+        per_shard = math.ceil(pool_size / n_shards)
+        # 允许超出长连接数的短暂突发 超出部分用完即关闭
+        limits = httpx.Limits(max_connections=per_shard * 2, max_keepalive_connections=per_shard,
+                              keepalive_expiry=KEEPALIVE_EXPIRY)
+        ssl_context = httpx.create_ssl_context()  # 创建SSL上下文需要加载证书 各连接池共用一个
+        self.shards = [httpx.AsyncHTTPTransport(verify=ssl_context, limits=limits, http2=http2)
+                       for _ in range(n_shards)]
+        self.next_shard = itertools.cycle(self.shards)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await next(self.next_shard).handle_async_request(request)
+
+    async def aclose(self):
+        for shard in self.shards:
+            await shard.aclose()
+
+    def __len__(self):
+        return len(self.shards)
+
+
+class HttpTransport:
+    """
+    管理各后端使用的HTTP连接池 在build_task中创建 任务结束时显式关闭
+    连接池按RequestLimit设置大小 长连接被复用 避免每个请求重新建立TCP与TLS连接 异步的连接池拆分为多个小连接池
+    同一时刻超过连接数上限的请求在连接池中排队 不会超时
+    openai与zhipuai的SDK要求httpx客户端 安装h2时使用HTTP/2
+    DashScope没有可注入连接池的异步SDK 使用aiohttp会话(dashscope本身依赖aiohttp) 高并发下开销比httpx小得多
+    """
+
+    def __init__(self, http2: bool | None = None):
+        self.http2 = http2_supported() if http2 is None else http2
+        self.async_clients: list[httpx.AsyncClient] = []
+        self.sync_clients: list[httpx.Client] = []
+        self.aiohttp_sessions = []
+
+    def _limits(self, pool_size: int) -> httpx.Limits:
+        # 允许超出长连接数的短暂突发 超出部分用完即关闭
+        return httpx.Limits(max_connections=pool_size * 2, max_keepalive_connections=pool_size,
+                            keepalive_expiry=KEEPALIVE_EXPIRY)
+
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=None)
+
+    def async_client(self, pool_size: int) -> httpx.AsyncClient:
+        client = httpx.AsyncClient(transport=ShardedAsyncTransport(pool_size, self.http2), timeout=self._timeout())
+        self.async_clients.append(client)
+        return client
+
+    def sync_client(self, pool_size: int) -> httpx.Client:
+        # 供只有同步SDK的后端在线程池中使用 httpx.Client是线程安全的
+        client = httpx.Client(limits=self._limits(pool_size), timeout=self._timeout(), http2=self.http2)
+        self.sync_clients.append(client)
+        return client
+
+    def aiohttp_session(self, pool_size: int):
+        # 必须在事件循环中调用
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=pool_size * 2, keepalive_timeout=KEEPALIVE_EXPIRY)
+        timeout = aiohttp.ClientTimeout(total=None, connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        self.aiohttp_sessions.append(session)
+        return session
+
+    async def aclose(self):
+        for client in self.async_clients:
+            await client.aclose()
+        for client in self.sync_clients:
+            client.close()
+        for session in self.aiohttp_sessions:
+            await session.close()
+        logging.getLogger("InfoExtract").debug(f"http transport closed: {self}")
+        self.async_clients.clear()
+        self.sync_clients.clear()
+        self.aiohttp_sessions.clear()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.aclose()
+
+    def __repr__(self):
+        return (f"HttpTransport(http2={self.http2},async_pools={len(self.async_clients)},"
+                f"sync_pools={len(self.sync_clients)},aiohttp_sessions={len(self.aiohttp_sessions)})")
@@ -0,0 +1,122 @@
+import json
+import re
+
+CODE_FENCE_PATTERN = re.compile(r'```(?:json)?', re.IGNORECASE)
+PYTHON_LITERALS = {'None': 'null', 'True': 'true', 'False': 'false'}
+CLOSING = {'{': '}', '[': ']'}
+
+
+def is_json_syntax_error(e: Exception) -> bool:
+    """
+    parse_json的异常是否源于JSON本身的语法问题 字段校验失败等异常无法通过修复JSON解决
+    """
+    return isinstance(e, json.JSONDecodeError) or (isinstance(e, ValueError) and e.args == ('substring not found',))
+
+
+def _strip_trailing_comma(out: list[str]):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ',':
+        out.pop()
+
+
+def repair_json_locally(text: str, one_to_many: bool = False) -> str | None:
+    """
+    在本地修复大模型回复中常见的JSON错误 不消耗token
+    支持: 代码块标记 注释 单引号字符串 Python字面量 尾随逗号 被截断的数组或对象
+    被截断的数组只保留最后一个完整的元素
+    :return: 修复后可以被json.loads解析的字符串 无法修复时返回None
+    """
+    text = CODE_FENCE_PATTERN.sub('', text)
+    begin = text.find('[' if one_to_many else '{')
+    if begin == -1:
+        return None
+    text = text[begin:]
+
+    out: list[str] = []
+    stack: list[str] = []
+    quote = ''  # 当前所在字符串的引号 不在字符串中时为空
+    last_complete = -1  # 顶层数组中最后一个完整元素结束时out的长度
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if quote:
+            if c == '\\' and i + 1 < n:
+                nxt = text[i + 1]
+                # 单引号字符串中的\'在JSON中不需要转义
+                out.append("'" if nxt == "'" else c + nxt)
+                i += 2
+                continue
+            if c == quote:
+                out.append('"')
+                quote = ''
+            elif c == '"':
+                out.append('\\"')  # 单引号字符串中出现的双引号
+            elif c == '\n':
+                out.append('\\n')
+            elif c < ' ':
+                out.append(' ')  # JSON字符串中不能出现不可打印字符
+            else:
+                out.append(c)
+            i += 1
+            continue
+
+        if c == '"' or c == "'":
+            quote = c
+            out.append('"')
+        elif c == '/' and text.startswith('//', i):
+            end = text.find('\n', i)
+            i = n if end == -1 else end
+            continue
+        elif c == '/' and text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            continue
+        elif c in CLOSING:
+            stack.append(c)
+            out.append(c)
+        elif c == '}' or c == ']':
+            if not stack or CLOSING[stack[-1]] != c:
+                return None
+            _strip_trailing_comma(out)
+            stack.pop()
+            out.append(c)
+            if len(stack) == 1 and stack[0] == '[':
+                last_complete = len(out)
+            if not stack:
+                break  # 第一个完整的JSON值之后的内容都丢弃
+        elif c.isalpha():
+            end = i
+            while end < n and (text[end].isalnum() or text[end] == '_'):
+                end += 1
+            word = text[i:end]
+            out.append(PYTHON_LITERALS.get(word, word))
+            i = end
+            continue
+        else:
+            out.append(c)
+        i += 1
+
+    if stack:  # 被截断
+        if stack[0] == '[' and last_complete != -1:
+            # 丢弃被截断的最后一个元素 只保留完整的元素
+            del out[last_complete:]
+            _strip_trailing_comma(out)
+            stack = ['[']
+        else:
+            if quote:
+                out.append('"')
+            _strip_trailing_comma(out)
+            if out and out[-1] == ':':
+                out.append('null')
+        while stack:
+            _strip_trailing_comma(out)
+            out.append(CLOSING[stack.pop()])
+
+    repaired = ''.join(out)
+    try:
+        json.loads(repaired)
+    except json.JSONDecodeError:
+        return None
+    return repaired
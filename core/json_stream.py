@@ -0,0 +1,102 @@
+from contextvars import ContextVar
+from typing import Callable, Awaitable
+
+from .extract_helper import ExtractResult, estimate_tokens
+
+# 当前文章的流式回调 每收到一个完整的数组元素(JSON对象的文本)调用一次 返回因此写入的行数
+# 由parse_for_any_type的worker设置 流式后端读取 为None时后端只拼接完整回复
+stream_sink: ContextVar[Callable[[str], Awaitable[int]] | None] = ContextVar('stream_sink', default=None)
+
+
+class JsonArrayStream:
+    """
+    增量解析JSON数组 每当顶层数组中的一个对象的右括号到达时 返回该对象的完整文本
+    第一个'['之前的内容(如代码块标记 说明文字)被忽略 顶层数组结束后的内容也被忽略
+    只识别双引号字符串 单引号等不规范的写法留给json_repair处理
+    """
+
+    def __init__(self):
+        self.started = False  # 是否已遇到顶层数组的'['
+        self.finished = False  # 顶层数组是否已结束
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.buffer: list[str] = []  # 当前元素已接收的文本
+        self.element_cnt = 0
+
+    def feed(self, text: str) -> list[str]:
+        elements = []
+        for c in text:
+            if self.finished:
+                break
+            if not self.started:
+                if c == '[':
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.depth > 1:
+                self.buffer.append(c)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+            elif c == '"':
+                self.in_string = True
+            elif c == '{' or c == '[':
+                self.depth += 1
+                if self.depth == 2:
+                    self.buffer = [c]
+            elif c == '}' or c == ']':
+                self.depth -= 1
+                if self.depth == 1:
+                    if self.buffer and self.buffer[0] == '{':
+                        elements.append(''.join(self.buffer))
+                        self.element_cnt += 1
+                    self.buffer = []
+                elif self.depth == 0:
+                    self.finished = True
+        return elements
+
+
+class StreamCollector:
+    """
+    供流式后端使用: 拼接回复的增量文本 并把完整的数组元素交给当前文章的stream_sink
+    """
+
+    def __init__(self):
+        self.parser = JsonArrayStream()
+        self.sink = stream_sink.get()
+        self.chunks: list[str] = []
+        self.rows_emitted = 0  # sink已经写入的行数
+
+    async def feed(self, delta: str):
+        self.chunks.append(delta)
+        for element in self.parser.feed(delta):
+            if self.sink is not None:
+                self.rows_emitted += await self.sink(element)
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.chunks)
+
+    @property
+    def salvageable(self) -> bool:
+        """
+        回复中断时 已经有行通过sink写入了数据库 就保留部分结果 不再重试 重试会导致重复
+        没有sink(一对一模式 分块提取)或尚未写入任何行时 回复不完整就应当重试
+        """
+        return self.sink is not None and self.rows_emitted > 0
+
+
+def salvage_result(file_name: str, prompt: str, collector: StreamCollector, error: Exception) -> ExtractResult:
+    """
+    流式回复中断时 保留已完整接收的实例 中断时没有token用量 按估计值记录
+    不完整的最后一个元素在解析时由json_repair丢弃
+    """
+    return ExtractResult(file_name=file_name,
+                         json_str=collector.text,
+                         tokens_consumed=estimate_tokens(prompt) + estimate_tokens(collector.text),
+                         fail_message=f"stream interrupted after {collector.parser.element_cnt} objects: {error!r}")
@@ -1,21 +1,122 @@
+import atexit
+import json
 import logging
+import queue
+import re
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
+FILE_NAME_PATTERN = re.compile(r'file_name=(.*?),')
+DIGITS_PATTERN = re.compile(r'\d+')
+# LogRecord自带的属性 其余属性来自extra 在JSON行中原样输出
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
 
-def init_logging(file_path: Path):
+_queue_handler: QueueHandler | None = None
+_listener: QueueListener | None = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    每条日志一行JSON 消息中的file_name单独成为一个字段 便于按文件检索
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        message = record.getMessage()
+        ret = {"time": self.formatTime(record, '%Y-%m-%d %H:%M:%S'), "level": record.levelname, "message": message}
+        if (match := FILE_NAME_PATTERN.search(message)) is not None:
+            ret["file_name"] = match[1]
+        ret.update((k, v) for k, v in vars(record).items() if k not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            ret["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(ret, ensure_ascii=False, default=str)
+
+
+class WarningRateLimiter(logging.Filter):
+    """
+    同类警告每interval秒至多记录limit条 去掉文件名与数字后消息相同的视为同类
+    例如每个文件都可能产生的缺失或多余字段的警告 窗口结束后的第一条附上被略去的条数
+    """
+
+    def __init__(self, limit: int = 20, interval: float = 60.0):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows: dict[str, list] = {}  # 类别 -> [窗口开始时间, 窗口内的条数, 被略去的条数]
+        self.lock = threading.Lock()  # 解析线程等其他线程也会记录日志
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno != logging.WARNING:
+            return True
+        key = DIGITS_PATTERN.sub('#', FILE_NAME_PATTERN.sub('file_name=,', str(record.msg)))
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.setdefault(key, [now, 0, 0])
+            if now - window[0] >= self.interval:
+                suppressed = window[2]
+                window[:] = [now, 0, 0]
+                if suppressed:
+                    record.msg = f"{record.getMessage()} ({suppressed} similar warnings suppressed)"
+                    record.args = None
+            window[1] += 1
+            if window[1] > self.limit:
+                window[2] += 1
+                return False
+            return True
+
+
+def init_logging(file_path: Path,
+                 json_lines: bool = False,
+                 max_bytes: int = 100 << 20,
+                 backup_count: int = 5,
+                 warning_limit: int = 20):
+    """
+    日志记录只放入队列 控制台与文件的写入在单独的线程中进行 不阻塞事件循环
+    重复调用时替换之前的配置 同一进程中运行多个任务不会重复输出
+    :param json_lines: 日志文件是否每行一个JSON对象
+    :param max_bytes: 日志文件超过这么多字节时轮转 0为不轮转
+    :param backup_count: 保留的轮转文件数
+    :param warning_limit: 同类警告每分钟至多记录的条数 0为不限制
+    """
+    global _queue_handler, _listener
+    shutdown_logging()
     logger = logging.getLogger('InfoExtract')
     logger.setLevel(logging.DEBUG)
 
     console_h = logging.StreamHandler()
     console_h.setLevel(logging.INFO)
 
-    file_h = logging.FileHandler(file_path, encoding="utf-8")
+    file_h = RotatingFileHandler(file_path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
     file_h.setLevel(logging.DEBUG)
 
     formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
     console_h.setFormatter(formatter)
-    file_h.setFormatter(formatter)
+    file_h.setFormatter(JsonFormatter() if json_lines else formatter)
 
-    logger.addHandler(console_h)
-    logger.addHandler(file_h)
+    _queue_handler = QueueHandler(queue.SimpleQueue())
+    if warning_limit > 0:
+        # 在放入队列之前过滤 被略去的警告不占用队列与写入线程
+        _queue_handler.addFilter(WarningRateLimiter(warning_limit))
+    _listener = QueueListener(_queue_handler.queue, console_h, file_h, respect_handler_level=True)
+    _listener.start()
+    logger.addHandler(_queue_handler)
     return logger
+
+
+def shutdown_logging():
+    """
+    写完队列中剩余的日志后关闭文件 任务结束与进程退出时调用
+    """
+    global _queue_handler, _listener
+    if _queue_handler is not None:
+        logging.getLogger('InfoExtract').removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,358 @@
+import asyncio
+import bisect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+# 覆盖从毫秒级的限流等待到几分钟的长回复
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for v in labels.values())
+    return '{' + ','.join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + '}'
+
+
+class _Timer:
+    # 同时支持with与async with 可以与限流器写在同一个async with中
+    def __init__(self, histogram: 'HistogramChild'):
+        self.histogram = histogram
+        self.begin = 0.0
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(time.perf_counter() - self.begin)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.__exit__(exc_type, exc_val, exc_tb)
+
+
+class CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()  # 写入器与解析在其他线程中更新指标
+
+    def inc(self, n: float = 1):
+        with self.lock:
+            self.value += n
+
+
+class GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Callable[[], float] | None = None
+        self.lock = threading.Lock()
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, n: float = 1):
+        with self.lock:
+            self.value += n
+
+    def dec(self, n: float = 1):
+        self.inc(-n)
+
+    def set_function(self, function: Callable[[], float] | None):
+        # 读取指标时才调用 适合队列长度这类随时可以查询的值
+        self.function = function
+
+    def get(self) -> float:
+        return self.function() if self.function is not None else self.value
+
+
+class HistogramChild:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个为+Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        ret, total = [], 0
+        for le, cnt in zip((*self.buckets, math.inf), self.counts):
+            total += cnt
+            ret.append((le, total))
+        return ret
+
+    def quantile(self, q: float) -> float | None:
+        """
+        在桶内线性插值估计分位数 落在+Inf桶时返回最大的有限桶边界 没有观测值时为None
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        lower, prev_total = 0.0, 0
+        for le, total in self.cumulative():
+            if total >= rank:
+                if le == math.inf:
+                    return lower
+                in_bucket = total - prev_total
+                return lower + (le - lower) * ((rank - prev_total) / in_bucket if in_bucket else 0)
+            lower, prev_total = le, total
+        return lower
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.children: dict[tuple, object] = {}
+        self.lock = threading.Lock()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(str(labels[e]) for e in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._new_child())
+        return child
+
+    def _default(self):
+        # 没有标签的指标直接调用inc observe等方法
+        if self.labelnames:
+            raise ValueError(f"metric {self.name} requires labels {self.labelnames}")
+        return self.labels()
+
+    def samples(self):
+        for key, child in list(self.children.items()):
+            yield dict(zip(self.labelnames, key)), child
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, n: float = 1):
+        self._default().inc(n)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def set_function(self, function: Callable[[], float] | None):
+        self._default().set_function(function)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self) -> _Timer:
+        return self._default().time()
+
+
+class MetricsRegistry:
+    """
+    进程内的指标注册表 指标累积整个进程的生命周期 多次运行build_task时继续累加
+    """
+
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+        self.created_at = time.time()
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                raise ValueError(f"metric {metric.name} already registered with a different type or labels")
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """
+        Prometheus的文本格式
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for labels, child in metric.samples():
+                if isinstance(child, HistogramChild):
+                    for le, total in child.cumulative():
+                        lines.append(f"{metric.name}_bucket{_format_labels({**labels, 'le': _format_value(le)})} "
+                                     f"{total}")
+                    lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_value(child.sum)}")
+                    lines.append(f"{metric.name}_count{_format_labels(labels)} {child.count}")
+                else:
+                    value = child.get() if isinstance(child, GaugeChild) else child.value
+                    lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> dict:
+        """
+        JSON快照 直方图给出数量 总和与估计的分位数
+        """
+        metrics = {}
+        for metric in self.metrics.values():
+            samples = []
+            for labels, child in metric.samples():
+                if isinstance(child, HistogramChild):
+                    samples.append({"labels": labels, "count": child.count, "sum": child.sum,
+                                    **{f"p{int(q * 100)}": child.quantile(q) for q in (0.5, 0.9, 0.99)}})
+                else:
+                    value = child.get() if isinstance(child, GaugeChild) else child.value
+                    samples.append({"labels": labels, "value": value})
+            metrics[metric.name] = {"type": metric.kind, "help": metric.documentation, "samples": samples}
+        return {"timestamp": time.time(), "uptime_seconds": time.time() - self.created_at, "metrics": metrics}
+
+
+REGISTRY = MetricsRegistry()
+
+# 限流器 利用率 = rate(limiter_tokens_taken_total[1m]) * 60 / limiter_limit_per_minute
+LIMITER_WAIT_SECONDS = REGISTRY.histogram("limiter_wait_seconds", "Time spent waiting for limiter tokens",
+                                          ("limiter",))
+LIMITER_TOKENS_TAKEN = REGISTRY.counter("limiter_tokens_taken_total", "Tokens taken from limiters", ("limiter",))
+LIMITER_LIMIT = REGISTRY.gauge("limiter_limit_per_minute", "Configured limit of all live limiters per minute",
+                               ("limiter",))
+# 请求
+REQUEST_SECONDS = REGISTRY.histogram("request_seconds", "Backend call latency after acquiring limiters",
+                                     ("model",))
+REQUEST_RETRIES = REGISTRY.counter("request_retries_total", "Retried requests", ("rate_limited",))
+TOKENS_CONSUMED = REGISTRY.counter("tokens_consumed_total", "Tokens consumed by successful requests", ("kind",))
+FILES_PROCESSED = REGISTRY.counter("files_processed_total", "Processed files", ("outcome",))
+# 流水线
+QUEUE_DEPTH = REGISTRY.gauge("dispatch_queue_depth", "Files read and waiting for a worker")
+PARSE_SECONDS = REGISTRY.histogram("parse_seconds", "Time spent parsing one response", ("mode",))
+SQL_WRITE_SECONDS = REGISTRY.histogram("sql_write_seconds", "Time spent writing and committing one batch")
+SQL_ROWS_WRITTEN = REGISTRY.counter("sql_rows_written_total", "Rows written to the database")
+
+
+class MetricsServer:
+    """
+    在本地端口上以Prometheus的文本格式提供 GET /metrics 其他路径返回JSON快照
+    """
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, host: str = "127.0.0.1", port: int = 9464):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server: asyncio.AbstractServer | None = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logging.getLogger("InfoExtract").info(f"metrics at http://{self.host}:{self.port}/metrics")
+        return self
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while await reader.readline() not in (b'\r\n', b'\n', b''):  # 忽略请求头
+                pass
+            path = request_line.decode().split(' ')[1] if request_line.count(b' ') >= 2 else '/'
+            if path.split('?')[0] == '/metrics':
+                body, content_type = self.registry.render().encode(), "text/plain; version=0.0.4; charset=utf-8"
+            else:
+                body, content_type = json.dumps(self.registry.snapshot()).encode(), "application/json"
+            writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class SnapshotWriter:
+    """
+    每隔interval秒将JSON快照写入文件 先写临时文件再替换 读取方不会读到写了一半的文件
+    """
+
+    def __init__(self, path: Path, interval: float = 10.0, registry: MetricsRegistry = REGISTRY):
+        if isinstance(path, str):
+            path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.task: asyncio.Task | None = None
+
+    def write(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.registry.snapshot(), ensure_ascii=False, indent=1), encoding='utf-8')
+        os.replace(tmp_path, self.path)
+
+    def start(self):
+        async def write_periodically():
+            while True:
+                await asyncio.sleep(self.interval)
+                self.write()
+
+        self.task = asyncio.create_task(write_periodically())
+
+    def close(self):
+        # 任务结束时写入最后一次快照
+        if self.task is not None:
+            self.task.cancel()
+        self.write()
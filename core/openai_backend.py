@@ -2,9 +2,12 @@ from openai import AsyncOpenAI
 
 from .config import OPENAI_DEEPSEEK_API_KEY, OPENAI_DEEPSEEK_BASE_URL
 from .custom_semaphore import TimedReqsSemaphore, FlowSemaphore
-from .extract_helper import ExtractResult, _is_got_json_str
+from .extract_helper import ExtractResult, _is_got_json_str, build_prompt, cached_prompt_tokens
+from .json_stream import StreamCollector, salvage_result
+from .metrics import REQUEST_SECONDS
+from .retry import RetryableError, failure_from_exception
 
-client = AsyncOpenAI(api_key=OPENAI_DEEPSEEK_API_KEY, base_url=OPENAI_DEEPSEEK_BASE_URL)
+default_client = AsyncOpenAI(api_key=OPENAI_DEEPSEEK_API_KEY, base_url=OPENAI_DEEPSEEK_BASE_URL)
 
 
 async def openai_extraction(file_name: str,
@@ -14,30 +17,69 @@ async def openai_extraction(file_name: str,
                             instant_sem: TimedReqsSemaphore,  # 瞬时并发数上限
                             extract_model: str,
                             extract_prompt: str,
-                            post_check_func: callable  # 后处理函数
+                            post_check_func: callable,  # 后处理函数
+                            stream: bool = False,  # 是否流式输出 每个实例完整时立即交给写入器
+                            client: AsyncOpenAI | None = None  # 客户端池分配的客户端 为None时使用默认客户端
                             ) -> ExtractResult:
-    async with (timed_reqs_sem, flow_sem, instant_sem):
+    client = client or default_client
+    # 指令与字段格式放在不变的system消息中 文章放在user消息中 使请求的前缀可以命中DeepSeek的上下文缓存
+    prompt = build_prompt(extract_prompt, file_content)
+    flow_reservation = flow_sem.reserve(prompt.text)
+    request_timer = REQUEST_SECONDS.labels(model=extract_model).time()
+    # 计时器最后进入 只统计获得令牌之后的耗时
+    async with (timed_reqs_sem, flow_reservation, instant_sem, request_timer):
         try:
-            response = await client.chat.completions.create(
-                model=extract_model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant"},
-                    {"role": "user", "content": extract_prompt.format(article=file_content)}
-                ],
-                stream=False
-            )
-            tokens_consumed = response.usage.total_tokens
-            await flow_sem.flow(tokens_consumed)
-            output_text = response.choices[0].message.content
-            if _is_got_json_str(output_text) and post_check_func(output_text):
+            messages = prompt.messages()
+            streamed = False
+            if stream:
+                collector = StreamCollector()
+                try:
+                    output_text, usage = await _stream_completion(client, extract_model, messages, collector)
+                except Exception as e:
+                    if not collector.salvageable:
+                        raise
+                    return salvage_result(file_name, prompt.text, collector, e)
+                streamed = collector.salvageable
+            else:
+                response = await client.chat.completions.create(
+                    model=extract_model,
+                    messages=messages,
+                    stream=False
+                )
+                output_text, usage = response.choices[0].message.content, response.usage
+            tokens_consumed = usage.total_tokens
+            cached_tokens = cached_prompt_tokens(usage)
+            await flow_reservation.flow(usage.prompt_tokens, usage.completion_tokens, cached_tokens)
+            # 已经流式写入的实例无法撤回 即使后处理检查失败也视为请求成功
+            if (_is_got_json_str(output_text) and post_check_func(output_text)) or streamed:
                 return ExtractResult(file_name=file_name,
                                      json_str=output_text,
-                                     tokens_consumed=tokens_consumed)
+                                     tokens_consumed=tokens_consumed,
+                                     cached_tokens=cached_tokens)
             else:
                 return ExtractResult(request_success=False,
                                      file_name=file_name,
                                      file_content=file_content,
                                      fail_message="Not got a json str or post check failed")
         except Exception as e:  # 对于键盘中断 Exception捕获不到 会向外抛出
-            # 得记录下是哪个文件发生了不可继续的异常
-            raise RuntimeError(file_name, *e.args)
+            # 限流 超时等异常交给重试层 鉴权失败等异常终止任务
+            return failure_from_exception(e, file_name, file_content)
+
+
+async def _stream_completion(client: AsyncOpenAI, extract_model: str, messages: list[dict],
+                             collector: StreamCollector):
+    response = await client.chat.completions.create(
+        model=extract_model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True}  # 最后一个分片带有token用量
+    )
+    usage = None
+    async for chunk in response:
+        if chunk.usage is not None:
+            usage = chunk.usage
+        if chunk.choices and (delta := chunk.choices[0].delta.content):
+            await collector.feed(delta)
+    if usage is None:
+        raise RetryableError("stream ended without usage")
+    return collector.text, usage
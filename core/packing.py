@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import re
+from typing import Callable, Awaitable
+
+from .chat_bot_limit import RequestLimit
+from .extract_helper import ExtractResult, estimate_tokens, _is_got_json_str
+from .json_repair import repair_json_locally
+from .json_stream import stream_sink
+
+PACK_LINGER = 0.5  # 打包未满时 第一篇文章最多等待的秒数
+DOC_ID_PATTERN = re.compile(r'\d+')
+
+
+def pack_token_budget(limit: RequestLimit, packed_prompt: str) -> int:
+    """
+    一个打包请求中所有文章最多可以有多少token
+    回复随文章数量增长 为回复预留一半的上下文 再乘上安全系数 以抵消token估计的误差
+    """
+    budget = (limit.max_len_context - estimate_tokens(packed_prompt)) // 2
+    return max(int(budget * 0.9), 256)
+
+
+def pack_articles(articles: list[str]) -> str:
+    # 文档编号从1开始 比文件路径短得多 也不会泄露路径
+    return ''.join(f"=== Document {i} ===\n{article}\n" for i, article in enumerate(articles, 1))
+
+
+def split_packed_reply(json_str: str, n_docs: int, one_to_many: bool) -> dict[int, str]:
+    """
+    将以文档编号为键的回复拆分为各文档的json_str
+    回复被截断而经本地修复时 最后一个文档的结果可能不完整 将其丢弃
+    :return: 文档编号(从1开始) -> json_str 缺失的文档不在其中
+    """
+    try:
+        reply = json.loads(json_str[json_str.index('{'):json_str.rindex('}') + 1])
+        repaired = False
+    except ValueError:
+        if (text := repair_json_locally(json_str)) is None:
+            return {}
+        reply = json.loads(text)
+        repaired = True
+    if not isinstance(reply, dict):
+        return {}
+
+    ret = {}
+    for key, value in reply.items():
+        if (match := DOC_ID_PATTERN.search(str(key))) is None:
+            continue
+        doc_id = int(match[0])
+        if not 1 <= doc_id <= n_docs:
+            continue
+        if one_to_many and isinstance(value, dict):
+            value = [value]
+        elif not one_to_many and isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        if value is None or (not one_to_many and not isinstance(value, dict)):
+            continue
+        ret[doc_id] = json.dumps(value, ensure_ascii=False)
+    if repaired and ret:
+        del ret[list(ret)[-1]]
+    return ret
+
+
+class RequestPacker:
+    """
+    将多篇短文章打包进一个请求 以文档编号为键的回复再拆分回各文件的ExtractResult
+    节省每个请求都要重复的提示词模板 也只占用一个RPM令牌 适合RPM很低的模型
+    并发的worker各自提交文章 打包满(文章数或token预算)或等待超过PACK_LINGER秒时发出请求
+    超过max_article_tokens的文章 打包请求失败的文章 回复中缺失的文章 都交给single_func单独提取
+    """
+
+    def __init__(self,
+                 single_func: Callable[[str, str], Awaitable[ExtractResult]],
+                 packed_func: Callable[[str, str], Awaitable[ExtractResult]],
+                 max_tokens: int,
+                 max_docs: int,
+                 max_article_tokens: int,
+                 one_to_many: bool,
+                 post_check_func: Callable[[str], bool]):
+        """
+        :param single_func: 单篇文章的提取函数
+        :param packed_func: 使用打包模板的提取函数 不做后处理检查
+        :param max_tokens: 一个打包请求中所有文章的token上限
+        :param max_docs: 一个打包请求中的文章数上限
+        :param max_article_tokens: 只打包不超过这么多token的文章
+        :param post_check_func: 对拆分后各文章的回复做后处理检查
+        """
+        self.single_func = single_func
+        self.packed_func = packed_func
+        self.max_tokens = max_tokens
+        self.max_docs = max_docs
+        self.max_article_tokens = min(max_article_tokens, max_tokens)
+        self.one_to_many = one_to_many
+        self.post_check_func = post_check_func
+        self.pending: list[tuple[str, str, asyncio.Future]] = []
+        self.pending_tokens = 0
+        self.linger_handle: asyncio.TimerHandle | None = None
+        self.tasks: set[asyncio.Task] = set()
+        self.packed_cnt = 0  # 打包请求的数量
+        self.packed_docs_cnt = 0  # 通过打包请求得到结果的文章数
+        self.fallback_cnt = 0  # 打包后又单独提取的文章数
+        self.logger = logging.getLogger("InfoExtract")
+
+    async def __call__(self, file_name: str, file_content: str) -> ExtractResult:
+        tokens = estimate_tokens(file_content)
+        if self.max_docs < 2 or tokens > self.max_article_tokens:
+            return await self.single_func(file_name, file_content)
+
+        if self.pending and self.pending_tokens + tokens > self.max_tokens:
+            self._flush()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((file_name, file_content, future))
+        self.pending_tokens += tokens
+        if len(self.pending) >= self.max_docs:
+            self._flush()
+        elif len(self.pending) == 1:
+            self.linger_handle = asyncio.get_running_loop().call_later(PACK_LINGER, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.linger_handle is not None:
+            self.linger_handle.cancel()
+            self.linger_handle = None
+        if not self.pending:
+            return
+        pack, self.pending, self.pending_tokens = self.pending, [], 0
+        task = asyncio.create_task(self._run(pack))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, pack: list[tuple[str, str, asyncio.Future]]):
+        try:
+            results = await self._extract(pack)
+        except BaseException as e:  # 鉴权失败等致命错误 以及取消 传递给每个等待的worker
+            for _, _, future in pack:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for (_, _, future), result in zip(pack, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _extract(self, pack: list[tuple[str, str, asyncio.Future]]) -> list[ExtractResult]:
+        # 打包的回复包含多篇文章的实例 不能流式写入某一篇文章
+        stream_sink.set(None)
+        if len(pack) == 1:
+            return [await self.single_func(pack[0][0], pack[0][1])]
+
+        file_names = [e[0] for e in pack]
+        pack_name = f"{file_names[0]} (+{len(pack) - 1} packed)"
+        ret = await self.packed_func(pack_name, pack_articles([e[1] for e in pack]))
+        self.packed_cnt += 1
+        json_strs = split_packed_reply(ret.json_str, len(pack), self.one_to_many) if ret.request_success else {}
+        if not ret.request_success:
+            self.logger.warning(f"file_name={pack_name},packed request failed,"
+                                f"extract one by one,message={ret.fail_message}")
+
+        results: list[ExtractResult | None] = [None] * len(pack)
+        tokens_consumed = ret.tokens_consumed // max(len(json_strs), 1)
+        cached_tokens = ret.cached_tokens // max(len(json_strs), 1)
+        for doc_id, json_str in json_strs.items():
+            file_name, file_content, _ = pack[doc_id - 1]
+            if _is_got_json_str(json_str) and self.post_check_func(json_str):
+                results[doc_id - 1] = ExtractResult(file_name=file_name, json_str=json_str,
+                                                    tokens_consumed=tokens_consumed,
+                                                    cached_tokens=cached_tokens)
+            else:
+                results[doc_id - 1] = ExtractResult(request_success=False, file_name=file_name,
+                                                    file_content=file_content,
+                                                    fail_message="Not got a json str or post check failed")
+        self.packed_docs_cnt += len(json_strs)
+
+        missing = [i for i, e in enumerate(results) if e is None]
+        if missing:
+            if ret.request_success:
+                self.logger.info(f"file_name={pack_name},{len(missing)}/{len(pack)} documents missing "
+                                 f"in packed reply, extract one by one")
+            self.fallback_cnt += len(missing)
+            singles = await asyncio.gather(*[self.single_func(pack[i][0], pack[i][1]) for i in missing])
+            for i, e in zip(missing, singles):
+                results[i] = e
+        return results
+
+    def __repr__(self):
+        return (f"RequestPacker(max_tokens={self.max_tokens},max_docs={self.max_docs},"
+                f"max_article_tokens={self.max_article_tokens},packed_requests={self.packed_cnt},"
+                f"packed_docs={self.packed_docs_cnt},fallback={self.fallback_cnt})")
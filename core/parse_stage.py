@@ -0,0 +1,151 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Union, Type, Literal
+
+from .checked import Checked, CheckMixin
+from .chunking import merge_objects
+from .json_repair import is_json_syntax_error, repair_json_locally
+from .metrics import PARSE_SECONDS
+from .sql_helper import BatchWriter
+
+ParseMode = Literal['inline', 'thread', 'process']
+
+
+@dataclass
+class ParsedResponse:
+    objects: list = field(default_factory=list)
+    rows: list[tuple] = field(default_factory=list)  # 可以直接批量写入数据库的行 最后一列为file_path
+    warnings: list[str] = field(default_factory=list)  # 缺失或多余字段的警告 由主进程记录日志
+    repaired_locally: bool = False
+    merged_from: int = 0  # 由多少个分块的结果合并而来 0表示没有合并
+    error: Exception | None = None
+    syntax_error_index: int = -1  # 第几个回复存在本地无法修复的JSON语法错误 -1表示没有
+
+
+def _parse_one(data_type, json_str: str, one_to_many: bool) -> tuple[list, bool]:
+    try:
+        return list(data_type.parse_json(json_str, one_to_many)), False
+    except Exception as e:
+        if not is_json_syntax_error(e):
+            raise
+        error = e
+
+    if (repaired := repair_json_locally(json_str, one_to_many)) is not None:
+        try:
+            return list(data_type.parse_json(repaired, one_to_many)), True
+        except Exception as e:
+            if not is_json_syntax_error(e):
+                raise
+    raise error
+
+
+def parse_response(data_type: Union[Type[Checked], Type[CheckMixin]],
+                   file_name: str,
+                   json_strs: list[str],
+                   one_to_many: bool,
+                   primary_key: str | None) -> ParsedResponse:
+    """
+    解析一篇文章的回复(分块提取时为多个回复) 合并各分块的实例 并转为数据库的行
+    纯CPU计算 不依赖事件循环 可以在线程池或进程池中执行
+    出错时保留出错之前已解析的实例 与原先的行为一致
+    """
+    ret = ParsedResponse()
+    for idx, json_str in enumerate(json_strs):
+        try:
+            parsed, repaired = _parse_one(data_type, json_str, one_to_many)
+        except Exception as e:
+            ret.error = e
+            if is_json_syntax_error(e):
+                ret.syntax_error_index = idx
+            break
+        ret.repaired_locally |= repaired
+        for i, (obj, missing_keys, extra_keys) in enumerate(parsed):
+            if missing_keys or extra_keys:
+                ret.warnings.append(f"obj={i},missing_keys={missing_keys},extra_keys={extra_keys}")
+            ret.objects.append(obj)
+    if len(json_strs) > 1:
+        ret.objects = merge_objects(data_type, ret.objects, primary_key, one_to_many)
+        ret.merged_from = len(json_strs)
+    ret.rows = [(*obj.sql_adapter(), file_name) for obj in ret.objects]
+    return ret
+
+
+class StreamedObjects:
+    """
+    流式模式下一篇文章的stream_sink 每个完整的数组元素到达时立即解析并交给写入器
+    某个元素解析失败后 不再写入后续元素 与整体解析时出错即停止的行为一致
+    """
+
+    def __init__(self, data_type: Union[Type[Checked], Type[CheckMixin]], file_name: str, sql_writer: BatchWriter):
+        self.data_type = data_type
+        self.file_name = file_name
+        self.sql_writer = sql_writer
+        self.objects = []
+        self.warnings: list[str] = []
+        self.error: Exception | None = None
+        self.element_cnt = 0
+
+    async def __call__(self, element: str) -> int:
+        self.element_cnt += 1
+        if self.error is not None:
+            return 0
+        try:
+            parsed, _ = _parse_one(self.data_type, element, False)
+        except Exception as e:
+            self.error = e
+            return 0
+        for obj, missing_keys, extra_keys in parsed:
+            if missing_keys or extra_keys:
+                self.warnings.append(f"obj={len(self.objects)},missing_keys={missing_keys},extra_keys={extra_keys}")
+            self.objects.append(obj)
+            await self.sql_writer.add_rows([(*obj.sql_adapter(), self.file_name)])
+        return len(parsed)
+
+    def parsed_response(self) -> ParsedResponse:
+        # 实例已经写入数据库 rows为空
+        return ParsedResponse(objects=self.objects, warnings=self.warnings, error=self.error)
+
+
+class ParseStage:
+    """
+    解析阶段 将解析 校验 转换为数据库行的CPU工作移出事件循环 使其与网络请求重叠
+    inline: 在事件循环中直接解析 与原先的行为一致
+    thread: 在线程池中解析 事件循环保持响应 但受GIL限制
+    process: 在进程池中解析 数据类必须定义在可导入的模块中(Windows下入口脚本需有if __name__ == '__main__'保护)
+    同时提交到执行器的解析任务不超过max_workers的两倍 其余worker在此等待 不再发起新的请求 形成背压
+    """
+
+    def __init__(self, mode: ParseMode = 'thread', max_workers: int | None = None):
+        self.mode = mode
+        self.executor: Executor | None
+        if mode == 'inline':
+            self.executor = None
+        elif mode == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="parse")
+        elif mode == 'process':
+            self.executor = ProcessPoolExecutor(max_workers)
+        else:
+            raise ValueError(f"unknown parse mode {mode!r}")
+        self.max_workers = self.executor._max_workers if self.executor is not None else 1
+        self.semaphore = asyncio.Semaphore(self.max_workers * 2)
+        self.parse_seconds = PARSE_SECONDS.labels(mode=mode)
+
+    async def parse(self, data_type: Union[Type[Checked], Type[CheckMixin]],
+                    file_name: str,
+                    json_strs: list[str],
+                    one_to_many: bool,
+                    primary_key: str | None) -> ParsedResponse:
+        if self.executor is None:
+            with self.parse_seconds.time():
+                return parse_response(data_type, file_name, json_strs, one_to_many, primary_key)
+        async with self.semaphore, self.parse_seconds.time():
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, parse_response, data_type, file_name, json_strs, one_to_many, primary_key)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+    def __repr__(self):
+        return f"ParseStage(mode={self.mode!r},max_workers={self.max_workers})"
@@ -1,14 +1,18 @@
+import asyncio
+import hashlib
 import logging
+import os
 import pickle
 from pathlib import Path
 from concurrent import futures
-from typing import NamedTuple, List
+from typing import NamedTuple, Iterable, AsyncIterable, AsyncIterator
 import re
 
 import PyPDF2
-from .logger import init_logging
 from .task_config import TaskConfig
 
+REVERSED_REF_PATTERN = re.compile(r'secnerefer', re.IGNORECASE)  # 'references'的逆序
+
 
 class PDF2TXTResult(NamedTuple):
     path: str  # 文件名
@@ -17,62 +21,164 @@ class PDF2TXTResult(NamedTuple):
     ref_txt: str  # 对于论文 此部分为References后的内容
 
 
+class PDF2TXTFile(NamedTuple):
+    """
+    子进程返回的解析结果 正文与参考文献写在文件中 只跨进程传递路径 避免大文本的序列化
+    """
+    path: str  # 文件名
+    first_page_txt: str
+    txt_path: str  # 正文所在的文件
+    ref_txt_path: str  # 参考文献所在的文件
+    txt_len: int
+    ref_len: int
+    page_cnt: int  # 实际解析的页数
+
+    def load(self) -> PDF2TXTResult:
+        return PDF2TXTResult(self.path, self.first_page_txt,
+                             Path(self.txt_path).read_text(encoding='utf-8'),
+                             Path(self.ref_txt_path).read_text(encoding='utf-8'))
+
+
 def split_ref(text: str) -> tuple[str, str]:
     # 从txt中文本中不区分大小写地搜索References 找到最后一个出现的位置
-    pattern = re.compile(r'references', re.IGNORECASE)
-    matches = list(pattern.finditer(text))
-    if not matches:
-        pattern = re.compile(r"\[1]")
-        matches = list(pattern.finditer(text))
-    if matches:
-        start_index = matches[-1].start()
+    # 在逆序的文本上搜索 第一个匹配即为原文中最后一次出现的位置 不必遍历所有匹配
+    match = REVERSED_REF_PATTERN.search(text[::-1])
+    if match is not None:
+        start_index = len(text) - match.end()
     else:
+        start_index = text.rfind("[1]")
+    if start_index == -1:
         return text, ""
     return text[:start_index], text[start_index:]
 
 
-def worker(pdf_file_path: Path):
+def extract_pdf_text(pdf_file_path: Path, max_pages: int | None = None) -> tuple[str, str, int]:
+    """
+    :param max_pages: 最多解析的页数 为None时解析全部
+    :return: 全文 第一页 解析的页数
+    """
+    with open(pdf_file_path, 'rb') as read_file:
+        pdf_reader = PyPDF2.PdfReader(read_file)
+        pages = pdf_reader.pages
+        page_cnt = len(pages) if max_pages is None else min(len(pages), max_pages)
+        # 先收集每页的文本再一次性拼接 避免循环中 += 造成的平方复杂度
+        parts = [pages[page_num].extract_text() or '' for page_num in range(page_cnt)]
+    return ''.join(parts), parts[0] if parts else '', page_cnt
+
+
+def worker(pdf_file_path: Path, text_dir: Path, max_pages: int | None = None) -> PDF2TXTFile:
     # noinspection PyBroadException
     try:
-        with open(pdf_file_path, 'rb') as read_file:
-            pdf_reader = PyPDF2.PdfReader(read_file)
-            text = ''
-            first_page_txt = ''
-            for page_num in range(len(pdf_reader.pages)):
-                text += pdf_reader.pages[page_num].extract_text()
-                if page_num == 0:
-                    first_page_txt = text
-
-            # 存储提取到的正文与参考文献页
-            txt_without_ref, ref_txt = split_ref(text)
-            return PDF2TXTResult(pdf_file_path.as_posix(), first_page_txt, txt_without_ref, ref_txt)
+        text, first_page_txt, page_cnt = extract_pdf_text(pdf_file_path, max_pages)
+        # 存储提取到的正文与参考文献页
+        txt_without_ref, ref_txt = split_ref(text)
+        stem = hashlib.sha1(pdf_file_path.as_posix().encode('utf-8')).hexdigest()
+        txt_path = text_dir / f"{stem}.txt"
+        ref_txt_path = text_dir / f"{stem}.ref.txt"
+        txt_path.write_text(txt_without_ref, encoding='utf-8')
+        ref_txt_path.write_text(ref_txt, encoding='utf-8')
+        return PDF2TXTFile(pdf_file_path.as_posix(), first_page_txt, txt_path.as_posix(), ref_txt_path.as_posix(),
+                           len(txt_without_ref), len(ref_txt), page_cnt)
     except Exception as e:
         raise RuntimeError(pdf_file_path.as_posix(), repr(e))
 
 
-def parse_pdf(config: TaskConfig) -> list[PDF2TXTResult]:
+PDF_CACHE_CHECKPOINT_EVERY = 100  # 每新解析这么多个PDF 保存一次缓存
+
+
+def load_pdf_cache(cache_path: Path) -> dict[str, tuple[int, int, int | None, PDF2TXTFile]]:
+    """
+    读取pdf2txt.pkl 键为PDF路径 值为(mtime_ns, size, max_pages, 解析结果)
+    旧版本保存的结果无法判断文件是否修改过或不含文本文件的位置 直接忽略
+    """
+    if not cache_path.exists():
+        return {}
+    # noinspection PyBroadException
+    try:
+        with open(cache_path, 'rb') as file:
+            cache = pickle.load(file)
+    except Exception:
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return {k: v for k, v in cache.items() if len(v) == 4 and isinstance(v[3], PDF2TXTFile)}
+
+
+def save_pdf_cache(cache_path: Path, cache: dict[str, tuple[int, int, int | None, PDF2TXTFile]]):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix('.tmp')
+    with open(tmp_path, 'wb') as file:
+        pickle.dump(cache, file)
+    tmp_path.replace(cache_path)  # 原子替换 中途崩溃不会损坏已有的缓存
+
+
+async def parse_pdf(config: TaskConfig,
+                    file_paths: Iterable[str] | AsyncIterable[str]) -> AsyncIterator[PDF2TXTResult]:
+    """
+    增量地解析PDF 每解析完一个就产生一个结果 不必等待最慢的PDF
+    以 路径+修改时间+大小 为键缓存在pdf2txt.pkl中 未修改过的PDF不会重复解析
+    :param file_paths: 待解析的PDF路径 通常已经过滤掉了不需要处理的文件
+    """
+    from .async_extract import _aiter_input
     logger = logging.getLogger("InfoExtract")
+    cache_path = config.dataset_output_path / "pdf2txt.pkl"
+    text_dir = config.dataset_output_path / "pdf2txt"
+    text_dir.mkdir(parents=True, exist_ok=True)
+    cache = load_pdf_cache(cache_path)
+    max_workers = os.cpu_count() or 1
+    max_pending = max_workers * 2  # 提交到进程池的任务数上限 避免结果在内存中堆积
+    loop = asyncio.get_running_loop()
+    pending: dict[asyncio.Future, tuple[str, int, int]] = {}
+    new_cnt = 0
+    cached_cnt = 0
+    total_cnt = 0
+
+    def collect(fut: asyncio.Future) -> PDF2TXTResult | None:
+        nonlocal new_cnt
+        path, mtime_ns, size = pending.pop(fut)
+        if fut.exception() is not None:
+            logger.error(f"file_path={fut.exception().args[0]},message={fut.exception().args[1]}")
+            return None
+        ret: PDF2TXTFile = fut.result()
+        logger.info(f"file_path={ret.path},pages={ret.page_cnt},txt_len={ret.txt_len},ref_len={ret.ref_len}")
+        cache[path] = (mtime_ns, size, config.pdf_max_pages, ret)
+        new_cnt += 1
+        if new_cnt % PDF_CACHE_CHECKPOINT_EVERY == 0:
+            save_pdf_cache(cache_path, cache)
+        return ret.load()
+
+    def is_fresh(cached, stat) -> bool:
+        return (cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size
+                and cached[2] == config.pdf_max_pages and Path(cached[3].txt_path).exists())
+
+    executor = futures.ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        async for path in _aiter_input(file_paths):
+            total_cnt += 1
+            stat = Path(path).stat()
+            if is_fresh(cached := cache.get(path), stat):
+                cached_cnt += 1
+                yield cached[3].load()
+                continue
+
+            while len(pending) >= max_pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    if (ret := collect(fut)) is not None:
+                        yield ret
+            fut = loop.run_in_executor(executor, worker, Path(path), text_dir, config.pdf_max_pages)
+            pending[fut] = (path, stat.st_mtime_ns, stat.st_size)
+
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                if (ret := collect(fut)) is not None:
+                    yield ret
 
-    task_list = []
-    result = []
-    with futures.ProcessPoolExecutor(max_workers=8) as executor:
-        for e in config.dataset_input_path.glob("*.pdf"):
-            task_list.append(executor.submit(worker, e))
-
-    if len(task_list) == 0:
-        logger.warning(f"{config.dataset_input_path} is empty dataset!")
-    for e in task_list:
-        if e.exception() is None:
-            ret: PDF2TXTResult = e.result()
-            result.append(ret)
-            logger.info(f"file_path={ret.path},txt_len={len(ret.txt)},ref_len={len(ret.ref_txt)}")
-        else:
-            logger.error(f"file_path={e.exception().args[0]},message={e.exception().args[1]}")
-
-    if not config.dataset_output_path.exists():
-        config.dataset_output_path.mkdir(parents=True, exist_ok=True)
-
-    with open(config.dataset_output_path / "pdf2txt.pkl", 'wb') as file:
-        pickle.dump(result, file)
-
-    return result
+        if total_cnt == 0:
+            logger.warning(f"{config.dataset_input_path} is empty dataset!")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if new_cnt:
+            save_pdf_cache(cache_path, cache)
+        logger.info(f"parse {new_cnt} new pdf, {cached_cnt} pdf loaded from {cache_path}")
@@ -1,15 +1,83 @@
+import json
 from http import HTTPStatus
-from typing import Awaitable
+from typing import Awaitable, AsyncIterator
 
+import aiohttp
 import dashscope
 from dashscope.aigc.generation import AioGeneration
+from dashscope.api_entities.dashscope_response import DashScopeAPIResponse, GenerationResponse
 
 from .custom_semaphore import TimedReqsSemaphore, FlowSemaphore
-from .extract_helper import ExtractResult, _is_got_json_str
+from .extract_helper import ExtractResult, _is_got_json_str, build_prompt, cached_prompt_tokens
+from .json_stream import StreamCollector, salvage_result
+from .metrics import REQUEST_SECONDS
+from .retry import RetryableError, FatalError, failure_from_exception
 from .config import DASHSCOPE_API_KEY
 
 dashscope.api_key = DASHSCOPE_API_KEY
 
+GENERATION_PATH = "/services/aigc/text-generation/generation"
+
+
+class DashScopeClient:
+    """
+    通过共享的aiohttp会话直接调用DashScope的HTTP接口 返回与AioGeneration.call相同的GenerationResponse
+    AioGeneration.call每次调用都新建会话 无法复用连接
+    """
+
+    def __init__(self, api_key: str, session: aiohttp.ClientSession, base_url: str | None = None):
+        self.api_key = api_key
+        self.session = session
+        self.url = (base_url or dashscope.base_http_api_url).rstrip('/') + GENERATION_PATH
+
+    @staticmethod
+    def _to_response(status_code: int, data: dict) -> GenerationResponse:
+        return GenerationResponse.from_api_response(DashScopeAPIResponse(
+            status_code=status_code, request_id=data.get('request_id', ''), code=data.get('code', ''),
+            message=data.get('message', ''), output=data.get('output'), usage=data.get('usage')))
+
+    @staticmethod
+    async def _read_json(response: aiohttp.ClientResponse) -> dict:
+        # 网关等返回的错误可能不是JSON
+        text = await response.text()
+        try:
+            return json.loads(text)
+        except ValueError:
+            return {'code': str(response.status), 'message': text[:200]}
+
+    async def call(self, model: str, prompt: str | None = None, messages: list[dict] | None = None,
+                   result_format: str = 'text', stream: bool = False, incremental_output: bool = False):
+        """
+        与AioGeneration.call的参数一致 prompt与messages二选一
+        """
+        parameters = {"result_format": result_format}
+        if stream:
+            parameters["incremental_output"] = incremental_output
+        body = {"model": model, "input": {"messages": messages} if messages is not None else {"prompt": prompt},
+                "parameters": parameters}
+        headers = {"Authorization": f"Bearer {self.api_key}"}
+        if not stream:
+            async with self.session.post(self.url, json=body, headers=headers) as response:
+                return self._to_response(response.status, await self._read_json(response))
+        headers.update({"X-DashScope-SSE": "enable", "Accept": "text/event-stream"})
+        return self._stream(body, headers)
+
+    async def _stream(self, body: dict, headers: dict) -> AsyncIterator[GenerationResponse]:
+        """
+        解析SSE: 每个事件包含 ":HTTP_STATUS/200" 与 "data:{...}" 两行 出错时状态码为对应的HTTP错误码
+        """
+        async with self.session.post(self.url, json=body, headers=headers) as response:
+            if response.content_type != 'text/event-stream':
+                yield self._to_response(response.status, await self._read_json(response))
+                return
+            status_code = response.status
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8').rstrip('\r\n')
+                if line.startswith(':HTTP_STATUS/'):
+                    status_code = int(line[len(':HTTP_STATUS/'):])
+                elif line.startswith('data:'):
+                    yield self._to_response(status_code, json.loads(line[5:]))
+
 
 async def qwen_extraction(file_name: str,
                           file_content: str,
@@ -18,20 +86,41 @@ async def qwen_extraction(file_name: str,
                           instant_sem: TimedReqsSemaphore,  # 瞬时并发数上限
                           extract_model: str,
                           extract_prompt: str,
-                          post_check_func: callable  # 后处理函数
+                          post_check_func: callable,  # 后处理函数
+                          stream: bool = False,  # 是否流式输出 每个实例完整时立即交给写入器
+                          client: DashScopeClient | None = None  # 客户端池分配的客户端 为None时使用dashscope的SDK
                           ) -> ExtractResult:
-    async with (timed_reqs_sem, flow_sem, instant_sem):
+    generation_call = client.call if client is not None else AioGeneration.call
+    # 指令与字段格式放在不变的system消息中 文章放在user消息中 使请求的前缀可以命中DashScope的上下文缓存
+    prompt = build_prompt(extract_prompt, file_content)
+    flow_reservation = flow_sem.reserve(prompt.text)
+    request_timer = REQUEST_SECONDS.labels(model=extract_model).time()
+    # 计时器最后进入 只统计获得令牌之后的耗时
+    async with (timed_reqs_sem, flow_reservation, instant_sem, request_timer):
         try:
-            response = await AioGeneration.call(extract_model,
-                                                prompt=extract_prompt.format(article=file_content))
+            streamed = False
+            if stream:
+                collector = StreamCollector()
+                try:
+                    response = await _stream_generation(generation_call, extract_model, prompt.messages(), collector)
+                except Exception as e:
+                    if not collector.salvageable:
+                        raise
+                    return salvage_result(file_name, prompt.text, collector, e)
+                streamed = collector.salvageable
+            else:
+                response = await generation_call(extract_model, messages=prompt.messages(), result_format='text')
             if response.status_code == HTTPStatus.OK:
                 tokens_consumed = response.usage.total_tokens
-                await flow_sem.flow(tokens_consumed)
+                cached_tokens = cached_prompt_tokens(response.usage)
+                await flow_reservation.flow(response.usage.input_tokens, response.usage.output_tokens, cached_tokens)
 
-                if _is_got_json_str(response.output.text) and post_check_func(response.output.text):
+                # 已经流式写入的实例无法撤回 即使后处理检查失败也视为请求成功
+                if (_is_got_json_str(response.output.text) and post_check_func(response.output.text)) or streamed:
                     return ExtractResult(file_name=file_name,
                                          json_str=response.output.text,
-                                         tokens_consumed=tokens_consumed)
+                                         tokens_consumed=tokens_consumed,
+                                         cached_tokens=cached_tokens)
                 else:
                     return ExtractResult(request_success=False,
                                          file_name=file_name,
@@ -39,7 +128,7 @@ async def qwen_extraction(file_name: str,
                                          fail_message="Not got a json str or post check failed")
 
             elif response.status_code == HTTPStatus.TOO_MANY_REQUESTS:
-                raise RuntimeError("Too many requests! Check the concurrency limit setting!")
+                raise RetryableError(f"{response.code}: {response.message}", rate_limited=True)
             else:
                 if response.code == 'InvalidParameter' or response.code == 'DataInspectionFailed':
                     # 参数不合法 数据审查错误
@@ -47,10 +136,34 @@ async def qwen_extraction(file_name: str,
                                          file_name=file_name,
                                          file_content=file_content,
                                          fail_message="InvalidParameter or DataInspectionFailed")
+                elif response.code == 'Arrearage' or response.code == 'InvalidApiKey':
+                    # 账户欠费 API Key错误意味着其他并发任务都应该取消
+                    raise FatalError(response.code, response.message)
                 else:
-                    # response.code == 'Arrearage' or response.code == 'RequestTimeOut':
-                    # 账户欠费 网络不通导致超时 触发限流等异常意味着其他并发任务都应该取消
-                    raise RuntimeError(response.code, response.message)
+                    # 网络不通导致超时 服务端错误等 稍后重试
+                    raise RetryableError(f"{response.code}: {response.message}")
         except Exception as e:  # 对于键盘中断 Exception捕获不到 会向外抛出
-            # 得记录下是哪个文件发生了不可继续的异常
-            raise RuntimeError(file_name, *e.args)
+            return failure_from_exception(e, file_name, file_content)
+
+
+async def _stream_generation(generation_call, extract_model: str, messages: list[dict], collector: StreamCollector):
+    """
+    增量输出模式下 每个分片只含新增的文本 token用量为累计值
+    :return: 最后一个分片 其output.text被替换为完整的回复 出错时返回出错的分片
+    """
+    responses = await generation_call(extract_model, messages=messages, result_format='text',
+                                      stream=True, incremental_output=True)
+    last = None
+    async for response in responses:
+        last = response
+        if response.status_code != HTTPStatus.OK:
+            if collector.salvageable:
+                raise RetryableError(f"{response.code}: {response.message}")
+            return response
+        if response.output.text:
+            await collector.feed(response.output.text)
+    if last is None:
+        raise RetryableError("stream ended without any response")
+    if last.status_code == HTTPStatus.OK:
+        last.output.text = collector.text
+    return last
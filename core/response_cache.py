@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Awaitable
+
+from .extract_helper import ExtractResult, _is_got_json_str
+
+
+class ResponseCache:
+    """
+    持久化的大模型回复缓存
+    以 模型名 + 完整提示词的哈希 为键 保存回复的json_str与消耗的token数
+    总大小超过max_bytes时 按最近访问时间淘汰
+    命中时只在内存中记录访问时间 随下一次写入或关闭时一起提交 查询缓存不写数据库
+    异步接口lookup/add与BatchWriter一样在单独的线程中读写 不阻塞事件循环
+    add先缓存在内存中 每batch_size条或每flush_interval秒一起写入并提交 崩溃时至多丢失最后一个批次
+    """
+
+    def __init__(self, path: Path, max_bytes: int = 1 << 30, batch_size=64, flush_interval=5.0):
+        if isinstance(path, str):
+            path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # 只有一个线程 所有读写按顺序执行 先提交的写入一定在之后的查询前完成
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response_cache")
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS ResponseCache("
+                          "key TEXT PRIMARY KEY, model TEXT, json_str TEXT, tokens_consumed INTEGER, "
+                          "size INTEGER, accessed_at REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_ResponseCache_accessed_at ON ResponseCache(accessed_at)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM ResponseCache").fetchone()[0]
+        self.accessed: dict[str, float] = {}  # 命中后尚未写入的访问时间
+        self.buffer: dict[str, tuple[str, str, int]] = {}  # 尚未写入的 键 -> (模型名, json_str, token数)
+        self.pending: list[asyncio.Future] = []
+        self.last_flush = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode('utf-8')).hexdigest()
+
+    def _count(self, hit: tuple[str, int] | None) -> tuple[str, int] | None:
+        if hit is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return hit
+
+    def _get(self, key: str) -> tuple[str, int] | None:
+        row = self.conn.execute("SELECT json_str, tokens_consumed FROM ResponseCache WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.accessed[key] = time.time()
+        return row[0], row[1]
+
+    def get(self, model: str, prompt: str) -> tuple[str, int] | None:
+        return self._count(self._get(self.make_key(model, prompt)))
+
+    async def lookup(self, model: str, prompt: str) -> tuple[str, int] | None:
+        """
+        在写入线程中查询 尚未写入的回复直接从内存中返回
+        """
+        key = self.make_key(model, prompt)
+        if key in self.buffer:
+            _, json_str, tokens_consumed = self.buffer[key]
+            return self._count((json_str, tokens_consumed))
+        return self._count(await asyncio.get_running_loop().run_in_executor(self.executor, self._get, key))
+
+    def flush_accessed(self):
+        accessed, self.accessed = self.accessed, {}
+        self.conn.executemany("UPDATE ResponseCache SET accessed_at=? WHERE key=?",
+                              [(accessed_at, key) for key, accessed_at in accessed.items()])
+
+    def put(self, model: str, prompt: str, json_str: str, tokens_consumed: int):
+        self._write({self.make_key(model, prompt): (model, json_str, tokens_consumed)})
+
+    def add(self, model: str, prompt: str, json_str: str, tokens_consumed: int):
+        self.buffer[self.make_key(model, prompt)] = (model, json_str, tokens_consumed)
+        if len(self.buffer) >= self.batch_size or time.monotonic() - self.last_flush >= self.flush_interval:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        items, self.buffer = self.buffer, {}
+        fut = asyncio.get_running_loop().run_in_executor(self.executor, self._write, items)
+        self.pending.append(fut)
+        fut.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, fut: asyncio.Future):
+        self.pending.remove(fut)
+        if not fut.cancelled() and fut.exception() is not None:
+            # 缓存写入失败不影响提取结果 只记录日志
+            logging.getLogger("InfoExtract").error(f"response cache write failed: {fut.exception()!r}")
+
+    def _write(self, items: dict[str, tuple[str, str, int]]):
+        """
+        一个批次一个事务 同时写入命中的访问时间
+        """
+        now = time.time()
+        for key, (model, json_str, tokens_consumed) in items.items():
+            size = len(json_str.encode('utf-8'))
+            old = self.conn.execute("SELECT size FROM ResponseCache WHERE key=?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO ResponseCache VALUES (?, ?, ?, ?, ?, ?)",
+                              (key, model, json_str, tokens_consumed, size, now))
+            self.total_bytes += size - (old[0] if old else 0)
+        self.flush_accessed()
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        # 淘汰到上限的90% 避免每次写入都触发淘汰
+        target = int(self.max_bytes * 0.9)
+        cur = self.conn.execute("SELECT key, size FROM ResponseCache ORDER BY accessed_at")
+        evicted_keys = []
+        for key, size in cur:
+            if self.total_bytes <= target:
+                break
+            evicted_keys.append((key,))
+            self.total_bytes -= size
+        cur.close()
+        self.conn.executemany("DELETE FROM ResponseCache WHERE key=?", evicted_keys)
+        self.evictions += len(evicted_keys)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0, "total_bytes": self.total_bytes}
+
+    async def flush(self):
+        self._schedule_flush()
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+
+    def close(self):
+        self.executor.shutdown()
+        items, self.buffer = self.buffer, {}
+        self._write(items)
+        self.conn.close()
+
+    async def aclose(self):
+        await self.flush()
+        await asyncio.to_thread(self.close)
+
+    def __repr__(self):
+        return f"ResponseCache(path={self.path},max_bytes={self.max_bytes},stats={self.stats()})"
+
+
+def cached_extraction(extract_func: Callable[[str, str], Awaitable[ExtractResult]],
+                      cache: ResponseCache,
+                      extract_model: str,
+                      extract_prompt: str,
+                      post_check_func: Callable[[str], bool] = lambda _: True
+                      ) -> Callable[[str, str], Awaitable[ExtractResult]]:
+    """
+    为提取函数加上缓存 命中时直接返回 不经过任何限流器
+    只缓存完整的回复: 请求成功 没有失败信息(如中断后保留部分实例的流式回复) 且通过了post_check_func
+    流式回复即使未通过检查也视为请求成功 所以这里再检查一次
+    """
+
+    async def wrapper(file_name: str, file_content: str) -> ExtractResult:
+        prompt = extract_prompt.format(article=file_content)
+        if (hit := await cache.lookup(extract_model, prompt)) is not None:
+            json_str, tokens_consumed = hit
+            return ExtractResult(file_name=file_name, json_str=json_str, tokens_consumed=tokens_consumed,
+                                 from_cache=True)
+        ret = await extract_func(file_name, file_content)
+        if (ret.request_success and not ret.fail_message and _is_got_json_str(ret.json_str)
+                and post_check_func(ret.json_str)):
+            cache.add(extract_model, prompt, ret.json_str, ret.tokens_consumed)
+        return ret
+
+    return wrapper
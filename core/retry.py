@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import random
+import sqlite3
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Callable, Awaitable
+
+from .extract_helper import ExtractResult
+from .metrics import REQUEST_RETRIES
+
+
+class RetryableError(Exception):
+    """
+    暂时性的错误 如限流 超时 网络异常 服务端错误 稍后重试可能成功
+    """
+
+    def __init__(self, message: str, retry_after: float | None = None, rate_limited: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after  # 服务端要求的等待秒数
+        self.rate_limited = rate_limited  # 是否因触发限流而失败
+
+
+class FatalError(Exception):
+    """
+    不可恢复的错误 如鉴权失败 账户欠费 所有请求都会失败 应当终止整个任务
+    """
+
+
+def parse_retry_after(headers) -> float | None:
+    if not headers:
+        return None
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+_transient_exceptions: tuple[type[Exception], ...] | None = None
+
+
+def transient_exceptions() -> tuple[type[Exception], ...]:
+    """
+    连接失败 超时等网络层的异常 各SDK的异常类只在安装了该SDK时加入
+    """
+    global _transient_exceptions
+    if _transient_exceptions is None:
+        import httpx
+        ret = [TimeoutError, asyncio.TimeoutError, ConnectionError, httpx.TransportError]
+        try:
+            import openai
+            ret.append(openai.APIConnectionError)  # 包括APITimeoutError
+        except ImportError:
+            pass
+        try:
+            from zhipuai.core._errors import APIConnectionError
+            ret.append(APIConnectionError)
+        except ImportError:
+            pass
+        try:
+            import aiohttp
+            ret += [aiohttp.ClientConnectionError, aiohttp.ClientPayloadError]
+        except ImportError:
+            pass
+        _transient_exceptions = tuple(ret)
+    return _transient_exceptions
+
+
+def classify_exception(e: Exception) -> Exception | None:
+    """
+    按HTTP状态码对SDK抛出的异常分类 openai与zhipuai的异常都带有status_code与response
+    只有429 408 5xx与已知的连接 超时异常值得重试 其余(包括处理回复时的程序错误)立即使该文件失败
+    :return: RetryableError或FatalError 返回None表示只是这个文件的请求失败(如参数不合法) 重试也没有意义
+    """
+    if isinstance(e, (RetryableError, FatalError)):
+        return e
+    status_code = getattr(e, 'status_code', None)
+    retry_after = parse_retry_after(getattr(getattr(e, 'response', None), 'headers', None))
+    if status_code == 429:
+        return RetryableError(repr(e), retry_after, rate_limited=True)
+    if status_code in (401, 402, 403):  # 鉴权失败 余额不足
+        return FatalError(repr(e))
+    if isinstance(status_code, int) and (status_code == 408 or status_code >= 500):
+        return RetryableError(repr(e), retry_after)
+    if status_code is None and isinstance(e, transient_exceptions()):
+        return RetryableError(repr(e), retry_after)
+    return None
+
+
+def failure_from_exception(e: Exception, file_name: str, file_content: str) -> ExtractResult:
+    """
+    供各后端在捕获异常时调用: 可重试或致命的异常向外抛出 其余转为该文件的失败结果
+    """
+    error = classify_exception(e)
+    if error is None:
+        return ExtractResult(request_success=False, file_name=file_name, file_content=file_content,
+                             fail_message=repr(e))
+    if isinstance(error, FatalError):
+        # 得记录下是哪个文件发生了不可继续的异常
+        raise FatalError(file_name, *error.args) from e
+    raise error from e
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 5  # 包括第一次请求在内的最大尝试次数
+    base_delay: float = 2.0  # 第一次重试前的基准等待秒数 之后指数增长
+    max_delay: float = 60.0  # 等待秒数的上限
+    jitter: float = 0.5  # 随机抖动的比例 避免大量请求同时重试
+
+    def delay(self, attempt: int, retry_after: float | None = None) -> float:
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay * self.jitter)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+
+def retrying_extraction(extract_func: Callable[[str, str], Awaitable[ExtractResult]],
+                        policy: RetryPolicy) -> Callable[[str, str], Awaitable[ExtractResult]]:
+    """
+    为提取函数加上重试 RetryableError按指数退避加随机抖动重试 优先遵循服务端的Retry-After
+    触发限流时暂停该Key的限流器由ClientPool负责
+    超过最大尝试次数后返回失败结果 由调用方写入死信表
+    """
+    logger = logging.getLogger("InfoExtract")
+
+    async def wrapper(file_name: str, file_content: str) -> ExtractResult:
+        error = None
+        for attempt in range(policy.max_attempts):
+            try:
+                return await extract_func(file_name, file_content)
+            except RetryableError as e:
+                error = e
+                if attempt + 1 == policy.max_attempts:
+                    break
+                delay = policy.delay(attempt, e.retry_after)
+                logger.warning(f"file_name={file_name},attempt={attempt + 1},retry in {delay:.1f}s,message={e}")
+                REQUEST_RETRIES.labels(rate_limited=str(e.rate_limited).lower()).inc()
+                await asyncio.sleep(delay)
+        return ExtractResult(request_success=False, file_name=file_name, file_content=file_content,
+                             fail_message=f"gave up after {policy.max_attempts} attempts: {error}")
+
+    return wrapper
+
+
+class DeadLetterQueue:
+    """
+    持久化的死信表 记录最终失败的文件 以便之后只针对它们重新运行
+    文件之后成功处理时会被移出死信表
+    add与remove只在内存中记录 由BatchWriter在写入线程中随批次提交 关闭时提交剩余的部分
+    同一文件在一次运行中多次失败只计一次
+    """
+
+    def __init__(self, uri, table_name: str):
+        self.table_name = table_name
+        # 写入在BatchWriter的线程中进行 与事件循环中的查询不会同时发生
+        self.conn = sqlite3.connect(uri, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS DeadLetter("
+                          "table_name TEXT, file_path TEXT, fail_message TEXT, fail_cnt INTEGER, updated_at REAL, "
+                          "PRIMARY KEY(table_name, file_path))")
+        self.conn.commit()
+        self.known = self.file_paths()  # 表中已有的文件 只有它们需要在成功后移除
+        self.changes: dict[str, str | None] = {}  # 尚未提交的变更 文件路径 -> 失败信息 None为移除
+
+    def add(self, file_path: str, fail_message: str):
+        self.known.add(file_path)
+        self.changes[file_path] = fail_message
+
+    def remove(self, file_path: str):
+        if file_path in self.known:
+            self.known.discard(file_path)
+            self.changes[file_path] = None
+
+    def take_changes(self) -> dict[str, str | None]:
+        changes, self.changes = self.changes, {}
+        return changes
+
+    def write(self, changes: dict[str, str | None]):
+        """
+        在一个事务中提交take_changes取出的变更
+        """
+        now = time.time()
+        with self.conn:
+            self.conn.executemany("INSERT INTO DeadLetter VALUES (?, ?, ?, 1, ?) "
+                                  "ON CONFLICT(table_name, file_path) DO UPDATE SET "
+                                  "fail_message=excluded.fail_message, fail_cnt=fail_cnt+1, "
+                                  "updated_at=excluded.updated_at",
+                                  [(self.table_name, file_path, fail_message, now)
+                                   for file_path, fail_message in changes.items() if fail_message is not None])
+            self.conn.executemany("DELETE FROM DeadLetter WHERE table_name=? AND file_path=?",
+                                  [(self.table_name, file_path)
+                                   for file_path, fail_message in changes.items() if fail_message is None])
+
+    def file_paths(self) -> set[str]:
+        cur = self.conn.execute("SELECT file_path FROM DeadLetter WHERE table_name=?", (self.table_name,))
+        return {e for (e,) in cur}
+
+    def close(self):
+        if self.changes:
+            self.write(self.take_changes())
+        self.conn.close()
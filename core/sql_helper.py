@@ -1,8 +1,14 @@
+import asyncio
+import logging
 import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
-from typing import Union
+from typing import Any, Callable, Union
 
 from .checked import CheckMixin, Checked
+from .metrics import SQL_WRITE_SECONDS, SQL_ROWS_WRITTEN
+from .retry import DeadLetterQueue
 
 SQL_TYPES_MAPPING = {
     int: 'INTEGER',
@@ -22,7 +28,12 @@ class SQLAdapter:
         self.field_types = cls._field_types
         assert len(self.fields) == len(self.field_types)
         self.conn = sqlite3.connect(uri)
+        # WAL模式下读写互不阻塞 批量写入线程与主线程的查询可以并行
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
         self.cls = cls
+        self.insert_sql = (f'INSERT INTO {self.table_name}({",".join(self.fields)}, file_path) '
+                           f'VALUES ({",".join("?" for _ in range(len(self.fields) + 1))})')
         if auto_create:
             self.create_table(primary_key)
 
@@ -31,6 +42,7 @@ class SQLAdapter:
         cur = self.conn.cursor()
         cur.execute(f"SELECT name FROM sqlite_master WHERE type='table' AND name='{self.table_name}'")
         if cur.fetchone() is not None:
+            self.create_file_path_index()
             return
 
         field_type_list = ', '.join(
@@ -42,18 +54,43 @@ class SQLAdapter:
             create_command = f'CREATE TABLE {self.table_name}(id INTEGER PRIMARY KEY AUTOINCREMENT, {field_type_list})'
 
         cur.execute(create_command)
+        self.create_file_path_index()
+
+    def create_file_path_index(self):
+        # 断点续跑时按file_path过滤 没有索引时每次查询都是全表扫描
+        self.conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{self.table_name}_file_path '
+                          f'ON {self.table_name}(file_path)')
         self.conn.commit()
 
-    def add_item(self, file_path, item: Union[CheckMixin, Checked]):
+    def to_row(self, file_path, item: Union[CheckMixin, Checked]) -> tuple:
         if not isinstance(item, self.cls):
             raise ValueError(f"item must be an instance of {self.cls.__name__}")
-        cur = self.conn.cursor()
-        cur.execute(f'INSERT INTO {self.table_name}({",".join(self.fields)}, file_path) VALUES ({",".join("?" for _ in range(len(self.fields) + 1))})',
-                    (*item.sql_adapter(), file_path))
+        return *item.sql_adapter(), file_path
+
+    def add_item(self, file_path, item: Union[CheckMixin, Checked]):
+        self.conn.execute(self.insert_sql, self.to_row(file_path, item))
+
+    def add_rows(self, rows: list[tuple], conn: sqlite3.Connection | None = None):
+        (conn or self.conn).executemany(self.insert_sql, rows)
 
     def commit(self):
         self.conn.commit()
 
+    def fan_out(self, duplicates: list[tuple[str, str]]) -> int:
+        """
+        将代表文件的行复制给各重复文件 已经有行的重复文件不再复制 主键冲突的行被忽略
+        :param duplicates: (重复文件, 代表文件)
+        :return: 复制的行数
+        """
+        fields = ",".join(self.fields)
+        before = self.conn.total_changes
+        self.conn.executemany(f'INSERT OR IGNORE INTO {self.table_name}({fields}, file_path) '
+                              f'SELECT {fields}, ? FROM {self.table_name} WHERE file_path=? '
+                              f'AND NOT EXISTS (SELECT 1 FROM {self.table_name} WHERE file_path=?)',
+                              [(duplicate, representative, duplicate) for duplicate, representative in duplicates])
+        self.conn.commit()
+        return self.conn.total_changes - before
+
     def fetch_all(self):
         # 返回一个产生cls实例的生成器
         cur = self.conn.cursor()
@@ -64,9 +101,164 @@ class SQLAdapter:
 
     def check_exist(self, file_path_value):
         cur = self.conn.cursor()
-        cur.execute(f"SELECT * FROM {self.table_name} WHERE file_path=?", (file_path_value,))
+        cur.execute(f"SELECT 1 FROM {self.table_name} WHERE file_path=? LIMIT 1", (file_path_value,))
         return cur.fetchone() is not None
 
+    def iter_existing_file_paths(self):
+        # 逐行产生表中已有的file_path 走索引扫描 不会一次性取出整个结果集
+        cur = self.conn.cursor()
+        cur.execute(f"SELECT DISTINCT file_path FROM {self.table_name}")
+        for (file_path,) in cur:
+            yield file_path
+
+    def existing_file_paths(self) -> set[str]:
+        """
+        一次查询取出所有已存在的file_path 用于批量过滤 代替逐个文件调用check_exist
+        """
+        return set(self.iter_existing_file_paths())
+
     def __del__(self):
         self.conn.commit()
         self.conn.close()
+
+
+class BatchWriter:
+    """
+    批量写入器
+    行先缓存在内存中 每batch_size行或每flush_interval秒 在单独的线程中用executemany写入并提交
+    写入线程持有自己的连接 不阻塞事件循环 崩溃时至多丢失最后一个批次
+    某行违反约束(如主键冲突)时 批次回滚后按文件逐个重新写入 只有出错的文件写入失败 由on_error通知
+    磁盘已满 数据库被锁等OperationalError无法按文件隔离 在下一次add或flush时抛出
+    设置了dead_letters时 死信表的变更也随每个批次在写入线程中提交
+    """
+
+    def __init__(self, adapter: SQLAdapter, batch_size=500, flush_interval=5.0, max_pending_batches=4):
+        self.adapter = adapter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending_batches = max_pending_batches  # 待写入的批次过多时 add会等待 形成背压
+        self.buffer: list[tuple] = []
+        self.pending: list[asyncio.Future] = []
+        # 只有一个线程 所有写入按顺序执行 连接也只在这个线程中使用
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sql_writer")
+        self.conn = sqlite3.connect(adapter.uri, check_same_thread=False)
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.rows_written = 0
+        self.write_seconds = 0.0
+        self.flusher = None
+        self.error: BaseException | None = None  # 后台写入的异常 在下一次add或flush时抛出
+        self.on_error: Callable[[str, str], Any] | None = None  # 某个文件的行写入失败时 以(文件路径, 错误信息)调用
+        self.dead_letters: DeadLetterQueue | None = None
+
+    def start(self):
+        async def flush_periodically():
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                self._schedule_flush()
+
+        self.flusher = asyncio.create_task(flush_periodically())
+
+    async def add(self, file_path, item: Union[CheckMixin, Checked]):
+        await self.add_rows([self.adapter.to_row(file_path, item)])
+
+    async def add_rows(self, rows: list[tuple]):
+        """
+        添加已经转换好的行 最后一列为file_path
+        """
+        if self.error is not None:
+            raise self.error
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.batch_size:
+            self._schedule_flush()
+        if len(self.pending) > self.max_pending_batches:
+            await self.pending[0]
+
+    def _schedule_flush(self):
+        dead_letter_changes = self.dead_letters.take_changes() if self.dead_letters is not None else {}
+        if not self.buffer and not dead_letter_changes:
+            return
+        rows, self.buffer = self.buffer, []
+        fut = asyncio.get_running_loop().run_in_executor(self.executor, self._write, rows, dead_letter_changes)
+        self.pending.append(fut)
+        fut.add_done_callback(self._on_write_done)
+
+    def _on_write_done(self, fut: asyncio.Future):
+        self.pending.remove(fut)
+        if fut.cancelled():
+            return
+        if fut.exception() is not None:
+            if self.error is None:
+                self.error = fut.exception()
+            return
+        for file_path, message in fut.result():
+            logging.getLogger("InfoExtract").error(f"file_name={file_path},rows not written,message={message}")
+            if self.on_error is not None:
+                self.on_error(file_path, message)
+
+    def _write(self, rows: list[tuple], dead_letter_changes: dict[str, str | None]) -> list[tuple[str, str]]:
+        """
+        :return: 写入失败的 (文件路径, 错误信息)
+        """
+        if dead_letter_changes:
+            self.dead_letters.write(dead_letter_changes)
+        if not rows:
+            return []
+        logger = logging.getLogger("InfoExtract")
+        begin = time.perf_counter()
+        failed = []
+        try:
+            with self.conn:  # 一个批次一个事务 异常时回滚
+                self.adapter.add_rows(rows, self.conn)
+        except sqlite3.OperationalError:
+            raise
+        except sqlite3.Error:
+            rows, failed = self._write_by_file(rows)
+        cost = time.perf_counter() - begin
+        self.rows_written += len(rows)
+        self.write_seconds += cost
+        SQL_WRITE_SECONDS.observe(cost)
+        SQL_ROWS_WRITTEN.inc(len(rows))
+        logger.debug(f"sql writer: {len(rows)} rows committed in {cost:.3f}s, {self.rows_per_sec:.0f} rows/sec")
+        return failed
+
+    def _write_by_file(self, rows: list[tuple]) -> tuple[list[tuple], list[tuple[str, str]]]:
+        """
+        批次中有违反约束的行时 每个文件的行单独一个事务 其他文件的行不受影响
+        :return: 写入成功的行 与 写入失败的 (文件路径, 错误信息)
+        """
+        rows_by_file: dict[str, list[tuple]] = {}
+        for row in rows:
+            rows_by_file.setdefault(row[-1], []).append(row)
+        written, failed = [], []
+        for file_path, file_rows in rows_by_file.items():
+            try:
+                with self.conn:
+                    self.adapter.add_rows(file_rows, self.conn)
+                written.extend(file_rows)
+            except sqlite3.OperationalError:
+                raise
+            except sqlite3.Error as e:
+                failed.append((file_path, repr(e)))
+        return written, failed
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows_written / self.write_seconds if self.write_seconds > 0 else 0.0
+
+    async def flush(self):
+        self._schedule_flush()
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        if self.error is not None:
+            raise self.error
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+        try:
+            await self.flush()
+        finally:
+            self.executor.shutdown()
+            self.conn.close()
+            logging.getLogger("InfoExtract").info(
+                f"sql writer: {self.rows_written} rows written, {self.rows_per_sec:.0f} rows/sec")
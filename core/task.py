@@ -1,18 +1,26 @@
+import asyncio
+import logging
 from functools import partial
-from typing import Union, Type
+from pathlib import Path
+from typing import Union, Type, Iterable, Iterator, Callable, TypeVar, Awaitable, AsyncIterable, AsyncIterator
 
 from .chat_bot_limit import CHAT_MODEL_LIMIT
 from .checked import Checked, CheckMixin
-from .custom_semaphore import TimedReqsSemaphore, FlowSemaphore
-from .logger import init_logging
-from .sql_helper import SQLAdapter
+from .client_pool import ClientPool, create_client_pool
+from .http_transport import HttpTransport
+from .logger import init_logging, shutdown_logging
+from .metrics import MetricsServer, SnapshotWriter
+from .sql_helper import SQLAdapter, BatchWriter
+from .parse_stage import ParseStage
 from .task_config import TaskConfig
 from .config import DATABASE_URI
+from .extract_helper import ExtractResult
 from .async_extract import parse_for_any_type
+from .retry import retrying_extraction, RetryPolicy, DeadLetterQueue
 
 
-def get_extract_prompt_template(config: TaskConfig, cls):
-    with open(config.extract_prompt_template_path, 'r', encoding='utf-8') as file:
+def get_extract_prompt_template(config: TaskConfig, cls, template_path: Path | None = None):
+    with open(template_path or config.extract_prompt_template_path, 'r', encoding='utf-8') as file:
         prompt_template = file.read()
     prompt_template = prompt_template.format(
         dataset_theme=config.dataset_theme,
@@ -22,13 +30,75 @@ def get_extract_prompt_template(config: TaskConfig, cls):
     return prompt_template
 
 
-def load_dir_txt(config: TaskConfig) -> list[tuple[str, str]]:
+T = TypeVar('T')
+
+
+def iter_dir_files(config: TaskConfig, suffix: str) -> Iterator[str]:
     """
-    读取目录下的所有txt文件
+    惰性地遍历目录下指定后缀的文件 只产生路径 不读取内容
     :param config: 任务配置
-    :return: 无后缀文件名 与 文件内容
+    :param suffix: 文件后缀 如txt
+    :return: 文件全路径的字符串
+    """
+    return (e.as_posix() for e in config.dataset_input_path.glob(f"*.{suffix}"))
+
+
+def load_dir_txt(file_paths: Iterable[str]) -> Iterator[tuple[str, str]]:
+    """
+    按需读取txt文件 只有调度器取到该文件时才会读入内容
+    :param file_paths: 文件路径
+    :return: 文件路径 与 文件内容
+    """
+    for file_path in file_paths:
+        yield file_path, Path(file_path).read_text(encoding='utf-8')
+
+
+async def aload_dir_txt(file_paths: AsyncIterable[str]) -> AsyncIterator[tuple[str, str]]:
+    """
+    load_dir_txt的异步版本 用于从工作队列租用的文件路径
     """
-    return [(e.as_posix(), e.read_text(encoding='utf-8')) for e in config.dataset_input_path.glob("*.txt")]
+    async for file_path in file_paths:
+        yield file_path, Path(file_path).read_text(encoding='utf-8')
+
+
+def filter_lazily(items: Iterable[T], predicate: Callable[[T], bool], reason: str) -> Iterator[T]:
+    """
+    惰性过滤 迭代结束后记录被过滤掉的数量
+    """
+    logger = logging.getLogger("InfoExtract")
+    filtered_cnt = 0
+    for item in items:
+        if predicate(item):
+            yield item
+        else:
+            filtered_cnt += 1
+    if filtered_cnt:
+        logger.info(f"filter out {filtered_cnt} existing data in {reason}")
+
+
+def create_extract_func(model: str, prompt_template: str, post_check_func: Callable[[str], bool],
+                        pool: ClientPool,
+                        stream: bool = False) -> Callable[[str, str], Awaitable[ExtractResult]]:
+    """
+    根据模型名称选择后端 返回 (file_name, file_content) -> ExtractResult 的提取函数
+    每个请求由客户端池分配API Key及其限流器
+    :param stream: 是否流式输出 glm后端为异步任务接口 不支持流式
+    """
+    if model.startswith("qwen"):
+        from .qwen_backend import qwen_extraction
+        backend = partial(qwen_extraction, extract_model=model, extract_prompt=prompt_template,
+                          post_check_func=post_check_func, stream=stream)
+    elif model.startswith("glm"):
+        from .glm_backend import glm_extraction
+        backend = partial(glm_extraction, extract_model=model, extract_prompt=prompt_template,
+                          post_check_func=post_check_func)
+    elif model.startswith("deepseek"):
+        from .openai_backend import openai_extraction
+        backend = partial(openai_extraction, extract_model=model, extract_prompt=prompt_template,
+                          post_check_func=post_check_func, stream=stream)
+    else:
+        raise ValueError(f"unsupported model {model}")
+    return pool.extraction(backend)
 
 
 async def build_task(config: TaskConfig, cls: Union[Type[Checked], Type[CheckMixin]]):
@@ -39,78 +109,204 @@ async def build_task(config: TaskConfig, cls: Union[Type[Checked], Type[CheckMix
         print("Warning: one_article_to_many_instance and filter_by_file_path are both True, "
               "this may cause some data to be lost")
 
-    logger = init_logging(config.log_dir_path / f'{config.dataset_name}.log')
+    # 分片执行时每个worker写自己的日志文件 多个进程轮转同一个文件并不安全
+    log_name = config.dataset_name if config.worker_id is None else f"{config.dataset_name}.{config.worker_id}"
+    logger = init_logging(config.log_dir_path / f'{log_name}.log', config.log_json_lines,
+                          config.log_max_bytes, config.log_backup_count, config.log_warning_limit)
 
     logger.info(f"extract {cls.__name__} data")
     logger.debug(f"config is {config}")
 
+    metrics_server = None
+    if config.metrics_port is not None:
+        metrics_server = await MetricsServer(port=config.metrics_port).start()
+    snapshot_writer = None
+    if config.metrics_snapshot_path is not None:
+        snapshot_writer = SnapshotWriter(config.metrics_snapshot_path, config.metrics_snapshot_interval)
+        snapshot_writer.start()
+
     prompt_template = get_extract_prompt_template(config, cls)
     logger.debug(f"prompt_template is {prompt_template}")
 
-    timed_reqs_sem = TimedReqsSemaphore(CHAT_MODEL_LIMIT[config.model].max_reqs_per_min)
-    flow_sem = FlowSemaphore(CHAT_MODEL_LIMIT[config.model].max_tokens_consumed_per_min, 12000)
-    instant_req_sem = TimedReqsSemaphore(CHAT_MODEL_LIMIT[config.model].max_concurrent_requests, 15)  # 限制瞬时请求的数量
+    # 限流由客户端池按API Key分别处理 触发限流时只暂停对应的Key 重试层不再暂停全局的限流器
+    transport = HttpTransport()
+    logger.info(f"transport={transport}")
+    # 分片执行时每个分片只使用一部分Key
+    shard = (config.shard_index, config.shard_count) if config.shard_index is not None else None
+    client_pool = create_client_pool(config.model, transport, shard)
+    logger.info(f"{len(client_pool)} api keys for {config.model}")
+    extract_func = create_extract_func(config.model, prompt_template, config.post_check_func, client_pool,
+                                       config.stream_response)
+    retry_policy = RetryPolicy(max_attempts=config.max_attempts)
+    extract_func = retrying_extraction(extract_func, retry_policy)
 
-    logger.debug(f"timed_reqs_sem={timed_reqs_sem}")
-    logger.debug(f"flow_sem={flow_sem}")
-    logger.debug(f"instant_req_sem={instant_req_sem}")
+    repair_func = None
+    repair_pool = None
+    if config.llm_repair_json:
+        # 修复JSON的请求可以使用单独的(通常更便宜的)模型与它自己的限流器
+        # 与提取使用同一个模型时共享client_pool 两者的请求一起计入该模型的限额
+        repair_model = config.repair_model or config.model
+        if repair_model != config.model:
+            repair_pool = create_client_pool(repair_model, transport, shard)
+        repair_prompt = config.repair_json_prompt_template_path.read_text(encoding='utf-8')
+        repair_func = retrying_extraction(create_extract_func(repair_model, repair_prompt, lambda _: True,
+                                                              repair_pool or client_pool),
+                                          retry_policy)
 
-    match config.input_file_type:
-        case "pdf":
-            from .pdf2txt import parse_pdf
-            input_data = [(e.path, e.txt) for e in parse_pdf(config)]
-        case "txt":
-            input_data = load_dir_txt(config)
-        case _:
-            raise ValueError(f"unsupported input file type {config.input_file_type}")
+    response_cache = None
+    if config.response_cache_path is not None:
+        from .response_cache import ResponseCache, cached_extraction
+        response_cache = ResponseCache(config.response_cache_path, config.response_cache_max_bytes)
+        extract_func = cached_extraction(extract_func, response_cache, config.model, prompt_template,
+                                         config.post_check_func)
+        logger.debug(f"response_cache={response_cache}")
 
-    if config.model.startswith("qwen"):
-        from .qwen_backend import qwen_extraction
-        extract_func = partial(qwen_extraction,
-                               timed_reqs_sem=timed_reqs_sem, flow_sem=flow_sem, instant_sem=instant_req_sem,
-                               extract_model=config.model, extract_prompt=prompt_template,
-                               post_check_func=config.post_check_func)
-    elif config.model.startswith("glm"):
-        from .glm_backend import glm_extraction
-        extract_func = partial(glm_extraction,
-                               timed_reqs_sem=timed_reqs_sem, instant_sem=instant_req_sem,
-                               extract_model=config.model, extract_prompt=prompt_template,
-                               post_check_func=config.post_check_func)
-    elif config.model.startswith("deepseek"):
-        from .openai_backend import openai_extraction
-        extract_func = partial(openai_extraction,
-                               timed_reqs_sem=timed_reqs_sem, flow_sem=flow_sem, instant_sem=instant_req_sem,
-                               extract_model=config.model, extract_prompt=prompt_template,
-                               post_check_func=config.post_check_func
-                               )
-    else:
-        raise ValueError(f"unsupported model {config.model}")
+    if config.chunk_long_article:  # 分块包在缓存之外 每个分块的回复单独缓存
+        from .chunking import chunked_extraction, chunk_token_budget
+        chunk_budget = chunk_token_budget(CHAT_MODEL_LIMIT[config.model], prompt_template)
+        extract_func = chunked_extraction(extract_func, chunk_budget)
+        logger.debug(f"articles longer than {chunk_budget} tokens will be split into chunks")
+
+    packer = None
+    if config.pack_short_articles:  # 打包在分块之外 只有短文章会被打包 长文章仍按原来的方式提取
+        from .packing import RequestPacker, pack_token_budget
+        packed_prompt_template = get_extract_prompt_template(config, cls, config.packed_prompt_template_path)
+        packed_func = retrying_extraction(create_extract_func(config.model, packed_prompt_template, lambda _: True,
+                                                              client_pool),
+                                          retry_policy)
+        packer = RequestPacker(extract_func, packed_func,
+                               pack_token_budget(CHAT_MODEL_LIMIT[config.model], packed_prompt_template),
+                               config.pack_max_docs, config.pack_max_article_tokens,
+                               config.one_article_to_many_instance, config.post_check_func)
+        extract_func = packer
+        logger.debug(f"packer={packer}")
 
     cls_adapter = SQLAdapter(cls, DATABASE_URI, auto_create=True, primary_key=config.table_primary_key)
 
+    # 输入是惰性的流水线: 遍历路径 -> 过滤 -> 读取内容 -> 分发
+    # 只有正在处理中的文章会驻留内存
+    if config.input_file_type not in ("pdf", "txt"):
+        raise ValueError(f"unsupported input file type {config.input_file_type}")
+    input_data = iter_dir_files(config, config.input_file_type)
+
     if config.filter_by_file_path:
-        tmp_input_data = [(file_name, content) for file_name, content in input_data
-                          if not cls_adapter.check_exist(file_name)]
-        if len(tmp_input_data) != len(input_data):
-            logger.info(f"filter out {len(input_data) - len(tmp_input_data)} existing data in filter_by_file_path")
-        input_data = tmp_input_data
+        existing_file_paths = cls_adapter.existing_file_paths()
+        logger.info(f"{len(existing_file_paths)} file paths already exist in {cls_adapter.table_name}")
+        input_data = filter_lazily(input_data, lambda e: e not in existing_file_paths, "filter_by_file_path")
+
+    dead_letters = DeadLetterQueue(DATABASE_URI, cls_adapter.table_name)
+    if config.only_dead_letters:
+        dead_letter_file_paths = dead_letters.file_paths()
+        logger.info(f"rerun {len(dead_letter_file_paths)} files in dead letter table")
+        input_data = filter_lazily(input_data, lambda e: e in dead_letter_file_paths, "only_dead_letters")
 
     if config.filter_hooks:
-        tmp_input_data = [(file_name, content) for file_name, content in input_data if
-                          all(func(file_name) for func in config.filter_hooks)]
-        if len(tmp_input_data) != len(input_data):
-            logger.info(
-                f"filter out {len(input_data) - len(tmp_input_data)} existing data in {','.join([func.__name__ for func in config.filter_hooks])}")
+        input_data = filter_lazily(input_data, lambda e: all(func(e) for func in config.filter_hooks),
+                                   ','.join([func.__name__ for func in config.filter_hooks]))
+
+    work_queue = None
+    leased_input = None
+    if config.work_queue_path is not None:
+        # 分片执行: 过滤后的路径加入共享的工作队列 之后只处理从队列中租用的文件
+        from .work_queue import WorkQueue, LeasedInput, default_worker_id
+        work_queue = WorkQueue(config.work_queue_path)
+        added_cnt = await asyncio.to_thread(work_queue.populate, input_data, retry_failed=config.only_dead_letters)
+        leased_input = LeasedInput(work_queue, config.worker_id or default_worker_id(), config.lease_batch_size,
+                                   config.lease_seconds)
+        logger.info(f"work queue: {added_cnt} files added, {leased_input}")
+        # 租用在单独的线程中进行 输入变为异步迭代器
+        input_data = leased_input
+
+    # 过滤只作用在路径上 被过滤掉的文件不会被读取或解析
+    if config.input_file_type == "pdf":
+        from .pdf2txt import parse_pdf
+        input_data = ((e.path, e.txt) async for e in parse_pdf(config, input_data))
+    elif leased_input is not None:
+        input_data = aload_dir_txt(input_data)
+    else:
+        input_data = load_dir_txt(input_data)
 
-        input_data = tmp_input_data
+    dedup_index = None
+    dedup_executor = None
+    pending_duplicates = None
+    if config.dedup_index_path is not None:
+        # 去重在读取内容之后 分发之前 签名在进程池中计算
+        from concurrent.futures import ProcessPoolExecutor
+        from .dedup import DedupIndex, PendingDuplicates, deduplicate
+        dedup_index = DedupIndex(config.dedup_index_path, config.dedup_threshold)
+        dedup_executor = ProcessPoolExecutor()
+        pending_duplicates = PendingDuplicates()
+        input_data = deduplicate(input_data, dedup_index, dedup_executor, on_duplicate=pending_duplicates.add)
 
-    logger.info(f"start extract, total count = {len(input_data)}")
+    # 同时进行中的请求受瞬时并发限流器约束 更多的worker只会在限流器与连接池中排队 并增加调度开销
+    limit = CHAT_MODEL_LIMIT[config.model]
+    num_workers = config.num_workers or min(limit.max_reqs_per_min, limit.max_concurrent_requests) * len(client_pool)
+    if packer is not None and not config.num_workers:
+        num_workers *= config.pack_max_docs  # 每个请求包含多篇文章 需要更多同时处理中的文章才能填满打包
+    logger.info(f"start extract, num_workers = {num_workers}")
 
-    result = await parse_for_any_type(input_data, cls, extract_func, cls_adapter, config.one_article_to_many_instance)
+    sql_writer = BatchWriter(cls_adapter, config.sql_batch_size, config.sql_flush_interval)
+    parse_stage = ParseStage(config.parse_mode, config.parse_workers)
+    logger.info(f"parse_stage={parse_stage}")
+    if leased_input is not None:
+        leased_input.start_heartbeat(sql_writer)
 
-    timed_reqs_sem.cancel()
-    flow_sem.cancel()
-    instant_req_sem.cancel()
+    def on_result(ret: ExtractResult):
+        if pending_duplicates is not None:
+            pending_duplicates.record(ret)
+        if leased_input is not None:
+            leased_input.finish(ret)
+
+    try:
+        result = await parse_for_any_type(input_data, cls, extract_func, sql_writer,
+                                          config.one_article_to_many_instance, num_workers, config.table_primary_key,
+                                          dead_letters, repair_func, parse_stage,
+                                          config.stream_response and config.one_article_to_many_instance,
+                                          on_result)
+        if pending_duplicates is not None:
+            # 写入器已关闭 代表文件的结果都已确定 重复文件在此之后才算处理完成
+            duplicate_results = pending_duplicates.resolve(cls_adapter)
+            for ret in duplicate_results:
+                if ret.parse_success:
+                    dead_letters.remove(ret.file_name)
+                else:
+                    logger.error(f"file_name={ret.file_name},message={ret.fail_message}")
+                    dead_letters.add(ret.file_name, ret.fail_message)
+                if leased_input is not None:
+                    leased_input.finish(ret)
+            logger.info(f"dedup: {sum(e.parse_success for e in duplicate_results)}/{len(duplicate_results)} "
+                        f"duplicates copied from their representatives")
+    finally:
+        parse_stage.shutdown()
+        if leased_input is not None:
+            # 写入器已关闭 剩余的结果都已写入数据库
+            await leased_input.aclose()
+            logger.info(f"{leased_input}, work queue progress: {await asyncio.to_thread(work_queue.progress)}")
+            work_queue.close()
+        if dedup_executor is not None:
+            dedup_executor.shutdown(cancel_futures=True)
+    dead_letters.close()
+    if dedup_index is not None:
+        dedup_index.close()
+
+    client_pool.cancel()
+    logger.info(f"client_pool={client_pool}")
+    if packer is not None:
+        logger.info(f"packer={packer}")
+    if repair_pool is not None:
+        repair_pool.cancel()
+    await transport.aclose()
+    if response_cache is not None:
+        logger.info(f"response cache: {response_cache.stats()}")
+        await response_cache.aclose()
+
+    if snapshot_writer is not None:
+        snapshot_writer.close()
+    if metrics_server is not None:
+        await metrics_server.close()
 
     if config.post_processing_hook:
         config.post_processing_hook(result)
+
+    # 写完队列中剩余的日志 下一次build_task重新配置日志
+    shutdown_logging()
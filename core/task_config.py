@@ -21,12 +21,53 @@ class TaskConfig:
     extract_prompt_template_path: Path = Path(__file__).resolve().parent / "template/extract.txt"  # 提取模板路径
     repair_json_prompt_template_path: Path = Path(__file__).resolve().parent / "template/repair_json.txt"  # 修复json的模板路径
     log_dir_path: Path = Path("./log")  # 日志文件夹路径
+    log_json_lines: bool = False  # 日志文件是否每行一个JSON对象 便于检索与导入其他系统
+    log_max_bytes: int = 100 << 20  # 日志文件超过这么多字节时轮转 0为不轮转
+    log_backup_count: int = 5  # 保留的轮转日志文件数
+    log_warning_limit: int = 20  # 同类警告(如每个文件的缺失或多余字段)每分钟至多记录的条数 0为不限制
+    max_attempts: int = 5  # 限流 超时等暂时性错误的最大尝试次数 仍失败的文件记入死信表
+    only_dead_letters: bool = False  # 只重新处理死信表中的文件
+    llm_repair_json: bool = True  # 本地修复JSON失败后 是否用repair_json模板请求大模型修复
+    repair_model: str | None = None  # 修复JSON使用的模型 建议使用更便宜的模型如qwen-turbo 为None时与model相同
+    chunk_long_article: bool = True  # 超过模型上下文长度的文章是否切分后分块提取
+    pdf_max_pages: int | None = None  # 每个PDF最多解析的页数 为None时解析全部
+    response_cache_path: Path | None = None  # 回复缓存的路径 为None时不使用缓存
+    response_cache_max_bytes: int = 1 << 30  # 回复缓存的大小上限
+    sql_batch_size: int = 500  # 每积累这么多行写入并提交一次数据库
+    sql_flush_interval: float = 5.0  # 至多每隔这么多秒写入并提交一次数据库
+    stream_response: bool = False  # qwen与deepseek流式输出 一对多时每个实例完整即写入 回复中断时保留已完整的实例
+    parse_mode: Literal['inline', 'thread', 'process'] = 'thread'  # 解析回复的方式 大量一对多的长回复时可用process
+    parse_workers: int | None = None  # 解析线程或进程的数量 为None时使用执行器的默认值
+    dedup_index_path: Path | None = None  # 近似重复文章检测的签名索引路径 为None时不去重 每个簇只提取一篇
+    dedup_threshold: float = 0.8  # 估计的Jaccard相似度不低于该值的文章视为重复
+    pack_short_articles: bool = False  # 是否将多篇短文章打包进一个请求 节省重复的提示词与RPM 适合RPM很低的模型
+    pack_max_docs: int = 8  # 一个打包请求中的文章数上限
+    pack_max_article_tokens: int = 1000  # 只打包不超过这么多token的文章
+    packed_prompt_template_path: Path = Path(__file__).resolve().parent / "template/extract_packed.txt"  # 打包提取模板路径
+    num_workers: int | None = None  # 并发worker数量 即同时处理中的文章数上限 默认为模型的瞬时并发数乘以Key的数量
+    work_queue_path: Path | None = None  # 分片执行的工作队列路径 多个进程或主机共享 为None时不分片
+    worker_id: str | None = None  # 分片执行时worker的名称 为None时使用 主机名-进程号
+    lease_batch_size: int = 32  # 每次从工作队列租用的文件数
+    lease_seconds: float = 600.0  # 租约时长 worker崩溃后租用的文件在这么多秒后由其他worker重新处理
+    shard_index: int | None = None  # 分片序号 与shard_count一起决定该分片使用哪些API Key 为None时使用全部的Key
+    shard_count: int = 1  # 分片总数
+    metrics_port: int | None = None  # 在本地该端口以Prometheus的文本格式提供/metrics 为None时不启动 0为随机端口
+    metrics_snapshot_path: Path | None = None  # 定期写入指标JSON快照的路径 为None时不写入
+    metrics_snapshot_interval: float = 10.0  # 写入JSON快照的间隔秒数
 
     def __post_init__(self):
         if isinstance(self.dataset_dir_path, str):
             self.dataset_dir_path = Path(self.dataset_dir_path)
         if isinstance(self.log_dir_path, str):
             self.log_dir_path = Path(self.log_dir_path)
+        if isinstance(self.response_cache_path, str):
+            self.response_cache_path = Path(self.response_cache_path)
+        if isinstance(self.dedup_index_path, str):
+            self.dedup_index_path = Path(self.dedup_index_path)
+        if isinstance(self.work_queue_path, str):
+            self.work_queue_path = Path(self.work_queue_path)
+        if isinstance(self.metrics_snapshot_path, str):
+            self.metrics_snapshot_path = Path(self.metrics_snapshot_path)
 
         self.dataset_input_path = self.dataset_dir_path / self.dataset_name
         self.dataset_output_path = self.dataset_dir_path / (self.dataset_name + "_output")
@@ -0,0 +1,324 @@
+"""
+分片执行: 工作队列表列出所有输入文件 多个worker(本地进程或共享文件系统上的其他主机)分批租用文件
+提取并写入结果后标记完成 worker崩溃时租约过期 文件自动被其他worker重新租用
+查看全局进度: python -m core.work_queue progress <工作队列路径> [--watch 秒数]
+"""
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import logging
+import multiprocessing
+import os
+import socket
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import AsyncIterator, Iterable, Union, Type
+
+from .checked import Checked, CheckMixin
+from .extract_helper import ExtractResult
+from .sql_helper import BatchWriter
+from .task_config import TaskConfig
+
+MAX_LEASE_ATTEMPTS = 3  # 租约过期这么多次的文件视为会使worker崩溃 不再分配
+STATUSES = ('pending', 'leased', 'done', 'failed')
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    SQLite中的工作队列 每个文件一行 状态为 pending leased done failed
+    租用在BEGIN IMMEDIATE事务中完成 多个进程或主机同时租用时不会拿到同一个文件
+    使用回滚日志而不是WAL WAL依赖共享内存 不能跨主机使用
+    """
+
+    def __init__(self, path: Path, timeout: float = 60.0):
+        if isinstance(path, str):
+            path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # isolation_level=None 由各方法显式地开始事务
+        # LeasedInput在它自己的线程中使用连接
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS WorkItem("
+                          "file_path TEXT PRIMARY KEY, status TEXT, worker TEXT, lease_expires REAL, "
+                          "attempts INTEGER, updated_at REAL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_WorkItem_status ON WorkItem(status, lease_expires)")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # 开始事务时即获取写锁 其他进程在此等待 而不是在提交时因冲突失败
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def populate(self, file_paths: Iterable[str], retry_failed: bool = False) -> int:
+        """
+        加入新的文件 已在队列中的文件保持原来的状态 每个worker启动时都可以调用
+        :param retry_failed: 是否将失败的文件重新置为待处理
+        :return: 新加入的文件数
+        """
+        now = time.time()
+        with self.transaction():
+            before = self.conn.total_changes
+            self.conn.executemany("INSERT OR IGNORE INTO WorkItem VALUES (?, 'pending', NULL, NULL, 0, ?)",
+                                  ((e, now) for e in file_paths))
+            added = self.conn.total_changes - before
+            if retry_failed:
+                self.conn.execute("UPDATE WorkItem SET status='pending', attempts=0, updated_at=? "
+                                  "WHERE status='failed'", (now,))
+        return added
+
+    def claim(self, worker_id: str, n: int, lease_seconds: float) -> list[str]:
+        """
+        租用至多n个待处理或租约已过期的文件
+        """
+        now = time.time()
+        with self.transaction():
+            # 租约过期太多次的文件不再分配
+            self.conn.execute("UPDATE WorkItem SET status='failed', worker=NULL, updated_at=? "
+                              "WHERE status='leased' AND lease_expires<? AND attempts>=?",
+                              (now, now, MAX_LEASE_ATTEMPTS))
+            file_paths = [e for (e,) in self.conn.execute(
+                "SELECT file_path FROM WorkItem WHERE status='pending' OR (status='leased' AND lease_expires<?) "
+                "LIMIT ?", (now, n))]
+            self.conn.executemany("UPDATE WorkItem SET status='leased', worker=?, lease_expires=?, "
+                                  "attempts=attempts+1, updated_at=? WHERE file_path=?",
+                                  [(worker_id, now + lease_seconds, now, e) for e in file_paths])
+        return file_paths
+
+    def renew(self, worker_id: str, file_paths: Iterable[str], lease_seconds: float):
+        # 只续期仍由该worker持有的租约 已过期并被其他worker租用的文件不受影响
+        now = time.time()
+        with self.transaction():
+            self.conn.executemany("UPDATE WorkItem SET lease_expires=? "
+                                  "WHERE file_path=? AND worker=? AND status='leased'",
+                                  [(now + lease_seconds, e, worker_id) for e in file_paths])
+
+    def complete(self, worker_id: str, results: Iterable[tuple[str, bool]]):
+        """
+        :param results: 文件路径 与 是否成功
+        """
+        now = time.time()
+        with self.transaction():
+            self.conn.executemany("UPDATE WorkItem SET status=?, lease_expires=NULL, updated_at=? "
+                                  "WHERE file_path=? AND worker=? AND status='leased'",
+                                  [('done' if success else 'failed', now, file_path, worker_id)
+                                   for file_path, success in results])
+
+    def release(self, worker_id: str, file_paths: Iterable[str]):
+        # 主动归还的租约不计入尝试次数
+        now = time.time()
+        with self.transaction():
+            self.conn.executemany("UPDATE WorkItem SET status='pending', worker=NULL, lease_expires=NULL, "
+                                  "attempts=attempts-1, updated_at=? "
+                                  "WHERE file_path=? AND worker=? AND status='leased'",
+                                  [(now, e, worker_id) for e in file_paths])
+
+    def reclaim_expired(self) -> int:
+        """
+        将租约过期的文件置为待处理 claim时也会租用过期的文件 这里只是让进度更准确
+        """
+        now = time.time()
+        with self.transaction():
+            return self.conn.execute("UPDATE WorkItem SET status='pending', worker=NULL, lease_expires=NULL, "
+                                     "updated_at=? WHERE status='leased' AND lease_expires<?", (now, now)).rowcount
+
+    def progress(self, window: float = 60.0) -> dict:
+        """
+        :param window: 统计最近这么多秒内完成的文件数 以计算速率
+        """
+        now = time.time()
+        counts = dict.fromkeys(STATUSES, 0)
+        counts.update(self.conn.execute("SELECT status, COUNT(*) FROM WorkItem GROUP BY status").fetchall())
+        expired = self.conn.execute("SELECT COUNT(*) FROM WorkItem WHERE status='leased' AND lease_expires<?",
+                                    (now,)).fetchone()[0]
+        workers = {worker: {"leased": leased, "expired": expired_cnt}
+                   for worker, leased, expired_cnt in self.conn.execute(
+                       "SELECT worker, COUNT(*), SUM(lease_expires<?) FROM WorkItem WHERE status='leased' "
+                       "GROUP BY worker ORDER BY worker", (now,))}
+        recent = self.conn.execute("SELECT COUNT(*) FROM WorkItem WHERE status IN ('done', 'failed') "
+                                   "AND updated_at>=?", (now - window,)).fetchone()[0]
+        total = sum(counts.values())
+        return {"total": total, **counts, "expired_leases": expired, "files_per_sec": recent / window,
+                "workers": workers}
+
+    def close(self):
+        self.conn.close()
+
+
+class LeasedInput:
+    """
+    为一个worker租用文件 产生文件路径 作为build_task的输入
+    已处理的文件在结果写入数据库之后才标记完成 worker崩溃时未提交的结果会由其他worker重新提取
+    心跳任务定期提交已写入的结果并为处理中的文件续期
+    工作队列的读写可能等待其他分片持有的锁 都在单独的线程中执行 不阻塞事件循环
+    """
+
+    def __init__(self, queue: WorkQueue, worker_id: str, batch_size: int = 32, lease_seconds: float = 600.0):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.leased: set[str] = set()  # 租用中 尚未处理完的文件
+        self.finished: dict[str, bool] = {}  # 已处理 尚未标记完成的文件 -> 是否成功
+        self.exhausted = False  # 队列中已没有可以租用的文件
+        self.claimed_cnt = 0
+        self.completed_cnt = 0
+        self.heartbeat_task: asyncio.Task | None = None
+        # 只有一个线程 连接只在这个线程中使用
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="work_queue")
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        # 每次只租用一批 输入在调度器的队列有空位时才被读取 租用的文件不会远多于处理中的文件
+        while file_paths := await self.run(self.queue.claim, self.worker_id, self.batch_size, self.lease_seconds):
+            self.claimed_cnt += len(file_paths)
+            self.leased.update(file_paths)
+            for file_path in file_paths:
+                yield file_path
+        self.exhausted = True
+
+    def finish(self, ret: ExtractResult):
+        """
+        作为parse_for_any_type的on_result 每个文件处理完成后调用
+        行写入失败时会以失败的结果再次调用 尚未提交的完成状态随之更新
+        """
+        if ret.file_name in self.leased or ret.file_name in self.finished:
+            self.leased.discard(ret.file_name)
+            self.finished[ret.file_name] = ret.request_success and ret.parse_success
+
+    async def _complete_finished(self):
+        finished, self.finished = self.finished, {}
+        await self.run(self.queue.complete, self.worker_id, list(finished.items()))
+        self.completed_cnt += len(finished)
+
+    async def checkpoint(self, sql_writer: BatchWriter):
+        # 先等结果写入数据库 再标记完成 写入失败的文件在flush时已经更新为失败
+        await sql_writer.flush()
+        await self._complete_finished()
+        await self.run(self.queue.renew, self.worker_id, list(self.leased), self.lease_seconds)
+
+    def start_heartbeat(self, sql_writer: BatchWriter):
+        async def heartbeat():
+            while True:
+                await asyncio.sleep(self.lease_seconds / 3)
+                await self.checkpoint(sql_writer)
+
+        self.heartbeat_task = asyncio.create_task(heartbeat())
+
+    async def aclose(self):
+        """
+        在写入器关闭之后调用 提交剩余的结果
+        输入已读完时 仍没有结果的文件(如PDF解析失败 或任务因致命错误中止时处理中的文件)标记为失败
+        可以用retry-failed重新处理 否则(任务中断)将它们归还 由其他worker继续处理
+        """
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.heartbeat_task
+        await self._complete_finished()
+        unfinished = list(self.leased)
+        self.leased.clear()
+        if self.exhausted:
+            await self.run(self.queue.complete, self.worker_id, [(e, False) for e in unfinished])
+        else:
+            await self.run(self.queue.release, self.worker_id, unfinished)
+        if unfinished:
+            logging.getLogger("InfoExtract").warning(
+                f"{len(unfinished)} leased files without result {'marked failed' if self.exhausted else 'released'}")
+        self.executor.shutdown()
+
+    def __repr__(self):
+        return (f"LeasedInput(worker_id={self.worker_id!r},batch_size={self.batch_size},"
+                f"lease_seconds={self.lease_seconds},claimed={self.claimed_cnt},completed={self.completed_cnt})")
+
+
+def _run_worker(config: TaskConfig, cls: Union[Type[Checked], Type[CheckMixin]]):
+    from .task import build_task
+    asyncio.run(build_task(config, cls))
+
+
+def run_sharded(config: TaskConfig, cls: Union[Type[Checked], Type[CheckMixin]], processes: int):
+    """
+    在本机启动processes个worker进程 共享config.work_queue_path中的工作队列
+    每个进程使用一部分API Key 多台主机时为每台主机设置不同的shard_index 与相同的shard_count
+    在支持fork的系统上使用fork 否则config与数据类必须可以被pickle
+    """
+    if config.work_queue_path is None:
+        raise ValueError("run_sharded requires config.work_queue_path")
+    ctx = multiprocessing.get_context("fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn")
+    host_index = config.shard_index or 0
+    worker_processes = []
+    for i in range(processes):
+        worker_config = dataclasses.replace(config, shard_index=host_index * processes + i,
+                                            shard_count=config.shard_count * processes,
+                                            worker_id=f"{config.worker_id or default_worker_id()}-{i}")
+        process = ctx.Process(target=_run_worker, args=(worker_config, cls), name=worker_config.worker_id)
+        process.start()
+        worker_processes.append(process)
+    for process in worker_processes:
+        process.join()
+    failed = [e.name for e in worker_processes if e.exitcode != 0]
+    if failed:
+        logging.getLogger("InfoExtract").error(f"workers {failed} exited abnormally, "
+                                               f"their leases will be reclaimed after expiry")
+
+
+def print_progress(queue: WorkQueue):
+    p = queue.progress()
+    done_ratio = (p['done'] + p['failed']) / p['total'] if p['total'] else 0.0
+    remaining = p['pending'] + p['leased']
+    eta = f"{remaining / p['files_per_sec']:.0f}s" if p['files_per_sec'] > 0 else '?'
+    print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} total={p['total']} done={p['done']} failed={p['failed']} "
+          f"leased={p['leased']} pending={p['pending']} expired_leases={p['expired_leases']} "
+          f"progress={done_ratio:.1%} rate={p['files_per_sec']:.1f} files/s eta={eta}")
+    for worker, e in p['workers'].items():
+        print(f"  {worker}: leased={e['leased']} expired={e['expired']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="分片执行的工作队列")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    progress_parser = subparsers.add_parser("progress", help="显示全局进度")
+    progress_parser.add_argument("path", help="工作队列的路径")
+    progress_parser.add_argument("--watch", type=float, default=None, help="每隔这么多秒刷新一次")
+    reclaim_parser = subparsers.add_parser("reclaim", help="将租约过期的文件置为待处理")
+    reclaim_parser.add_argument("path")
+    retry_parser = subparsers.add_parser("retry-failed", help="将失败的文件置为待处理")
+    retry_parser.add_argument("path")
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.path)
+    try:
+        if args.command == "progress":
+            print_progress(queue)
+            while args.watch:
+                time.sleep(args.watch)
+                print_progress(queue)
+        elif args.command == "reclaim":
+            print(f"{queue.reclaim_expired()} expired leases reclaimed")
+        elif args.command == "retry-failed":
+            queue.populate([], retry_failed=True)
+            print_progress(queue)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
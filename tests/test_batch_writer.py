@@ -0,0 +1,91 @@
+import asyncio
+import json
+import sqlite3
+
+from core import CheckMixin, Checked
+from core.async_extract import parse_for_any_type
+from core.extract_helper import ExtractResult
+from core.retry import DeadLetterQueue
+from core.sql_helper import SQLAdapter, BatchWriter
+
+
+class U(CheckMixin, Checked):
+    user_name: str
+    age: int
+
+
+def make_extract_func(names: dict[str, str]):
+    async def extract(file_name: str, file_content: str) -> ExtractResult:
+        await asyncio.sleep(0)
+        return ExtractResult(file_name=file_name, json_str=json.dumps({"user_name": names[file_name], "age": 1}))
+
+    return extract
+
+
+def test_constraint_violation_fails_only_the_offending_file(tmp_path):
+    db = (tmp_path / "out.db").as_posix()
+    adapter = SQLAdapter(U, db, auto_create=True, primary_key="user_name")
+    # doc7与doc3的user_name相同 违反主键约束
+    names = {f"doc{i}": f"user{i}" for i in range(20)}
+    names["doc7"] = "user3"
+    dead_letters = DeadLetterQueue(db, "U")
+    writer = BatchWriter(adapter, batch_size=2, flush_interval=60)
+
+    results = asyncio.run(parse_for_any_type([(e, '') for e in names], U, make_extract_func(names), writer,
+                                             one_to_many=False, num_workers=4, dead_letters=dead_letters))
+
+    assert len(results) == 20
+    failed = [e.file_name for e in results if not e.parse_success]
+    assert len(failed) == 1 and failed[0] in ("doc3", "doc7")
+    assert "UNIQUE constraint failed" in next(e for e in results if not e.parse_success).fail_message
+    dead_letters.close()
+    assert DeadLetterQueue(db, "U").file_paths() == set(failed)
+    with sqlite3.connect(db) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM U").fetchone()[0] == 19
+
+
+def test_on_error_reports_each_failed_file_and_writer_keeps_running(tmp_path):
+    db = (tmp_path / "out.db").as_posix()
+    adapter = SQLAdapter(U, db, auto_create=True, primary_key="user_name")
+    writer = BatchWriter(adapter, batch_size=100, flush_interval=60)
+    errors = []
+    writer.on_error = lambda file_path, message: errors.append(file_path)
+
+    async def run():
+        writer.start()
+        await writer.add_rows([("a", 1, "f1"), ("b", 1, "f1"), ("a", 2, "f2"), ("c", 3, "f3")])
+        await writer.flush()
+        await writer.add_rows([("d", 4, "f4")])
+        await writer.close()
+
+    asyncio.run(run())
+    assert errors == ["f2"]
+    assert writer.rows_written == 4
+
+
+def test_dead_letters_are_written_by_the_writer_thread(tmp_path):
+    db = (tmp_path / "out.db").as_posix()
+    adapter = SQLAdapter(U, db, auto_create=True, primary_key="user_name")
+    setup = DeadLetterQueue(db, "U")
+    setup.add("old", "failed before")
+    setup.close()
+
+    dead_letters = DeadLetterQueue(db, "U")
+    writer = BatchWriter(adapter, batch_size=100, flush_interval=60)
+    writer.dead_letters = dead_letters
+    before = dead_letters.conn.total_changes
+    dead_letters.add("new", "failed")
+    dead_letters.remove("old")
+    dead_letters.remove("never_failed")  # 不在死信表中的文件不产生写入
+    assert dead_letters.conn.total_changes == before
+    assert dead_letters.changes == {"new": "failed", "old": None}
+
+    async def run():
+        writer.start()
+        await writer.flush()
+        await writer.close()
+
+    asyncio.run(run())
+    assert dead_letters.changes == {}
+    assert dead_letters.file_paths() == {"new"}
+    dead_letters.close()
@@ -0,0 +1,28 @@
+import json
+import re
+
+from core import CheckMixin, Checked
+
+
+class Item(CheckMixin, Checked):
+    name: str
+    count: int
+
+
+def parse(json_str: str):
+    return [(obj.name, obj.count, missing_keys) for obj, missing_keys, _ in Item.parse_json(json_str, True)]
+
+
+def test_not_specified_change_after_class_creation_is_respected():
+    json_str = json.dumps([{"name": "unknown", "count": 1}])
+    assert parse(json_str) == [("unknown", 1, [])]
+    original = Item.NOT_SPECIFIED
+    try:
+        Item.NOT_SPECIFIED = original + [re.compile(r'unknown')]
+        assert parse(json_str) == [("", 1, ["name"])]
+        # 没有模式时不丢弃任何字段
+        Item.NOT_SPECIFIED = []
+        assert parse(json.dumps([{"name": "not specified", "count": 1}])) == [("not specified", 1, [])]
+    finally:
+        Item.NOT_SPECIFIED = original
+    assert parse(json.dumps([{"name": "Not Specified", "count": 1}])) == [("", 1, ["name"])]
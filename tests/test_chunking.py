@@ -0,0 +1,33 @@
+from core import CheckMixin, Checked
+from core.chunking import split_article, merge_objects
+from core.extract_helper import estimate_tokens
+
+
+class Paper(CheckMixin, Checked):
+    title: str = ''
+    year: int = 0
+    venue: str = ''
+
+
+def test_split_article_respects_budget_and_keeps_text():
+    article = "".join(f"paragraph {i} " * 30 + "\n" for i in range(20)) + "x" * 5000 + "\n"
+    chunks = split_article(article, 300)
+    assert len(chunks) > 1
+    assert "".join(chunks) == article
+    assert all(estimate_tokens(e) <= 300 for e in chunks)
+
+
+def test_short_article_is_one_chunk():
+    assert split_article("short\narticle\n", 300) == ["short\narticle\n"]
+
+
+def test_merge_one_to_one_fills_empty_fields_in_order():
+    objects = [Paper(title="A"), Paper(title="B", year=2020), Paper(venue="V", year=2021)]
+    [merged] = merge_objects(Paper, objects, None, one_to_many=False)
+    assert (merged.title, merged.year, merged.venue) == ("A", 2020, "V")
+
+
+def test_merge_one_to_many_dedups_by_primary_key():
+    objects = [Paper(title="A"), Paper(title="B", year=1), Paper(title="A", venue="V")]
+    merged = merge_objects(Paper, objects, "title", one_to_many=True)
+    assert [(e.title, e.year, e.venue) for e in merged] == [("A", 0, "V"), ("B", 1, "")]
@@ -0,0 +1,25 @@
+import asyncio
+
+from core.client_pool import ClientPool, PooledClient
+from core.custom_semaphore import create_limiters
+from core.extract_helper import ExtractResult
+from core.retry import failure_from_exception
+
+
+def test_failed_result_counts_as_failure():
+    async def backend(file_name, file_content, **_):
+        if file_name == "bad":
+            return failure_from_exception(ValueError("malformed response"), file_name, file_content)
+        return ExtractResult(file_name=file_name, json_str="{}")
+
+    async def run():
+        client = PooledClient("***key", None, create_limiters("deepseek-chat"))
+        pool = ClientPool([client])
+        extract = pool.extraction(backend)
+        rets = [await extract(name, "content") for name in ["ok", "bad", "ok"]]
+        pool.cancel()
+        return client, rets
+
+    client, rets = asyncio.run(run())
+    assert [e.request_success for e in rets] == [True, False, True]
+    assert (client.success_cnt, client.fail_cnt, client.in_flight) == (2, 1, 0)
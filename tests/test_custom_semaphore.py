@@ -0,0 +1,193 @@
+import asyncio
+
+import pytest
+
+from core.custom_semaphore import TokenBucket, TimedReqsSemaphore, FlowSemaphore
+
+
+class FakeClock:
+    """
+    假时钟 sleep直接推进时间 限流器的行为与真实时间无关 结果是确定的
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+        await asyncio.sleep(0)
+
+
+async def count_takes(bucket: TokenBucket, clock: FakeClock, duration: float, n: int = 1) -> int:
+    cnt = 0
+    while True:
+        await bucket.take(n)
+        if clock.now > duration:
+            return cnt
+        cnt += 1
+
+
+@pytest.mark.parametrize("limit, reset_interval", [(10, 60), (60, 60), (2, 15), (1000, 60)])
+def test_sustained_rate_matches_limit(limit, reset_interval):
+    clock = FakeClock()
+    bucket = TokenBucket(limit, reset_interval, clock=clock, sleep=clock.sleep)
+    duration = 600
+    cnt = asyncio.run(count_takes(bucket, clock, duration))
+    expected = limit * duration / reset_interval
+    # 长期速率等于limit 至多多出开始时桶中的burst个令牌
+    assert expected <= cnt <= expected + bucket.burst
+
+
+def test_burst_is_available_immediately_then_waits():
+    clock = FakeClock()
+    bucket = TokenBucket(100, 60, burst=10, clock=clock, sleep=clock.sleep)
+
+    async def run():
+        for _ in range(10):
+            await bucket.take()
+        assert clock.now == 0
+        await bucket.take()
+        return clock.now
+
+    waited = asyncio.run(run())
+    assert waited == pytest.approx(60 / 100)
+
+
+def test_burst_defaults_to_a_tenth_of_limit_and_never_exceeds_limit():
+    assert TokenBucket(100).burst == 10
+    assert TokenBucket(5).burst == 1
+    assert TokenBucket(5, burst=50).burst == 5
+    with pytest.raises(ValueError):
+        TokenBucket(0)
+
+
+def test_take_more_than_burst_waits_for_burst_and_goes_into_debt():
+    clock = FakeClock()
+    bucket = TokenBucket(60, 60, burst=6, clock=clock, sleep=clock.sleep)
+
+    async def run():
+        await bucket.take(30)  # 桶中已有6个令牌 立即取得 欠下24个
+        assert clock.now == 0
+        assert bucket.tokens == pytest.approx(-24)
+        await bucket.take(1)  # 等待补齐欠下的令牌
+        return clock.now
+
+    assert asyncio.run(run()) == pytest.approx(25)
+
+
+def test_adjust_refunds_and_charges():
+    clock = FakeClock()
+    bucket = TokenBucket(60, 60, burst=10, clock=clock, sleep=clock.sleep)
+
+    async def run():
+        await bucket.take(8)
+        bucket.adjust(-5)  # 退还
+        assert bucket.tokens == pytest.approx(7)
+        bucket.adjust(-100)  # 退还不超过桶容量
+        assert bucket.tokens == pytest.approx(10)
+        bucket.adjust(15)  # 补扣
+        assert bucket.tokens == pytest.approx(-5)
+
+    asyncio.run(run())
+
+
+def test_penalize_pauses_following_takes():
+    clock = FakeClock()
+    bucket = TokenBucket(60, 60, burst=10, clock=clock, sleep=clock.sleep)
+
+    async def run():
+        bucket.penalize(5)
+        await bucket.take()
+        return clock.now
+
+    # 欠下5秒的补充量 再等1秒补出一个令牌
+    assert asyncio.run(run()) == pytest.approx(6)
+
+
+def test_cancelled_waiter_consumes_nothing():
+    clock = FakeClock()
+    blocked = asyncio.Event()
+
+    async def never_wake(seconds: float):
+        blocked.set()
+        await asyncio.Event().wait()
+
+    bucket = TokenBucket(60, 60, burst=1, clock=clock, sleep=never_wake)
+
+    async def run():
+        await bucket.take()
+        tokens = bucket.tokens
+        waiter = asyncio.create_task(bucket.take())
+        await blocked.wait()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert bucket.tokens == tokens
+        assert not bucket.lock.locked()
+
+    asyncio.run(run())
+
+
+def test_timed_reqs_semaphore_context_manager_takes_one_token():
+    clock = FakeClock()
+    sem = TimedReqsSemaphore(30, 60, burst=3, clock=clock, sleep=clock.sleep)
+
+    async def run():
+        for _ in range(4):
+            async with sem:
+                pass
+        return clock.now
+
+    assert asyncio.run(run()) == pytest.approx(2)
+
+
+def test_waiters_are_served_in_arrival_order():
+    clock = FakeClock()
+    sem = TimedReqsSemaphore(60, 60, burst=1, clock=clock, sleep=clock.sleep)
+    order = []
+
+    async def request(i: int):
+        async with sem:
+            order.append(i)
+
+    async def run():
+        await asyncio.gather(*[request(i) for i in range(5)])
+
+    asyncio.run(run())
+    assert order == list(range(5))
+
+
+def test_flow_reservation_settles_to_actual_usage():
+    clock = FakeClock()
+    flow_sem = FlowSemaphore(100_000, 60, burst=10_000, completion_tokens_prior=100, clock=clock, sleep=clock.sleep)
+    prompt = "x" * 400
+
+    async def run():
+        reservation = flow_sem.reserve(prompt)
+        async with reservation:
+            reserved = reservation.reserved
+            assert flow_sem.tokens == pytest.approx(10_000 - reserved)
+        await reservation.flow(prompt_tokens=50, completion_tokens=30)
+        # 多退少补 桶中只扣除实际用量
+        assert flow_sem.tokens == pytest.approx(10_000 - 80)
+        assert reservation.reserved == 80
+
+    asyncio.run(run())
+
+
+def test_flow_semaphore_weights_cached_tokens():
+    flow_sem = FlowSemaphore(100_000, cached_tokens_weight=0.1)
+    assert flow_sem.charged(1000, 100, cached_tokens=800) == 1000 - 720 + 100
+    assert FlowSemaphore(100_000).charged(1000, 100, cached_tokens=800) == 1100
+
+
+def test_flow_semaphore_estimate_follows_observed_usage():
+    flow_sem = FlowSemaphore(100_000, completion_tokens_prior=1000)
+    prompt = "x" * 400
+    for _ in range(50):
+        flow_sem.observe(prompt, prompt_tokens=200, completion_tokens=100)
+    assert flow_sem.avg_completion_tokens == pytest.approx(100)
+    assert flow_sem.estimate(prompt) == pytest.approx(300, abs=1)
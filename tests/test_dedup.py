@@ -0,0 +1,106 @@
+import asyncio
+import random
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from core import CheckMixin, Checked
+from core.dedup import (DedupIndex, PendingDuplicates, compute_signatures, content_hash, deduplicate,
+                        minhash_signature, NUM_PERM)
+from core.extract_helper import ExtractResult
+from core.sql_helper import SQLAdapter
+
+TEXT = "the quick brown fox jumps over the lazy dog " * 20
+
+
+class U(CheckMixin, Checked):
+    user_name: str
+    age: int
+
+
+def run_dedup(index: DedupIndex, input_data: list[tuple[str, str]], on_duplicate=None) -> list[str]:
+    async def run():
+        # 签名在线程池中计算即可 不必启动进程池
+        with ThreadPoolExecutor() as executor:
+            return [e[0] async for e in deduplicate(input_data, index, executor, batch_size=2,
+                                                    on_duplicate=on_duplicate)]
+
+    return asyncio.run(run())
+
+
+def test_compute_signatures_skips_unchanged_content():
+    (digest, signature), (new_digest, new_signature) = compute_signatures([TEXT, TEXT + "!"],
+                                                                          [content_hash(TEXT), content_hash(TEXT)])
+    assert digest == content_hash(TEXT) and signature is None
+    assert new_digest == content_hash(TEXT + "!") and new_signature is not None
+
+
+def test_exact_and_near_duplicates_are_skipped(tmp_path):
+    index = DedupIndex(tmp_path / "dedup.db", threshold=0.8)
+    input_data = [("a", TEXT), ("b", TEXT), ("c", TEXT.upper() + " "), ("d", "something else entirely " * 20)]
+    duplicates = PendingDuplicates()
+    assert run_dedup(index, input_data, duplicates.add) == ["a", "d"]
+    assert duplicates.representatives == {"b": "a", "c": "a"}
+    assert index.stats() == {"reused": 0, "hashed": 4, "exact_duplicates": 1, "near_duplicates": 1}
+    assert sorted(index.duplicates()) == [("b", "a"), ("c", "a")]
+    index.close()
+
+
+def test_rerun_reuses_previous_decisions(tmp_path):
+    path = tmp_path / "dedup.db"
+    input_data = [("a", TEXT), ("b", TEXT), ("d", "something else entirely " * 20)]
+    index = DedupIndex(path)
+    run_dedup(index, input_data)
+    index.close()
+
+    index = DedupIndex(path)
+    input_data[2] = ("d", "changed content " * 20)
+    assert run_dedup(index, input_data) == ["a", "d"]
+    assert index.stats()["reused"] == 2 and index.stats()["hashed"] == 1
+    index.close()
+
+
+def test_signature_memory_is_linear_in_document_size():
+    rng = random.Random(0)
+    text = ''.join(rng.choices("abcdefghijklmnopqrstuvwxyz ", k=300_000))
+    minhash_signature("warm up")  # 生成排列参数
+    tracemalloc.start()
+    try:
+        signature = minhash_signature(text)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(signature) == NUM_PERM * 8
+    # 约30万个shingle 逐个排列计算时峰值约为几个长度为shingle数的uint64数组
+    # 一次计算所有排列的矩阵需要 NUM_PERM * 30万 * 8字节 约300MB
+    assert peak < 48 << 20
+
+
+def test_duplicates_follow_their_representative(tmp_path):
+    db = (tmp_path / "out.db").as_posix()
+    adapter = SQLAdapter(U, db, auto_create=True)
+    adapter.add_rows([("alice", 1, "ok"), ("carol", 3, "earlier")], adapter.conn)
+    adapter.conn.commit()
+    duplicates = PendingDuplicates()
+    for duplicate, representative in [("ok_dup", "ok"), ("bad_dup", "bad"), ("earlier_dup", "earlier"),
+                                      ("missing_dup", "other_shard")]:
+        duplicates.add(duplicate, representative)
+    duplicates.record(ExtractResult(file_name="ok"))
+    duplicates.record(ExtractResult(file_name="bad", request_success=False, fail_message="timeout"))
+
+    results = {e.file_name: e for e in duplicates.resolve(adapter)}
+    assert results["ok_dup"].parse_success and results["earlier_dup"].parse_success
+    # 代表文件失败或没有行时 重复文件记为失败 不会被当作已完成而丢失
+    assert not results["bad_dup"].parse_success and "timeout" in results["bad_dup"].fail_message
+    assert not results["missing_dup"].parse_success
+    rows = adapter.conn.execute("SELECT user_name, file_path FROM U ORDER BY file_path").fetchall()
+    assert rows == [("carol", "earlier"), ("carol", "earlier_dup"), ("alice", "ok"), ("alice", "ok_dup")]
+
+
+def test_late_write_failure_of_representative_fails_duplicate(tmp_path):
+    adapter = SQLAdapter(U, (tmp_path / "out.db").as_posix(), auto_create=True)
+    duplicates = PendingDuplicates()
+    duplicates.add("dup", "rep")
+    duplicates.record(ExtractResult(file_name="rep"))
+    duplicates.record(ExtractResult(file_name="rep", parse_success=False, fail_message="UNIQUE constraint failed"))
+    [ret] = duplicates.resolve(adapter)
+    assert not ret.parse_success and "UNIQUE" in ret.fail_message
@@ -0,0 +1,34 @@
+import asyncio
+
+import httpx
+
+from core.http_transport import ShardedAsyncTransport, POOL_SHARD_SIZE
+
+
+def test_large_pool_is_split_into_small_shards():
+    transport = ShardedAsyncTransport(100, http2=False)
+    assert len(transport) == 4
+    pools = [e._pool for e in transport.shards]
+    assert all(e._max_keepalive_connections == 25 for e in pools)
+    assert len(ShardedAsyncTransport(1, http2=False)) == 1
+    assert len(ShardedAsyncTransport(POOL_SHARD_SIZE, http2=False)) == 1
+    asyncio.run(transport.aclose())
+
+
+def test_requests_are_spread_over_shards():
+    transport = ShardedAsyncTransport(3 * POOL_SHARD_SIZE, http2=False)
+    calls = []
+    for i, shard in enumerate(transport.shards):
+        async def handle(request, i=i):
+            calls.append(i)
+            return httpx.Response(200)
+
+        shard.handle_async_request = handle
+
+    async def run():
+        async with httpx.AsyncClient(transport=transport) as client:
+            for _ in range(6):
+                await client.get("http://example.invalid/")
+
+    asyncio.run(run())
+    assert sorted(calls) == [0, 0, 1, 1, 2, 2]
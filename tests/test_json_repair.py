@@ -0,0 +1,24 @@
+import json
+
+import pytest
+
+from core.json_repair import repair_json_locally
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ("{'a': 'it\\'s', 'b': None, 'c': True}", {"a": "it's", "b": None, "c": True}),
+    ('{"a": 1, // comment\n "b": [1, 2,],}', {"a": 1, "b": [1, 2]}),
+    ('{"a": {"b": "unterminated', {"a": {"b": "unterminated"}}),
+])
+def test_repairs_common_mistakes(text, expected):
+    assert json.loads(repair_json_locally(text)) == expected
+
+
+def test_truncated_array_keeps_complete_elements():
+    text = '[{"name": "a"}, {"name": "b"}, {"name": "c'
+    assert json.loads(repair_json_locally(text, one_to_many=True)) == [{"name": "a"}, {"name": "b"}]
+
+
+def test_returns_none_without_json():
+    assert repair_json_locally("no json here") is None
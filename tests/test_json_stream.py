@@ -0,0 +1,66 @@
+import asyncio
+import json
+
+from core.json_stream import JsonArrayStream, StreamCollector, salvage_result, stream_sink
+
+
+def test_elements_are_emitted_as_their_closing_brace_arrives():
+    stream = JsonArrayStream()
+    text = '```json\n[{"a": "x}"}, {"b": [1, {"c": 2}]}, {"d": "\\"]"}]\ntrailing [{"e": 1}]'
+    elements = []
+    for i in range(0, len(text), 3):
+        elements.extend(stream.feed(text[i:i + 3]))
+    assert [json.loads(e) for e in elements] == [{"a": "x}"}, {"b": [1, {"c": 2}]}, {"d": "\"]"}]
+    assert stream.finished
+
+
+def test_non_object_elements_are_ignored():
+    assert JsonArrayStream().feed('[1, "a", [2], {"x": 1}]') == ['{"x": 1}']
+
+
+def test_interrupted_stream_is_salvaged():
+    received = []
+
+    async def sink(element: str) -> int:
+        received.append(element)
+        return 1
+
+    async def run():
+        token = stream_sink.set(sink)
+        try:
+            collector = StreamCollector()
+            await collector.feed('[{"a": 1}, {"a"')
+            return collector
+        finally:
+            stream_sink.reset(token)
+
+    collector = asyncio.run(run())
+    assert received == ['{"a": 1}'] and collector.salvageable
+    ret = salvage_result("f", "prompt", collector, TimeoutError())
+    assert ret.request_success and ret.json_str == '[{"a": 1}, {"a"'
+    assert "stream interrupted after 1 objects" in ret.fail_message
+
+
+def collect(text: str, sink=None) -> StreamCollector:
+    async def run():
+        token = stream_sink.set(sink)
+        try:
+            collector = StreamCollector()
+            await collector.feed(text)
+            return collector
+        finally:
+            stream_sink.reset(token)
+
+    return asyncio.run(run())
+
+
+def test_without_sink_truncated_reply_is_retried_not_salvaged():
+    # 一对一模式与分块提取没有sink 没有写入任何行 应当重试
+    assert not collect('[{"a": 1}, {"a"').salvageable
+
+
+def test_sink_that_wrote_no_rows_is_not_salvaged():
+    async def rejecting_sink(element: str) -> int:
+        return 0
+
+    assert not collect('[{"a": 1}, {"a"', rejecting_sink).salvageable
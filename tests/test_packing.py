@@ -0,0 +1,26 @@
+import json
+
+from core.packing import pack_articles, split_packed_reply
+
+
+def test_pack_articles_numbers_documents_from_one():
+    packed = pack_articles(["first", "second"])
+    assert packed == "=== Document 1 ===\nfirst\n=== Document 2 ===\nsecond\n"
+
+
+def test_split_packed_reply_by_document_id():
+    reply = 'Here you go: {"Document 1": {"x": 1}, "document 2": [{"x": 2}], "Document 5": {"x": 5}, "3": null}'
+    assert split_packed_reply(reply, 3, one_to_many=False) == {1: json.dumps({"x": 1}), 2: json.dumps({"x": 2})}
+
+
+def test_split_packed_reply_wraps_single_objects_for_one_to_many():
+    reply = json.dumps({"1": {"x": 1}, "2": [{"x": 2}, {"x": 3}]})
+    ret = split_packed_reply(reply, 2, one_to_many=True)
+    assert json.loads(ret[1]) == [{"x": 1}]
+    assert json.loads(ret[2]) == [{"x": 2}, {"x": 3}]
+
+
+def test_truncated_reply_drops_the_last_document():
+    reply = '{"1": {"x": 1}, "2": {"x": 2}, "3": {"x": 3, "y": '
+    # 被截断的文档3经本地修复后可能缺少字段 丢弃
+    assert split_packed_reply(reply, 3, one_to_many=False) == {1: json.dumps({"x": 1}), 2: json.dumps({"x": 2})}
@@ -0,0 +1,118 @@
+import asyncio
+import json
+import threading
+
+from core.extract_helper import ExtractResult
+from core.response_cache import ResponseCache, cached_extraction
+
+
+def make_extract_func(results: list[ExtractResult]):
+    calls = []
+
+    async def extract(file_name: str, file_content: str) -> ExtractResult:
+        calls.append(file_name)
+        return results[len(calls) - 1]
+
+    return extract, calls
+
+
+def run_twice(cache: ResponseCache, ret: ExtractResult, post_check_func=lambda _: True) -> list[str]:
+    extract, calls = make_extract_func([ret, ret])
+    wrapped = cached_extraction(extract, cache, "model", "prompt {article}", post_check_func)
+
+    async def run():
+        await wrapped("a", "content")
+        return await wrapped("a", "content")
+
+    asyncio.run(run())
+    return calls
+
+
+def test_complete_result_is_cached(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.db")
+    calls = run_twice(cache, ExtractResult(file_name="a", json_str=json.dumps({"x": 1}), tokens_consumed=10))
+    assert calls == ["a"]
+    assert cache.stats()["hits"] == 1
+    cache.close()
+
+
+def test_incomplete_results_are_not_cached(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.db")
+    # 请求失败
+    assert len(run_twice(cache, ExtractResult(request_success=False, file_name="a"))) == 2
+    # 中断后保留部分实例的流式回复
+    salvaged = ExtractResult(file_name="a", json_str='[{"x": 1}, {"x"', fail_message="stream interrupted")
+    assert len(run_twice(cache, salvaged)) == 2
+    # 流式回复没有经过后处理检查
+    streamed = ExtractResult(file_name="a", json_str=json.dumps({"x": 1}))
+    assert len(run_twice(cache, streamed, post_check_func=lambda _: False)) == 2
+    assert cache.stats()["hits"] == 0
+    cache.close()
+
+
+def test_hit_does_not_write_until_next_put_or_close(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = ResponseCache(path)
+    cache.put("model", "p", "{}", 1)
+    before = cache.conn.total_changes
+    assert cache.get("model", "p") == ("{}", 1)
+    assert cache.conn.total_changes == before
+    assert cache.accessed
+    cache.close()
+    assert not cache.accessed
+
+
+def test_eviction_uses_recorded_access_time(tmp_path):
+    cache = ResponseCache(tmp_path / "cache.db", max_bytes=250)
+    cache.put("model", "old", "x" * 100, 1)
+    cache.put("model", "new", "x" * 100, 1)
+    cache.get("model", "old")  # 最近访问过 不应被淘汰
+    cache.put("model", "third", "x" * 100, 1)
+    assert cache.get("model", "old") is not None
+    assert cache.get("model", "new") is None
+    cache.close()
+
+
+def test_adds_are_committed_in_batches(tmp_path):
+    path = tmp_path / "cache.db"
+    cache = ResponseCache(path, batch_size=3)
+
+    async def run():
+        before = cache.conn.total_changes
+        cache.add("model", "p0", "{}", 1)
+        cache.add("model", "p1", "{}", 1)
+        # 尚未写入的回复也能命中
+        assert await cache.lookup("model", "p0") == ("{}", 1)
+        assert cache.conn.total_changes == before
+        cache.add("model", "p2", "{}", 1)
+        await cache.flush()
+        assert cache.conn.total_changes == before + 3
+        cache.add("model", "p3", "{}", 1)
+        await cache.aclose()
+
+    asyncio.run(run())
+    reopened = ResponseCache(path)
+    assert all(reopened.get("model", f"p{i}") == ("{}", 1) for i in range(4))
+    reopened.close()
+
+
+def test_lookup_runs_off_the_event_loop(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path / "cache.db")
+    cache.put("model", "p", "{}", 1)
+    threads = []
+    get = cache._get
+
+    def recording_get(key):
+        threads.append(threading.current_thread())
+        return get(key)
+
+    monkeypatch.setattr(cache, "_get", recording_get)
+
+    async def run():
+        assert await cache.lookup("model", "p") == ("{}", 1)
+        assert await cache.lookup("model", "missing") is None
+        await cache.aclose()
+
+    asyncio.run(run())
+    assert len(threads) == 2 and threading.main_thread() not in threads
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
@@ -0,0 +1,69 @@
+import asyncio
+
+import httpx
+import openai
+import pytest
+
+from core.extract_helper import ExtractResult
+from core.retry import (RetryableError, FatalError, RetryPolicy, classify_exception, failure_from_exception,
+                        retrying_extraction)
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int, headers: dict | None = None):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.response = httpx.Response(status_code, headers=headers or {})
+
+
+def test_rate_limit_is_retryable_and_keeps_retry_after():
+    error = classify_exception(StatusError(429, {"retry-after": "3"}))
+    assert isinstance(error, RetryableError) and error.rate_limited and error.retry_after == 3
+
+
+@pytest.mark.parametrize("e", [StatusError(500), StatusError(503), StatusError(408),
+                               httpx.ConnectError("refused"), httpx.ReadTimeout("slow"),
+                               openai.APITimeoutError(httpx.Request("POST", "http://x")),
+                               asyncio.TimeoutError(), ConnectionResetError()])
+def test_transient_errors_are_retryable(e):
+    assert isinstance(classify_exception(e), RetryableError)
+
+
+@pytest.mark.parametrize("status_code", [401, 402, 403])
+def test_auth_errors_are_fatal(status_code):
+    assert isinstance(classify_exception(StatusError(status_code)), FatalError)
+
+
+@pytest.mark.parametrize("e", [StatusError(400), StatusError(404), KeyError("choices"),
+                               AttributeError("'NoneType' object has no attribute 'content'"), TypeError()])
+def test_other_errors_fail_the_file_immediately(e):
+    assert classify_exception(e) is None
+
+
+def test_programming_error_is_not_retried():
+    calls = []
+
+    async def extract(file_name: str, file_content: str) -> ExtractResult:
+        calls.append(file_name)
+        try:
+            raise AttributeError("'NoneType' object has no attribute 'content'")
+        except Exception as e:
+            return failure_from_exception(e, file_name, file_content)
+
+    ret = asyncio.run(retrying_extraction(extract, RetryPolicy(max_attempts=5))("a", ""))
+    assert calls == ["a"]
+    assert not ret.request_success and "AttributeError" in ret.fail_message
+
+
+def test_transient_error_is_retried_until_success():
+    calls = []
+
+    async def extract(file_name: str, file_content: str) -> ExtractResult:
+        calls.append(file_name)
+        if len(calls) < 3:
+            return failure_from_exception(httpx.ConnectError("refused"), file_name, file_content)
+        return ExtractResult(file_name=file_name, json_str="{}")
+
+    policy = RetryPolicy(max_attempts=5, base_delay=0.001, max_delay=0.001)
+    ret = asyncio.run(retrying_extraction(extract, policy)("a", ""))
+    assert len(calls) == 3 and ret.request_success
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+
+from core.extract_helper import ExtractResult
+from core.work_queue import WorkQueue, LeasedInput, MAX_LEASE_ATTEMPTS
+
+
+def statuses(queue: WorkQueue) -> dict[str, str]:
+    return dict(queue.conn.execute("SELECT file_path, status FROM WorkItem"))
+
+
+def expire_leases(queue: WorkQueue):
+    queue.conn.execute("UPDATE WorkItem SET lease_expires=0 WHERE status='leased'")
+
+
+def test_populate_is_idempotent(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    assert queue.populate([f"f{i}" for i in range(5)]) == 5
+    assert queue.populate([f"f{i}" for i in range(7)]) == 2
+    assert queue.progress()["pending"] == 7
+    queue.close()
+
+
+def test_concurrent_claims_are_disjoint(tmp_path):
+    path = tmp_path / "queue.db"
+    WorkQueue(path).populate([f"f{i}" for i in range(200)])
+    claimed: dict[str, list[str]] = {}
+
+    def worker(worker_id: str):
+        # 每个worker使用自己的连接 与不同进程一样通过数据库的锁互斥
+        queue = WorkQueue(path)
+        claimed[worker_id] = []
+        while file_paths := queue.claim(worker_id, 7, 60):
+            claimed[worker_id].extend(file_paths)
+        queue.close()
+
+    threads = [threading.Thread(target=worker, args=(f"w{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    all_claimed = [e for file_paths in claimed.values() for e in file_paths]
+    assert len(all_claimed) == len(set(all_claimed)) == 200
+
+
+def test_expired_lease_is_reclaimed_by_another_worker(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.populate(["a", "b"])
+    assert sorted(queue.claim("w1", 10, 60)) == ["a", "b"]
+    assert queue.claim("w2", 10, 60) == []
+    queue.renew("w1", ["a"], 60)
+    expire_leases(queue)
+    assert sorted(queue.claim("w2", 10, 60)) == ["a", "b"]
+    # 原来的worker不能再提交或续期已被其他worker租用的文件
+    queue.complete("w1", [("a", True)])
+    assert statuses(queue)["a"] == "leased"
+    queue.complete("w2", [("a", True), ("b", False)])
+    assert statuses(queue) == {"a": "done", "b": "failed"}
+    queue.close()
+
+
+def test_reclaim_expired_returns_files_to_pending(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.populate(["a", "b"])
+    queue.claim("w1", 1, 60)
+    expire_leases(queue)
+    assert queue.reclaim_expired() == 1
+    assert set(statuses(queue).values()) == {"pending"}
+    queue.close()
+
+
+def test_file_fails_after_max_lease_attempts(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.populate(["a"])
+    for i in range(MAX_LEASE_ATTEMPTS):
+        assert queue.claim(f"w{i}", 1, 60) == ["a"]
+        expire_leases(queue)
+    assert queue.claim("w", 1, 60) == []
+    assert statuses(queue) == {"a": "failed"}
+    # 重新处理失败的文件时重置尝试次数
+    queue.populate([], retry_failed=True)
+    assert queue.claim("w", 1, 60) == ["a"]
+    queue.close()
+
+
+def test_release_does_not_count_as_attempt(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.populate(["a"])
+    for _ in range(MAX_LEASE_ATTEMPTS + 1):
+        assert queue.claim("w", 1, 60) == ["a"]
+        queue.release("w", ["a"])
+    assert statuses(queue) == {"a": "pending"}
+    queue.close()
+
+
+def run_leased(queue: WorkQueue, results: dict[str, bool], stop_after: int | None = None) -> LeasedInput:
+    """
+    模拟build_task: 从队列租用文件 results中没有的文件没有结果(如PDF解析失败)
+    """
+    leased_input = LeasedInput(queue, "w", batch_size=3)
+
+    async def run():
+        cnt = 0
+        async for file_path in leased_input:
+            if file_path in results:
+                leased_input.finish(ExtractResult(file_name=file_path, request_success=True,
+                                                  parse_success=results[file_path]))
+            cnt += 1
+            if cnt == stop_after:
+                break
+        await leased_input.aclose()
+
+    asyncio.run(run())
+    return leased_input
+
+
+def test_leased_input_marks_only_explicit_results_done(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.populate(["ok", "bad", "no_result"])
+    leased_input = run_leased(queue, {"ok": True, "bad": False})
+    assert statuses(queue) == {"ok": "done", "bad": "failed", "no_result": "failed"}
+    assert leased_input.completed_cnt == 2
+    queue.close()
+
+
+def test_leased_input_late_failure_overrides_success(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.populate(["a"])
+    leased_input = LeasedInput(queue, "w")
+
+    async def run():
+        async for file_path in leased_input:
+            leased_input.finish(ExtractResult(file_name=file_path, request_success=True, parse_success=True))
+            # 行写入失败时以失败的结果再次调用
+            leased_input.finish(ExtractResult(file_name=file_path, request_success=True, parse_success=False))
+        await leased_input.aclose()
+
+    asyncio.run(run())
+    assert statuses(queue) == {"a": "failed"}
+    queue.close()
+
+
+def test_interrupted_leased_input_releases_unfinished_files(tmp_path):
+    queue = WorkQueue(tmp_path / "queue.db")
+    queue.populate([f"f{i}" for i in range(6)])
+    run_leased(queue, {"f0": True, "f1": True}, stop_after=2)
+    # 只租用了第一批 已处理的标记完成 租用中未处理的归还
+    assert sorted(statuses(queue).values()) == ["done", "done", "pending", "pending", "pending", "pending"]
+    queue.close()
+